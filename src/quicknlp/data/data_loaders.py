@@ -4,30 +4,38 @@ from fastai.dataloader import DataLoader
 
 class DialogueDataLoader(DataLoader):
 
-    def pad2d(self, x, max_cl, max_sl):
+    def pad_batch(self, arrays):
+        """Stacks arrays of the same rank into one array padded with pad_idx to the largest size of every dim
 
-        paddings = [(max_cl - x.shape[0], 0), (max_sl - x.shape[1], 0)] if self.pre_pad else [(0, max_cl - x.shape[0]),
-                                                                                              (0, max_sl - x.shape[1])]
-        return np.pad(x, paddings, mode='constant', constant_values=self.pad_idx)
+        Args:
+            arrays (List[np.ndarray]): The arrays of the batch
 
-    def pad1d(self, x, max_sl):
-        paddings = [(max_sl - x.size, 0)] if self.pre_pad else [(0, max_sl - x.size)]
-        return np.pad(x, paddings, mode='constant', constant_values=self.pad_idx)
+        Returns:
+            np.ndarray: The padded batch with dims [bs, *max_dims]
 
-    def get_batch(self, indices):
-        max_cl, max_sl = np.asarray([self.dataset[i][0].shape for i in indices]).max(axis=0)
-        x_batch = np.stack([self.pad2d(self.dataset[i][0], max_cl, max_sl) for i in indices], axis=0)
+        """
+        max_shape = np.asarray([array.shape for array in arrays]).max(axis=0)
+        batch = np.full((len(arrays), *max_shape), self.pad_idx, dtype=arrays[0].dtype)
+        for row, array in zip(batch, arrays):
+            if self.pre_pad:
+                row[tuple(slice(dim - size, dim) for dim, size in zip(max_shape, array.shape))] = array
+            else:
+                row[tuple(slice(0, size) for size in array.shape)] = array
+        return batch
 
-        max_sl = max([self.dataset[i][-2].size for i in indices])
-        y_batch = np.stack([self.pad1d(self.dataset[i][-2], max_sl) for i in indices], axis=0)
-        y_target = np.stack([self.pad1d(self.dataset[i][-1], max_sl) for i in indices], axis=0)
+    def get_batch(self, indices):
+        # every item is fetched once, the batches are filled by slice assignment into one padded array per field
+        items = [self.dataset[i] for i in indices]
+        x_batch = self.pad_batch([item[0] for item in items])
+        y_batch = self.pad_batch([item[-2] for item in items])
+        y_target = self.pad_batch([item[-1] for item in items])
         res = [x_batch, y_batch, y_target]
         if self.transpose:
             res[0], res[1] = np.transpose(res[0], [1, 2, 0]), res[1].T
         if self.transpose_y:
             res[2] = res[2].T
-        if len(self.dataset[0]) > 3:
-            constraints = np.stack([self.dataset[i][1] for i in indices], axis=0)
+        if len(items[0]) > 3:
+            constraints = np.stack([item[1] for item in items], axis=0)
             if self.transpose:
                 constraints = constraints.T
             res = res[0], constraints, res[1], res[2]
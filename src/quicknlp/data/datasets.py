@@ -9,7 +9,6 @@ from typing import Iterator, List, Optional, Tuple, Union
 import numpy as np
 import pandas as pd
 import torch
-from fastai.core import A
 from torchtext.data import Dataset, Example, Field
 from tqdm import tqdm
 
@@ -271,80 +270,140 @@ class DialogueDataset(Dataset):
         return tuple(d for d in (train_data, val_data, test_data) if d is not None)
 
 
+def flatten_sequences(sequences, sos: Optional[int] = None, eos: Optional[int] = None, backwards: bool = False,
+                      dtype=np.int32) -> Tuple[np.ndarray, np.ndarray]:
+    """Concatenates variable length sequences into one flat token array with an offsets table
+
+    Args:
+        sequences (List[List[int]]): The sequences of token ids (lists or arrays, they are flattened)
+        sos (Optional[int]): If given, the token id placed in front of every sequence
+        eos (Optional[int]): If given, the token id placed at the end of every sequence
+        backwards (bool): If True, the tokens of every sequence are stored in reverse order
+        dtype: The dtype of the token array
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The flat tokens and the offsets [num_sequences + 1],
+            sequence i (with its sos and eos) is tokens[offsets[i]:offsets[i + 1]]
+
+    """
+    sequences = [np.asarray(sequence, dtype=dtype).ravel() for sequence in sequences]
+    if backwards:
+        sequences = [sequence[::-1] for sequence in sequences]
+    num_sos, num_eos = int(sos is not None), int(eos is not None)
+    lengths = np.asarray([sequence.size for sequence in sequences], dtype=np.int64)
+    offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+    np.cumsum(lengths + num_sos + num_eos, out=offsets[1:])
+    tokens = np.empty(offsets[-1], dtype=dtype)
+    if len(sequences) > 0:
+        # the positions of the sequence tokens once the sos and eos slots are taken out
+        is_token = np.ones(offsets[-1], dtype=bool)
+        if sos is not None:
+            tokens[offsets[:-1]] = sos
+            is_token[offsets[:-1]] = False
+        if eos is not None:
+            tokens[offsets[1:] - 1] = eos
+            is_token[offsets[1:] - 1] = False
+        tokens[is_token] = np.concatenate(sequences)
+    return tokens, offsets
+
+
 class ContextResponseDataset(Dataset):
     def __init__(self, context: List[int], response: List[int], label: Optional[int] = None, backwards=False,
                  sos: Optional[int] = None,
                  eos: Optional[int] = None):
-        self.c, self.r, self.l, self.backwards, self.sos, self.eos = context, response, label, backwards, sos, eos
+        self.l, self.backwards, self.sos, self.eos = label, backwards, sos, eos
+        self.c, self.c_offsets = flatten_sequences(context, sos=sos, eos=eos, backwards=backwards)
+        self.r, self.r_offsets = flatten_sequences(response, sos=sos, eos=eos)
 
     def __getitem__(self, idx):
-        x = self.c[idx]
-        y = self.r[idx]
-        label = None if self.label is None else self.l[idx]
-        if self.backwards: x = list(reversed(x))
-        if self.eos is not None:
-            x = x + [self.eos]
-            y = y + [self.eos]
-        if self.sos is not None:
-            x = [self.sos] + x
-            y = [self.sos] + y
-        if label is None:
-            return np.array(x), np.array(y)
+        x = self.c[self.c_offsets[idx]:self.c_offsets[idx + 1]]
+        y = self.r[self.r_offsets[idx]:self.r_offsets[idx + 1]]
+        if self.l is None:
+            return x, y
         else:
-            return np.array(x), np.array(y), label
+            return x, y, self.l[idx]
 
     def __len__(self):
-        return len(self.x)
+        return self.c_offsets.size - 1
 
 
 class DialDataset(Dataset):
+    """Dialogues stored as flat int32 arrays. The utterances of all the contexts are kept (with their sos, eos
+    and in reverse order if backwards) in one token array, dialogue i has the utterances
+    dialogue_offsets[i]:dialogue_offsets[i + 1]. Items are padded with pad to the longest utterance of the context.
+    """
+
     def __init__(self, context: List[List[int]], response: List[int], pad: int, label: Optional[int] = None,
                  backwards=False,
                  sos: Optional[int] = None,
                  eos: Optional[int] = None,
                  ):
-        self.c, self.r, self.l, self.backwards, self.sos, self.eos, self.pad = context, response, label, backwards, sos, eos, pad
+        self.l, self.backwards, self.sos, self.eos, self.pad = label, backwards, sos, eos, pad
+        utterances = [utterance for dialogue in context for utterance in dialogue]
+        self.c, self.utterance_offsets = flatten_sequences(utterances, sos=sos, eos=eos, backwards=backwards)
+        self.dialogue_offsets = np.zeros(len(context) + 1, dtype=np.int64)
+        np.cumsum([len(dialogue) for dialogue in context], out=self.dialogue_offsets[1:])
+        self.r, self.r_offsets = flatten_sequences(response, sos=sos, eos=eos)
 
     def __getitem__(self, idx):
-        x = self.c[idx]
-        y = self.r[idx]
-        if self.backwards: x = [list(reversed(i)) for i in x]
-        if self.eos is not None:
-            x = [i + [self.eos] for i in x]
-            y = y + [self.eos]
-        if self.sos is not None:
-            x = [[self.sos] + i for i in x]
-            y = [self.sos] + y
-
-        max_sl = max([len(i) for i in x])
-        x_padded = np.zeros((len(x), max_sl), dtype=np.int64)
-        for i, row in enumerate(x):
-            x_padded[i, :len(row)] = row
-        return x_padded, np.array(y)
+        first, last = self.dialogue_offsets[idx], self.dialogue_offsets[idx + 1]
+        starts = self.utterance_offsets[first:last]
+        lengths = self.utterance_offsets[first + 1:last + 1] - starts
+        tokens = self.c[starts[0]:starts[-1] + lengths[-1]]
+        x_padded = np.full((last - first, lengths.max()), self.pad, dtype=tokens.dtype)
+        # every token goes to the row of its utterance at its position within the utterance
+        rows = np.repeat(np.arange(last - first), lengths)
+        columns = np.arange(tokens.size) - np.repeat(starts - starts[0], lengths)
+        x_padded[rows, columns] = tokens
+        return x_padded, self.r[self.r_offsets[idx]:self.r_offsets[idx + 1]]
+
+    def context_shapes(self):
+        """Returns the (num_utterances, max_utterance_length) of the context of every dialogue with dims [n, 2]"""
+        num_utterances = np.diff(self.dialogue_offsets)
+        max_lengths = np.zeros_like(num_utterances)
+        not_empty = num_utterances > 0
+        if not_empty.any():
+            max_lengths[not_empty] = np.maximum.reduceat(np.diff(self.utterance_offsets),
+                                                         self.dialogue_offsets[:-1][not_empty])
+        return np.stack([num_utterances, max_lengths], axis=1)
 
     def __len__(self):
-        return len(self.c)
+        return self.dialogue_offsets.size - 1
 
 
 class HREDDataset(torch.utils.data.Dataset):
-    def __init__(self, x, y):
-        self.x, self.y = x, y
+    """The contexts [cl, sl] and responses of the dialogues stored as flat int32 arrays. Every response is stored
+    followed by an eos token, so that both the response and its target (the response shifted by one step)
+    are views of the same array.
+    """
 
-    def __getitem__(self, idx):
-        return A(np.atleast_2d(self.x[idx]), self.y[idx],
-                 np.hstack((self.y[idx][1:], np.asarray([2]))))
+    def __init__(self, x, y, eos: int = 2):
+        self.x_shapes = np.asarray([np.shape(np.atleast_2d(i)) for i in x], dtype=np.int64).reshape(-1, 2)
+        self.x, self.x_offsets = flatten_sequences(x)
+        self.y, self.y_offsets = flatten_sequences(y, eos=eos)
 
-    def __len__(self):
-        return len(self.x)
+    def context_shapes(self):
+        """Returns the (num_utterances, max_utterance_length) of the context of every dialogue with dims [n, 2]"""
+        return self.x_shapes
 
+    def context(self, idx):
+        return self.x[self.x_offsets[idx]:self.x_offsets[idx + 1]].reshape(self.x_shapes[idx])
 
-class HREDConstraintsDataset(torch.utils.data.Dataset):
-    def __init__(self, x, c, y):
-        self.x, self.c, self.y = x, c, y
+    def response(self, idx):
+        start, end = self.y_offsets[idx], self.y_offsets[idx + 1]
+        return self.y[start:end - 1], self.y[start + 1:end]
 
     def __getitem__(self, idx):
-        return A(np.atleast_2d(self.x[idx]), self.c[idx], self.y[idx],
-                 np.hstack((self.y[idx][1:], np.asarray([2]))))
+        return [self.context(idx), *self.response(idx)]
 
     def __len__(self):
-        return len(self.x)
+        return self.x_offsets.size - 1
+
+
+class HREDConstraintsDataset(HREDDataset):
+    def __init__(self, x, c, y, eos: int = 2):
+        super().__init__(x=x, y=y, eos=eos)
+        self.c = c
+
+    def __getitem__(self, idx):
+        return [self.context(idx), np.asarray(self.c[idx]), *self.response(idx)]
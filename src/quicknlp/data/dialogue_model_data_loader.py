@@ -10,7 +10,7 @@ from quicknlp.data.torchtext_data_loaders import DialogueTTDataLoader
 from quicknlp.models import CVAE, HRED
 from quicknlp.models.hred_attention import HREDAttention
 from .datasets import DialogueDataset
-from .learners import EncoderDecoderLearner, cvae_loss
+from .learners import EncoderDecoderLearner
 from .model_helpers import CVAEModel, HREDModel, PrintingMixin, HREDAttentionModel
 
 
@@ -165,7 +165,8 @@ class CVAEModelData(HREDModelData):
     def to_model(self, m, opt_fn):
         model = CVAEModel(to_gpu(m))
         learner = EncoderDecoderLearner(self, model, opt_fn=opt_fn)
-        learner.crit = partial(cvae_loss, pad_idx=learner.data.pad_idx)  # change loss to auxiliary loss
+        # change loss to auxiliary loss, computed from the projection inputs if the decoder defers its projection
+        learner.crit = partial(learner.cvaeloss, pad_idx=learner.data.pad_idx)
         return learner
 
     def get_model(self, opt_fn=None, emb_sz=300, nhid=512, nlayers=2, max_tokens=100, latent_dim=100, bow_nhid=400,
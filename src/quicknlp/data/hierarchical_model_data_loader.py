@@ -26,7 +26,7 @@ class HierarchicalModelData(ModelData, PrintingMixin):
 
     def __init__(self, path: str, text_field: Field, target_names: List[str], trn_ds: Dataset, val_ds: Dataset,
                  test_ds: Dataset, bs: int, sort_key: Union[Callable, str] = "sl", max_context_size: int = 130000,
-                 backwards: bool = False, **kwargs):
+                 backwards: bool = False, whole_dialogue: bool = False, max_tokens: Optional[int] = None, **kwargs):
         """ Constructor for the class. An important thing that happens here is
         that the field's "build_vocab" method is invoked, which builds the vocabulary
         for this NLP model.
@@ -48,6 +48,11 @@ class HierarchicalModelData(ModelData, PrintingMixin):
             max_context_size (Optional[int]: The maximums size of allowed context tensors (bs x cl xsl)
                 These will be filtered out so as not to run out of gpu memory
             backwards (bool): Reverse the order of the text or not (not implemented yet)
+            whole_dialogue (bool): If True the training batches have all the turns of the dialogues,
+                so that the models encode every dialogue once and decode the responses of all the turns in parallel.
+                Contexts larger than max_context_size keep their last turns instead of being filtered out
+            max_tokens (Optional[int]): If given the batches have up to max_tokens padded tokens (bs x cl x sl)
+                instead of bs dialogues and no context is filtered out by max_context_size
             **kwargs: Other arguments to be passed to the BucketIterator and the fields build_vocab function
         """
 
@@ -59,7 +64,9 @@ class HierarchicalModelData(ModelData, PrintingMixin):
         self.eos_idx = text_field.vocab.stoi[text_field.eos_token]
 
         trn_dl, val_dl, test_dl = [HierarchicalDataLoader(ds, bs, target_names=target_names, sort_key=sort_key,
-                                                          max_context_size=max_context_size, backwards=backwards)
+                                                          max_context_size=max_context_size, backwards=backwards,
+                                                          whole_dialogue=whole_dialogue and ds is trn_ds,
+                                                          max_tokens=max_tokens)
                                    if ds is not None else None
                                    for ds in (trn_ds, val_ds, test_ds)]
         super().__init__(path=path, trn_dl=trn_dl, val_dl=val_dl, test_dl=test_dl)
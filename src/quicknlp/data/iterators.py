@@ -1,9 +1,10 @@
 import random
 from doctest import Example
 from typing import Iterator as Iter
-from typing import List, Optional, Tuple
+from typing import Callable, List, Optional, Tuple
 
 import numpy as np
+import torch
 import torch.cuda as cuda
 from torch import LongTensor
 from torchtext.data import Batch, BucketIterator, Field, Iterator, batch
@@ -16,39 +17,211 @@ Lengths = List[int]
 LT = LongTensor
 
 
-class HierarchicalIterator(BucketIterator):
+def numericalize_dialogues(examples: List[Example], field: Field) -> None:
+    """Numericalizes the dialogue examples once, so that the batches are padded directly from the token ids.
+
+    Every example gets the token ids of its text (example.ids), the offsets of its utterances in them
+    (example.offsets) and the token ids of its response (example.response_ids) if it has one.
+    The stoi used is kept in example.ids_stoi, the examples that have been numericalized before with the same
+    stoi are skipped, the ones numericalized with another vocab (e.g. a rebuilt one) are numericalized again.
+    """
+    stoi = field.vocab.stoi
+    for example in examples:
+        if getattr(example, "ids_stoi", None) is stoi:
+            continue
+        example.ids_stoi = stoi
+        example.ids = np.array([stoi[token] for token in example.text], dtype=np.int64)
+        example.offsets = np.cumsum([0] + list(example.sl))
+        if hasattr(example, "response"):
+            example.response_ids = np.array([stoi[token] for token in example.response], dtype=np.int64)
+
+
+def pad_token_ids(sequence: np.ndarray, max_len: int, field: Field) -> np.ndarray:
+    """Adds the init and eos tokens of the field to the token ids, truncating them so that they fit in max_len,
+    the same way field.pad does with fix_length=max_len
+    """
+    stoi = field.vocab.stoi
+    max_tokens = max(max_len - (field.init_token is not None) - (field.eos_token is not None), 0)
+    if getattr(field, "truncate_first", False):
+        sequence = sequence[max(len(sequence) - max_tokens, 0):]
+    else:
+        sequence = sequence[:max_tokens]
+    init = [stoi[field.init_token]] if field.init_token is not None else []
+    eos = [stoi[field.eos_token]] if field.eos_token is not None else []
+    return np.concatenate([init, sequence, eos]).astype(np.int64)
+
+
+def pad_dialogues(minibatch: List[Example], max_sl: int, max_conv: int, field: Field, backwards: bool = False,
+                  target_roles: Optional[Roles] = None) -> np.ndarray:
+    """Pads the numericalized utterances of the dialogues into one array [max_conv, max_sl, bs], the same as
+    padding them with field.pad and numericalizing them. If target_roles is given the utterances of the other roles
+    are padded completely.
+    """
+    pad = field.vocab.stoi[field.pad_token]
+    pad_first = getattr(field, "pad_first", False)
+    data = np.full((max_conv, max_sl, len(minibatch)), pad, dtype=np.int64)
+    for row, example in enumerate(minibatch):
+        for index, role in enumerate(example.roles):
+            if target_roles is not None and role not in target_roles:
+                continue
+            utterance = example.ids[example.offsets[index]:example.offsets[index + 1]]
+            utterance = pad_token_ids(utterance[::-1] if backwards else utterance, max_len=max_sl, field=field)
+            if pad_first:
+                data[index, max_sl - len(utterance):, row] = utterance
+            else:
+                data[index, :len(utterance), row] = utterance
+    return data
+
+
+def to_tensor(array: np.ndarray, device: Optional[int]) -> LT:
+    """A LongTensor of the array on the device of a torchtext iterator (-1 for the cpu)"""
+    tensor = torch.from_numpy(array)
+    return tensor if device == -1 else tensor.cuda(device)
+
+
+def dialogue_shape(example: Example) -> Tuple[int, int]:
+    """The (cl, sl) of a dialogue example, the number of its utterances and the length of the longest one"""
+    return len(example.roles), max(example.sl)
+
+
+class MaxTokens:
+    """A batch_size_fn for the torchtext iterators that measures a batch by its number of padded tokens,
+    the batch_size of the iterator is then the maximum number of padded tokens in a batch.
+    A batch of examples with shapes (cl, sl) has bs x max(cl) x max(sl) padded tokens.
+
+    Args:
+        max_tokens (int): The maximum number of padded tokens in a batch. An example larger than it
+            gets a batch of its own.
+        shape (Callable[[Example], Tuple[int, ...]]): Returns the dims of an example before padding
+    """
+
+    def __init__(self, max_tokens: int, shape: Callable[[Example], Tuple[int, ...]]):
+        self.max_tokens = max_tokens
+        self.shape = shape
+        self.max_shape = None
+
+    def __call__(self, new: Example, count: int, sofar: int) -> int:
+        # the batch is started again every time count is 1
+        shape = np.asarray(self.shape(new))
+        self.max_shape = shape if count == 1 else np.maximum(self.max_shape, shape)
+        size = count * int(np.prod(self.max_shape))
+        # torchtext would yield an empty batch for a first example over the limit
+        return min(size, self.max_tokens) if count == 1 else size
+
+
+class TokenBucketIterator(BucketIterator):
+    """A BucketIterator that can batch the examples by their number of padded tokens.
+
+    If max_tokens is given the batches have up to max_tokens padded tokens (see MaxTokens) instead of batch_size
+    examples. The batches are made once from the examples sorted by their shape, so that every batch has examples
+    of similar sizes, and every epoch shuffles their order (if shuffle is True), so that every epoch has the same
+    batches and len is their number.
+    """
+
+    def __init__(self, dataset, batch_size, sort_key, max_tokens: Optional[int] = None,
+                 shape: Optional[Callable[[Example], Tuple[int, ...]]] = None, **kwargs):
+        super().__init__(dataset=dataset, batch_size=batch_size if max_tokens is None else max_tokens,
+                         sort_key=sort_key, **kwargs)
+        self.token_batches = None
+        if max_tokens is not None:
+            self.token_batches = list(batch(sorted(dataset.examples, key=shape), max_tokens,
+                                            MaxTokens(max_tokens, shape=shape)))
+
+    def create_batches(self):
+        if self.token_batches is None:
+            super().create_batches()
+        else:
+            batches = self.random_shuffler(self.token_batches) if self.shuffle else self.token_batches
+            # copies, the minibatches are sorted in place while iterating
+            self.batches = [list(minibatch) for minibatch in batches]
+
+    def __len__(self):
+        return super().__len__() if self.token_batches is None else len(self.token_batches)
+
+
+class HierarchicalIterator(TokenBucketIterator):
     def __init__(self, dataset, batch_size, sort_key, target_roles=None, max_context_size=130000, backwards=False,
-                 **kwargs):
+                 whole_dialogue=False, max_tokens=None, **kwargs):
+        """
+
+        Args:
+            max_context_size (Optional[int]): Contexts larger than max_context_size (bs x cl x sl) are skipped,
+                or with whole_dialogue truncated to their last turns, if None no context is skipped
+            whole_dialogue (bool): If True yield one batch for every minibatch of dialogues with all the turns,
+                context [cl, sl, bs], responses [cl, sl, bs] and targets [sl - 1, n] of the n turns that have
+                a response, instead of one batch for every turn with the contexts up to the turn
+            max_tokens (Optional[int]): If given the minibatches have up to max_tokens padded tokens (bs x cl x sl)
+                instead of batch_size dialogues (see TokenBucketIterator)
+        """
         self.target_roles = target_roles
+        self.whole_dialogue = whole_dialogue
         self.text_field = dataset.fields['text']
         self.max_context_size = max_context_size
         self.backwards = backwards
         device = None if cuda.is_available() else -1
-        super().__init__(dataset=dataset, batch_size=batch_size, sort_key=sort_key, device=device, **kwargs)
+        super().__init__(dataset=dataset, batch_size=batch_size, sort_key=sort_key, device=device,
+                         max_tokens=max_tokens, shape=dialogue_shape, **kwargs)
+        # the vocab is built by now, so the examples are numericalized once instead of on every batch
+        numericalize_dialogues(dataset.examples, self.text_field)
+        self.num_batches = None
+        if self.token_batches is not None:
+            self.num_batches = sum(self.num_yielded(minibatch) for minibatch in self.token_batches)
+
+    def num_yielded(self, minibatch: List[Example]) -> int:
+        """The number of batches the minibatch is yielded as, one for the whole dialogues if they have a response
+        or one for every turn with targets, without the ones skipped for max_context_size
+        """
+        max_sl = max([max(ex.sl) for ex in minibatch])
+        max_conv = max([len(ex.roles) for ex in minibatch])
+        turn_size = max_sl * len(minibatch)
+        # the responses and targets of every turn are its padded utterances, the targets without their first step
+        lengths = self.padded_lengths(minibatch, max_sl=max_sl, max_conv=max_conv)[1:]
+        if self.whole_dialogue:
+            # the turns that are kept (see dialogue_turns)
+            if self.max_context_size is not None:
+                lengths = lengths[-max(self.max_context_size // turn_size, 1):]
+            return int((lengths > 0).any())
+        if getattr(self.text_field, "pad_first", False):
+            has_targets = (lengths > 0).any(axis=1) & (max_sl > 1)
+        else:
+            has_targets = (lengths > 1).any(axis=1)
+        if self.max_context_size is not None:
+            has_targets &= np.arange(1, max_conv) * turn_size <= self.max_context_size
+        return int(has_targets.sum())
+
+    def padded_lengths(self, minibatch: List[Example], max_sl: int, max_conv: int) -> np.ndarray:
+        """The number of tokens that are not padding of every utterance [max_conv, bs] after pad_dialogues
+        with the target_roles, without padding them
+        """
+        field = self.text_field
+        num_special = (field.init_token is not None) + (field.eos_token is not None)
+        max_tokens = max(max_sl - num_special, 0)
+        lengths = np.zeros((max_conv, len(minibatch)), dtype=np.int64)
+        for row, example in enumerate(minibatch):
+            for index, (role, sl) in enumerate(zip(example.roles, example.sl)):
+                if self.target_roles is None or role in self.target_roles:
+                    lengths[index, row] = min(sl, max_tokens) + num_special
+        return lengths
+
+    def __len__(self):
+        """The number of minibatches, or with max_tokens the number of batches yielded in every epoch"""
+        return super().__len__() if self.num_batches is None else self.num_batches
 
     def process_minibatch(self, minibatch: List[Example]) -> Tuple[LT, LT, LT]:
         max_sl = max([max(ex.sl) for ex in minibatch])
         max_conv = max([len(ex.roles) for ex in minibatch])
-        padded_examples, padded_targets, padded_lengths, padded_roles = [], [], [], []
-        for example in minibatch:
-            examples, lens, roles = self.pad(example, max_sl=max_sl, max_conv=max_conv, field=self.text_field)
-            padded_examples.extend(examples)
-            padded_lengths.extend(lens)
-            padded_roles.append(roles)
-            # if self.target_roles is not None we will pad the roles we do not want to train on
-            # this allows for learning only the responses we are interested in
-            targets, *_ = self.pad(example, max_sl=max_sl, max_conv=max_conv, field=self.text_field,
-                                   target_roles=self.target_roles)
-            padded_targets.extend(targets)
-        self.text_field.include_lengths = False
-
-        data = self.text_field.numericalize(padded_examples, device=self.device, train=self.train)
         batch_size = len(minibatch)
-        assert_dims(data, [max_sl, max_conv * batch_size])
-        data = data.view(max_sl, batch_size, max_conv).transpose(2, 0).transpose(2, 1).contiguous()
+        numericalize_dialogues(minibatch, self.text_field)
+        data = to_tensor(pad_dialogues(minibatch, max_sl=max_sl, max_conv=max_conv, field=self.text_field,
+                                       backwards=self.backwards), self.device)
+        # if self.target_roles is not None we will pad the roles we do not want to train on
+        # this allows for learning only the responses we are interested in
+        if self.target_roles is None:
+            targets = data
+        else:
+            targets = to_tensor(pad_dialogues(minibatch, max_sl=max_sl, max_conv=max_conv, field=self.text_field,
+                                              backwards=self.backwards, target_roles=self.target_roles), self.device)
         source = data[:-1]  # we remove the extra padding  sentence added here
-        targets = self.text_field.numericalize(padded_targets, device=self.device, train=self.train)
-        targets = targets.view(max_sl, batch_size, max_conv).transpose(2, 0).transpose(2, 1).contiguous()
         # shapes will be max_conv -1 , max_sl, batch_size
         assert_dims(source, [max_conv - 1, max_sl, batch_size])
         assert_dims(targets, [max_conv, max_sl, batch_size])
@@ -71,13 +244,19 @@ class HierarchicalIterator(BucketIterator):
                         minibatch.sort(key=self.sort_key, reverse=True)
 
                 context, response, targets = self.process_minibatch(minibatch)
+                if self.whole_dialogue:
+                    context, response, targets = self.dialogue_turns(context, response, targets)
+                    if targets.size(1) > 0:
+                        yield Batch.fromvars(dataset=self.dataset, batch_size=len(minibatch), train=self.train,
+                                             context=context, response=response, targets=targets)
+                    continue
                 for index in range(context.shape[0]):
                     # do not yield if the target is just padding (does not provide anything to training)
                     num_empty_targets = targets[index] == self.text_field.vocab.stoi[self.text_field.pad_token]
                     if num_empty_targets.all():
                         continue
                     # skip examples with contexts that won't fit in gpu memory
-                    if np.prod(context[:index + 1].shape) > self.max_context_size:
+                    if self.max_context_size is not None and np.prod(context[:index + 1].shape) > self.max_context_size:
                         continue
                     yield Batch.fromvars(dataset=self.dataset, batch_size=len(minibatch),
                                          train=self.train,
@@ -88,6 +267,31 @@ class HierarchicalIterator(BucketIterator):
             if not self.repeat:
                 raise StopIteration
 
+    def dialogue_turns(self, context: LT, response: LT, targets: LT) -> Tuple[LT, LT, LT]:
+        """The whole dialogue batch of a minibatch. Contexts larger than max_context_size keep their last turns
+        that fit in it (at least one), and the targets of all the turns are flattened the same way the models flatten
+        the responses, without the turns whose response is all padding, e.g. the turns of the other roles or
+        the ones after the end of the shorter dialogues (see HRED.dialogue_turns)
+
+        Args:
+            context (Tensor): The contexts of every turn [cl, sl, bs]
+            response (Tensor): The responses of every turn [cl, sl, bs]
+            targets (Tensor): The targets of every turn [cl, sl - 1, bs]
+
+        Returns:
+            Tuple[Tensor, Tensor, Tensor]: The context [cl, sl, bs], the responses [cl, sl, bs]
+                and the targets [sl - 1, n] of the n turns with a response
+        """
+        cl, sl, bs = context.size()
+        if self.max_context_size is not None and cl * sl * bs > self.max_context_size:
+            num_turns = max(self.max_context_size // (sl * bs), 1)
+            context, response, targets = context[-num_turns:], response[-num_turns:], targets[-num_turns:]
+        pad = self.text_field.vocab.stoi[self.text_field.pad_token]
+        responses = response.permute(1, 0, 2).contiguous().view(sl, -1)
+        turns = ((responses != pad).sum(dim=0) > 0).nonzero().view(-1)
+        targets = targets.permute(1, 0, 2).contiguous().view(targets.size(1), -1)
+        return context, response, targets.index_select(1, turns) if turns.numel() > 0 else targets[:, :0]
+
     def pad(self, example: Example, max_sl: int, max_conv: int, field: Field, target_roles: Optional[Roles] = None) -> \
             Tuple[Conversations, Lengths, Roles]:
         """Pad a hierarchical example to the max sequence length and max conv length provided. Optionally if
@@ -128,6 +332,8 @@ class DialogueIterator(Iterator):
         self.sort_key_inner = sort_key_inner  # inner should be utterance sizes
         self.sort_key_outer = sort_key_outer  # outer should be dialogue sizes
         super().__init__(dataset=dataset, batch_size=batch_size, sort_key=sort_key, device=device, **kwargs)
+        # the vocab is built by now, so the examples are numericalized once instead of on every batch
+        numericalize_dialogues(dataset.examples, self.text_field)
 
     def create_batches(self):
         if self.sort:
@@ -184,23 +390,22 @@ class DialogueIterator(Iterator):
     def process_minibatch(self, minibatch: List[Example]) -> Tuple[LT, LT, LT]:
         max_sl = max([max(ex.sl) for ex in minibatch])
         max_conv = max([len(ex.roles) for ex in minibatch])
-        padded_examples, targets, padded_lengths, padded_roles = [], [], [], []
-        for example in minibatch:
-            examples, lens, roles = self.pad(example, max_sl=max_sl, max_conv=max_conv, field=self.text_field)
-            padded_examples.extend(examples)
-            padded_lengths.extend(lens)
-            padded_roles.append(roles)
-            targets.append(example.response)
-        self.text_field.include_lengths = False
-
-        data = self.text_field.numericalize(padded_examples, device=self.device, train=self.train)
         batch_size = len(minibatch)
-        assert_dims(data, [max_sl, max_conv * batch_size])
-        data = data.view(max_sl, batch_size, max_conv).transpose(2, 0).transpose(2, 1).contiguous()
-        self.text_field.fix_length = None
-        padded_targets = self.text_field.pad(targets)
-        targets = self.text_field.numericalize(padded_targets, device=self.device,
-                                               train=self.train)  # [max_sl, batch_size]
+        numericalize_dialogues(minibatch, self.text_field)
+        data = to_tensor(pad_dialogues(minibatch, max_sl=max_sl, max_conv=max_conv, field=self.text_field,
+                                       backwards=self.backwards), self.device)
+        # the responses are padded to the longest one
+        max_response = max([len(ex.response_ids) for ex in minibatch])
+        max_response += (self.text_field.init_token is not None) + (self.text_field.eos_token is not None)
+        targets = np.full((max_response, batch_size), self.text_field.vocab.stoi[self.text_field.pad_token],
+                          dtype=np.int64)
+        for row, example in enumerate(minibatch):
+            response = pad_token_ids(example.response_ids, max_len=max_response, field=self.text_field)
+            if getattr(self.text_field, "pad_first", False):
+                targets[max_response - len(response):, row] = response
+            else:
+                targets[:len(response), row] = response
+        targets = to_tensor(targets, self.device)  # [max_sl, batch_size]
         assert_dims(data, [max_conv, max_sl, batch_size])
         assert_dims(targets, [None, batch_size])
         return data, targets, targets[1:]
@@ -1,3 +1,4 @@
+import math
 from functools import partial
 
 import torch
@@ -10,39 +11,53 @@ from quicknlp.data.model_helpers import predict_with_seq2seq, CVAEModel
 from quicknlp.stepper import S2SStepper
 
 
-def decoder_loss(input, target, pad_idx, predict_first_token=False, **kwargs):
+def decoder_loss(input, target, pad_idx, predict_first_token=False, projection=None, **kwargs):
+    """The cross entropy of the decoder outputs [sl_in, bs, vocab] and the targets [sl, bs], ignoring the pad tokens
+
+    If the projection layer is given the input are the inputs of the projection layer [sl_in, bs, dim]
+    (see Decoder.deferred_projection) and the loss is computed by projection.loss, e.g. the loss of an
+    AdaptiveProjection does not compute the scores of the whole vocabulary.
+    """
+    if projection is not None:
+        sl = 1 if predict_first_token else target.size(0)
+        return projection.loss(input[:sl], target[:sl], pad_idx)
     sl_in, bs_in, vocab = input.size()
-    sl, bs = target.size()
-    # if the input size is smaller than the target fill it up with zeros (i.e. unks)
-    if sl > sl_in:
-        input = F.pad(input, (0, sl - sl_in, 0, 0, 0, 0), value=0)
-    input = input[:sl]
     if predict_first_token:
-        input = input[:1]
         target = target[:1]
-    return F.cross_entropy(input=input.view(-1, vocab),
-                           target=target.view(-1),
-                           ignore_index=pad_idx)
+    sl, bs = target.size()
+    steps = min(sl, sl_in)
+    loss = F.cross_entropy(input=input[:steps].contiguous().view(-1, vocab),
+                           target=target[:steps].contiguous().view(-1),
+                           ignore_index=pad_idx, size_average=False)
+    not_pad = target.data != pad_idx
+    # if the input is shorter than the target its missing steps score zero for every token (i.e. log(vocab) loss),
+    # without padding a copy of the input
+    if sl > sl_in:
+        loss = loss + math.log(vocab) * float(not_pad[sl_in:].sum())
+    return loss / max(float(not_pad.sum()), 1.)
 
 
-def decoder_loss_smoothed(input, target, pad_idx, smoothing_factor=0.9, loss_scale=1e4, **kwargs):
+def decoder_loss_smoothed(input, target, pad_idx, smoothing_factor=0.9, loss_scale=1., **kwargs):
+    """The label smoothed cross entropy of the decoder outputs [sl_in, bs, vocab] and the targets [sl, bs],
+    ignoring the pad tokens
+
+    The smoothed target distribution gives smoothing_factor to the target token and spreads the rest evenly over
+    the other tokens, its cross entropy is computed in closed form from the target log probability and the sum
+    of the log probabilities of the vocabulary, without building the target distributions.
+    """
     sl_in, bs_in, vocab = input.size()
     sl, bs = target.size()
-    # if the input size is smaller than the target fill it up with zeros (i.e. unks)
-    if sl > sl_in:
-        input = F.pad(input, (0, sl - sl_in, 0, 0, 0, 0), value=0.)
+    steps = min(sl, sl_in)
     smoothing_pdf = (1. - smoothing_factor) / (vocab - 1.)
-    targets = torch.zeros_like(input).scatter(2, target.unsqueeze(-1), smoothing_factor - smoothing_pdf)
-    targets = (targets + smoothing_pdf)
-    targets = targets.div(targets.sum(dim=-1).unsqueeze_(-1))
-    # weights = None
-    weights = to_gpu(V(torch.ones(targets.size(-1)).view(1, 1, -1)))
-    weights[..., pad_idx] = 0
-    input = F.log_softmax(input, dim=-1)
-    return F.binary_cross_entropy_with_logits(input=input,
-                                              target=targets,
-                                              weight=weights
-                                              ) * loss_scale
+    logprobs = F.log_softmax(input[:steps], dim=-1)
+    target_logprobs = logprobs.gather(2, target[:steps].unsqueeze(-1)).squeeze(-1)  # [steps, bs]
+    loss = -(smoothing_factor - smoothing_pdf) * target_logprobs - smoothing_pdf * logprobs.sum(dim=-1)
+    not_pad = V((target.data != pad_idx).float())
+    loss = (loss * not_pad[:steps]).sum()
+    # if the input is shorter than the target its missing steps score zero for every token (i.e. log(vocab) loss)
+    if sl > sl_in:
+        loss = loss + math.log(vocab) * float(not_pad.data[sl_in:].sum())
+    return loss / max(float(not_pad.data.sum()), 1.) * loss_scale
 
 
 def gaussian_kld(recog_mu, recog_logvar, prior_mu, prior_logvar):
@@ -52,30 +67,25 @@ def gaussian_kld(recog_mu, recog_logvar, prior_mu, prior_logvar):
     return kld
 
 
-def cvae_loss(input, target, pad_idx, step=0, max_kld_step=None, **kwargs):
+def cvae_loss(input, target, pad_idx, step=0, max_kld_step=None, projection=None, **kwargs):
     predictions, recog_mu, recog_log_var, prior_mu, prior_log_var, bow_logits = input
-    sl, bs, vocab = predictions.size()
-    # dims are sq-1 times bs times vocab
-    dec_input = predictions[:target.size(0)].view(-1, vocab).contiguous()
+    bs = bow_logits.size(0)
     slt = target.size(0)
-    bow_targets = bow_logits.unsqueeze_(0).repeat(slt, 1, 1)
-    target = target.view(-1).contiguous()
-    bow_loss = F.cross_entropy(input=bow_targets.view(-1, vocab), target=target, ignore_index=pad_idx,
-                               reduce=False).view(-1, bs)
-    bow_loss = bow_loss.mean()
+    # dims are sq-1 times bs times vocab
+    dec_loss = decoder_loss(predictions, target, pad_idx=pad_idx, projection=projection)
+    # every target token of a response is scored by the bag of words of its batch row, the pad tokens score zero
+    bow_logprobs = F.log_softmax(bow_logits, dim=-1)  # [bs, vocab]
+    bow_loss = -bow_logprobs.gather(1, target.t()) * V((target.data.t() != pad_idx).float())  # [bs, slt]
+    bow_loss = bow_loss.sum() / (slt * bs)
     # targets are sq-1 times bs (one label for every word)
     kld_loss = gaussian_kld(recog_mu, recog_log_var, prior_mu, prior_log_var)
-    decoder_loss = F.cross_entropy(input=dec_input,
-                                   target=target,
-                                   ignore_index=pad_idx,
-                                   )
     kld_weight = 1.0 if max_kld_step is None else min((step + 1) / max_kld_step, 1)
     global STEP
     if step > STEP:
         if step == 0: STEP = 0
-        print(f"\nlosses: decoder {decoder_loss}, bow: {bow_loss}, kld x weight: {kld_loss} x {kld_weight}")
+        print(f"\nlosses: decoder {dec_loss}, bow: {bow_loss}, kld x weight: {kld_loss} x {kld_weight}")
         STEP += 1
-    return decoder_loss + bow_loss + kld_loss * kld_weight
+    return dec_loss + bow_loss + kld_loss * kld_weight
 
 
 STEP = 0
@@ -112,22 +122,45 @@ def cvae_loss_sigmoid(input, target, pad_idx, step=0, max_kld_step=None, **kwarg
 class EncoderDecoderLearner(Learner):
 
     def s2sloss(self, input, target, smoothing_factor=None, pad_idx=1, **kwargs):
-        if smoothing_factor is None:
-            return decoder_loss(input=input, target=target, pad_idx=pad_idx, **kwargs)
+        projection = self.deferred_projection_layer()
+        # label smoothing and deferred projection are not used together (see __init__)
+        if smoothing_factor is None or projection is not None:
+            return decoder_loss(input=input, target=target, pad_idx=pad_idx, projection=projection, **kwargs)
         else:
             return decoder_loss_smoothed(input=input, target=target, smoothing_factor=smoothing_factor, pad_idx=pad_idx,
                                          **kwargs
                                          )
 
-    def __init__(self, data, models, smoothing_factor=None, predict_first_token=False, **kwargs):
+    def cvaeloss(self, input, target, pad_idx=1, **kwargs):
+        return cvae_loss(input=input, target=target, pad_idx=pad_idx, projection=self.deferred_projection_layer(),
+                         **kwargs)
+
+    def __init__(self, data, models, smoothing_factor=None, predict_first_token=False, deferred_projection=False,
+                 **kwargs):
+        """
+
+        Args:
+            deferred_projection (bool): If True the decoder does not project its outputs in training and the loss
+                is computed by the projection layer from its inputs, e.g. with an AdaptiveProjection.
+                It can not be used with label smoothing (smoothing_factor) or with an AttentionDecoder
+        """
+        if deferred_projection and smoothing_factor is not None:
+            raise ValueError("deferred_projection can not be used with label smoothing, set smoothing_factor to None")
         super().__init__(data, models, **kwargs)
+        if deferred_projection:
+            self.model.decoder.deferred_projection = True
         if isinstance(models, CVAEModel):
-            self.crit = partial(cvae_loss, pad_idx=1)
+            self.crit = partial(self.cvaeloss, pad_idx=1)
         else:
             self.crit = partial(self.s2sloss, smoothing_factor=smoothing_factor,
                                 predict_first_token=predict_first_token)
         self.fit_gen = partial(self.fit_gen, stepper=S2SStepper)
 
+    def deferred_projection_layer(self):
+        """The projection layer of the decoder if the decoder outputs are its inputs, otherwise None"""
+        decoder = self.model.decoder
+        return decoder.projection_layer if decoder.defer_projection else None
+
     def save_encoder(self, name):
         save_model(self.model[0], self.get_model_path(name))
 
@@ -137,9 +170,9 @@ class EncoderDecoderLearner(Learner):
     def predict_with_targs(self, is_test=False):
         return self.predict_with_targs_and_inputs(is_test=is_test)[:2]
 
-    def predict_with_targs_and_inputs(self, is_test=False, num_beams=1):
+    def predict_with_targs_and_inputs(self, is_test=False, num_beams=1, inference=False):
         dl = self.data.test_dl if is_test else self.data.val_dl
-        return predict_with_seq2seq(self.model, dl, num_beams=num_beams)
+        return predict_with_seq2seq(self.model, dl, num_beams=num_beams, inference=inference)
 
     def predict_array(self, arr):
         raise NotImplementedError
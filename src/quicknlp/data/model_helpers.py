@@ -1,8 +1,12 @@
+import contextlib
+from inspect import signature
 from typing import Dict, List, Union
 
 import numpy as np
 import pandas as pd
-from fastai.core import BasicModel, VV, to_np
+import torch.nn as nn
+from fastai.core import BasicModel, VV, no_grad_context, to_np
+from fastai.rnn_reg import LockedDropout
 from torchtext.data import Field
 
 BeamTokens = List[str]
@@ -56,16 +60,64 @@ def check_columns_in_df(df: pd.DataFrame, columns: List[str]) -> bool:
         return True
 
 
-def predict_with_seq2seq(m, dl, num_beams=1):
+def set_inference(m, inference=True):
+    """Sets the inference mode of the decoders in the model, in inference mode greedy and beam search
+    run without gradients and keep only the decoded tokens and their scores
+
+    Args:
+        m (nn.Module): The model
+        inference (Union[bool, Dict[nn.Module, bool]]): The inference mode of all the decoders,
+            or the inference mode of every decoder e.g. the one returned by a previous call
+
+    Returns:
+        Dict[nn.Module, bool]: The inference mode every decoder had before the call
+    """
+    previous = {}
+    for module in m.modules():
+        if hasattr(module, "inference"):
+            previous[module] = module.inference
+            module.inference = inference[module] if isinstance(inference, dict) else inference
+    return previous
+
+
+def freeze_for_inference(m, stack=True):
+    """Prepares a model for a faster inference, the outputs in eval mode stay the same.
+
+    The modules with a freeze_for_inference method (e.g. RNNLayers, Cell, DropoutEmbeddings) replace their
+    weight dropped cells with plain RNN modules and drop their dropout wrappers, the dropout of the other
+    modules is set to zero. The model is set to eval mode and should not be trained afterwards.
+
+    Args:
+        m (nn.Module): The model to freeze
+        stack (bool): If True the consecutive RNN layers are stacked to multi-layer RNNs where possible
+
+    Returns:
+        nn.Module: the frozen model
+    """
+    for module in list(m.modules()):
+        if hasattr(module, "freeze_for_inference"):
+            kwargs = dict(stack=stack) if "stack" in signature(module.freeze_for_inference).parameters else {}
+            module.freeze_for_inference(**kwargs)
+        elif isinstance(module, (nn.Dropout, LockedDropout)):
+            module.p = 0.0
+    return m.eval()
+
+
+def predict_with_seq2seq(m, dl, num_beams=1, inference=False):
     m.eval()
     if hasattr(m, 'reset'):
         m.reset()
+    previous_inference = set_inference(m, inference)
     inputs, predictions, targets = [], [], []
-    for *x, y in iter(dl):
-        inputs.append(to_np(x[0]))
-        targets.append(to_np(y))
-        prediction, *_ = m(*VV(x), num_beams=num_beams)
-        predictions.append(to_np(prediction))
+    try:
+        with no_grad_context() if inference else contextlib.suppress():
+            for *x, y in iter(dl):
+                inputs.append(to_np(x[0]))
+                targets.append(to_np(y))
+                prediction, *_ = m(*VV(x), num_beams=num_beams)
+                predictions.append(to_np(prediction))
+    finally:
+        set_inference(m, previous_inference)
     return predictions, targets, inputs
 
 
@@ -26,7 +26,7 @@ class S2SModelData(ModelData, PrintingMixin):
 
     def __init__(self, path: str, fields: List[NamedField], source_names: List[str], target_names: List[str],
                  trn_ds: Dataset, val_ds: Dataset, test_ds: Dataset, bs: int,
-                 sort_key: Optional[Callable] = None,
+                 sort_key: Optional[Callable] = None, max_tokens: Optional[int] = None,
                  **kwargs):
         """ Constructor for the class. An important thing that happens here is
         that the field's "build_vocab" method is invoked, which builds the vocabulary
@@ -46,6 +46,8 @@ class S2SModelData(ModelData, PrintingMixin):
             sort_key (Optional[Callable]): A function to sort the data in the batches. I should provide the name of a
                 field to use. If None the name of the first field in fields will be used to sort the batch.
             backwards (bool): Reverse the order of the text or not (not implemented yet)
+            max_tokens (Optional[int]): If given the batches have up to max_tokens padded tokens (bs x sl)
+                instead of bs examples
             **kwargs: Other arguments to be passed to the BucketIterator and the fields build_vocab function
         """
 
@@ -60,7 +62,7 @@ class S2SModelData(ModelData, PrintingMixin):
 
         trn_dl, val_dl, test_dl = [S2SDataLoader(ds, bs, source_names=source_names,
                                                  target_names=target_names, sort_key=sort_key,
-                                                 )
+                                                 max_tokens=max_tokens)
                                    if ds is not None else None
                                    for ds in (trn_ds, val_ds, test_ds)]
         super(S2SModelData, self).__init__(path=path, trn_dl=trn_dl, val_dl=val_dl, test_dl=test_dl)
@@ -2,6 +2,16 @@ import numpy as np
 from torch.utils.data.sampler import Sampler
 
 
+def context_shapes(data_source):
+    """Returns the (num_utterances, max_utterance_length) of the context of every sample with dims [n, 2].
+    Datasets that keep their own length index provide it with a context_shapes method, for the rest every sample
+    is read once.
+    """
+    if hasattr(data_source, "context_shapes"):
+        return np.asarray(data_source.context_shapes())
+    return np.asarray([np.shape(data_source[i][0]) for i in range(len(data_source))], dtype=np.int64).reshape(-1, 2)
+
+
 class DialogueSampler(Sampler):
     """Returns an iterator that traverse dialogue samples in order. Samples are ordered in descending order
        from longest conversation with largest utterances to shortest conversation with shortest utterances
@@ -10,12 +20,14 @@ class DialogueSampler(Sampler):
     def __init__(self, data_source):
         super().__init__(data_source=data_source)
         self.data_source = data_source
+        self.shapes = context_shapes(data_source)
 
     def sort(self, indeces, reverse=True):
-        sorted_by_sentence_length = sorted(indeces, key=lambda x: self.data_source[x][0].shape[1], reverse=reverse)
-        sorted_by_conv_length = sorted(sorted_by_sentence_length, key=lambda x: self.data_source[x][0].shape[0],
-                                       reverse=reverse)
-        return sorted_by_conv_length
+        indeces = np.asarray(indeces)
+        shapes = self.shapes[indeces]
+        sign = -1 if reverse else 1
+        # lexsort is stable and its last key is the primary one
+        return indeces[np.lexsort((sign * shapes[:, 1], sign * shapes[:, 0]))]
 
     def __len__(self): return len(self.data_source)
 
@@ -36,14 +48,22 @@ class DialogueRandomSampler(DialogueSampler):
         self.bs = bs
 
     def __iter__(self):
-        idxs = np.random.permutation(len(self.data_source))
-        sz = self.bs * self.BATCH_WINDOW
-        ck_idx = [idxs[i:i + sz] for i in range(0, len(idxs), sz)]
-        sort_idx = np.concatenate([self.sort(s) for s in ck_idx])
-        sz = self.bs
-        ck_idx = [sort_idx[i:i + sz] for i in range(0, len(sort_idx), sz)]
-        max_ck = np.argmax([ck[0] for ck in ck_idx])  # find the chunk with the largest key,
-        ck_idx[0], ck_idx[max_ck] = ck_idx[max_ck], ck_idx[0]  # then make sure it goes first.
-        sort_idx = np.concatenate(np.random.permutation(ck_idx[1:]))
-        sort_idx = np.concatenate((ck_idx[0], sort_idx))
-        return iter(sort_idx)
+        num_samples = len(self.data_source)
+        if num_samples == 0:
+            return iter([])
+        idxs = np.random.permutation(num_samples)
+        # sort all the windows at once, the window of every sample is the primary key
+        shapes = self.shapes[idxs]
+        windows = np.arange(num_samples) // (self.bs * self.BATCH_WINDOW)
+        sort_idx = idxs[np.lexsort((-shapes[:, 1], -shapes[:, 0], windows))]
+
+        # the first sample of every chunk of bs is its largest one
+        num_chunks = (num_samples + self.bs - 1) // self.bs
+        first_shapes = self.shapes[sort_idx[::self.bs]]
+        max_ck = np.lexsort((first_shapes[:, 1], first_shapes[:, 0]))[-1]  # find the chunk with the largest key,
+        others = np.delete(np.arange(num_chunks), max_ck)
+        chunks = np.concatenate(([max_ck], np.random.permutation(others)))  # then make sure it goes first.
+        starts = chunks * self.bs
+        lengths = np.minimum(starts + self.bs, num_samples) - starts
+        positions = np.arange(num_samples) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+        return iter(sort_idx[positions])
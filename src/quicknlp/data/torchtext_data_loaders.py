@@ -1,19 +1,21 @@
 from typing import List, Optional, Callable, Union
 
 from torch import cuda as cuda
-from torchtext.data import Dataset, BucketIterator
+from torchtext.data import Dataset
 
-from quicknlp.data.iterators import HierarchicalIterator, DialogueIterator
+from quicknlp.data.iterators import DialogueIterator, HierarchicalIterator, TokenBucketIterator
 
 
 class S2SDataLoader:
     """Instance of ModelLoader. It is an iterator that buckets the data in batches of similar sizes based on
        a sort_key and iterates through the batches.
 
+       If max_tokens is given the batches have up to max_tokens padded tokens (bs x sl) instead of
+       batch_size examples, so that short sentences go in large batches and long ones in small batches.
     """
 
     def __init__(self, dataset: Dataset, batch_size: int, source_names: List[str], target_names: List[str],
-                 sort_key: Optional[Callable] = None, **kwargs):
+                 sort_key: Optional[Callable] = None, max_tokens: Optional[int] = None, **kwargs):
         self.dataset = dataset
         self.source_names = source_names
         self.target_names = target_names
@@ -21,8 +23,14 @@ class S2SDataLoader:
         if sort_key is None:
             def sort_key(x):
                 return getattr(x, self.source_names[0])
+
+        def shape(x):
+            """the longest sequence of the example"""
+            return max(len(getattr(x, name)) for name in self.source_names + self.target_names),
+
         device = None if cuda.is_available() else -1
-        self.dl = BucketIterator(dataset, batch_size=batch_size, sort_key=sort_key, device=device, **kwargs)
+        self.dl = TokenBucketIterator(dataset, batch_size=batch_size, sort_key=sort_key, device=device,
+                                      max_tokens=max_tokens, shape=shape, **kwargs)
         self.bs = batch_size
         self.iter = 0
 
@@ -43,11 +51,15 @@ class S2SDataLoader:
 
 
 class HierarchicalDataLoader:
-    """Loads Hierarchical data into batches, including source and target"""
+    """Loads Hierarchical data into batches, including source and target
+
+    If max_tokens is given the batches have up to max_tokens padded tokens (bs x cl x sl) instead of
+    batch_size dialogues, and no context is skipped for being larger than max_context_size.
+    """
 
     def __init__(self, dataset: Dataset, batch_size: int, target_names: Optional[List[str]] = None,
-                 sort_key: Union[Callable, str] = "sl", max_context_size: int = 130000, backwards=False,
-                 **kwargs):
+                 sort_key: Union[Callable, str] = "sl", max_context_size: Optional[int] = 130000, backwards=False,
+                 max_tokens: Optional[int] = None, **kwargs):
         self.dataset = dataset
         target_names = [target_names] if isinstance(target_names, str) else target_names
         # sort by the first field if no sort key is given
@@ -61,8 +73,11 @@ class HierarchicalDataLoader:
                 return max(x.sl)
         else:
             assert callable(sort_key), "sort_key provided is not a function"
+        if max_tokens is not None:
+            # the batches are limited by their size, so no context has to be skipped
+            max_context_size = None
         self.dl = HierarchicalIterator(dataset, batch_size=batch_size, sort_key=sort_key, target_roles=target_names,
-                                       max_context_size=max_context_size, **kwargs)
+                                       max_context_size=max_context_size, max_tokens=max_tokens, **kwargs)
         self.bs = batch_size
         self.iter = 0
 
@@ -4,7 +4,7 @@ import torch
 import torch.nn as nn
 from fastai.core import V, to_gpu
 
-from quicknlp.utils import assert_dims, concat_bidir_state
+from quicknlp.utils import assert_dims, concat_bidir_state, get_lengths
 from .hred import HRED
 
 HParam = Union[List[int], int]
@@ -38,12 +38,14 @@ class CVAE(HRED):
             tie_decoder (bool): if True the encoder and the decoder share their embeddings
             bidir (bool): if True use a bidirectional encoder
             **kwargs: Extra embeddings that will be passed to the encoder and the decoder
+                e.g. adaptive_cutoffs (List[int]) the cutoffs of an AdaptiveProjection e.g. [2000, 10000] to use
+                instead of a full projection. An adaptive projection is not tied to the embeddings, so it needs
+                tie_decoder to be False, otherwise a ValueError is raised
         """
 
         super().__init__(ntoken=ntoken, emb_sz=emb_sz, nhid=nhid, nlayers=nlayers, pad_token=pad_token,
                          eos_token=eos_token, max_tokens=max_tokens, share_embedding_layer=share_embedding_layer,
-                         tie_decoder=tie_decoder, bidir=bidir
-                         )
+                         tie_decoder=tie_decoder, bidir=bidir, **kwargs)
         self.latent_dim = latent_dim
         self.recognition_network = nn.Linear(in_features=self.se_enc.output_size + self.query_encoder.output_size,
                                              out_features=latent_dim * 2)
@@ -77,9 +79,13 @@ class CVAE(HRED):
         query_encoder_outputs = self.query_level_encoding(encoder_inputs)
 
         outputs = self.se_enc(query_encoder_outputs)
-        session = self.se_enc.hidden[-1]
-        self.query_encoder.reset(bs)
-        decoder_outputs = self.query_encoder(decoder_inputs)
+        if decoder_inputs.dim() == 3:
+            session, decoder_inputs = self.dialogue_turns(outputs[-1], decoder_inputs)
+        else:
+            session = self.se_enc.hidden[-1]
+        self.query_encoder.reset(decoder_inputs.size(1))
+        lengths = get_lengths(decoder_inputs, self.decoder.pad_token) if self.pack_sequences else None
+        decoder_outputs = self.query_encoder(decoder_inputs, lengths=lengths)
         decoder_out = concat_bidir_state(self.query_encoder.encoder_layer.hidden[-1],
                                          cell_type=self.cell_type, nlayers=1,
                                          bidir=self.query_encoder.encoder_layer.bidir
@@ -98,6 +104,11 @@ class CVAE(HRED):
         else:
             return predictions, [*outputs, *outputs_dec]
 
+    def session_decoder_input(self, session_output):
+        # without a response to recognize the latent variable comes from the prior network
+        prior_mu, _ = torch.split(self.prior_network(session_output), self.latent_dim, dim=-1)
+        return torch.cat([session_output, prior_mu], dim=-1)
+
     def variational_encoding(self, session, x):
         recog_mu_log_var = self.recognition_network(x)
         recog_mu, recog_log_var = torch.split(recog_mu_log_var, self.latent_dim, dim=-1)
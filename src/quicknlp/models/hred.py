@@ -1,10 +1,10 @@
 from typing import List, Union
 
-import torch
 import torch.nn as nn
+from fastai.core import T, V, no_grad_context, to_np
 
-from quicknlp.modules import Decoder, DropoutEmbeddings, Encoder, Projection, RNNLayers
-from quicknlp.utils import assert_dims, get_kwarg, get_list, concat_bidir_state
+from quicknlp.modules import AdaptiveProjection, Decoder, DropoutEmbeddings, Encoder, Projection, RNNLayers
+from quicknlp.utils import assert_dims, get_kwarg, get_lengths, get_list, concat_bidir_state
 
 HParam = Union[List[int], int]
 
@@ -36,6 +36,9 @@ class HRED(nn.Module):
             bidir (bool): if True use a bidirectional encoder
             session_constraint (bool) If true the session will be concated as a constraint to the decoder input
             **kwargs: Extra embeddings that will be passed to the encoder and the decoder
+                e.g. adaptive_cutoffs (List[int]) the cutoffs of an AdaptiveProjection e.g. [2000, 10000] to use
+                instead of a full projection. An adaptive projection is not tied to the embeddings, so it needs
+                tie_decoder to be False, otherwise a ValueError is raised
         """
         super().__init__()
         # allow for the same or different parameters between encoder and decoder
@@ -56,6 +59,8 @@ class HRED(nn.Module):
         self.cell_type = "gru"
         self.nt = ntoken[-1]
         self.pr_force = 1.0
+        # pack the utterances so that the query encoder skips their padding, they have to be padded at the end
+        self.pack_sequences = get_kwarg(kwargs, name="pack_sequences", default_value=False)
 
         encoder_embedding_layer = DropoutEmbeddings(ntokens=ntoken[0],
                                                     emb_size=emb_sz[0],
@@ -111,9 +116,18 @@ class HRED(nn.Module):
         # allow for changing sizes of decoder output
         input_size = decoder_rnn.output_size
         nhid = emb_sz[1] if input_size != emb_sz[1] else None
-        projection_layer = Projection(output_size=ntoken[0], input_size=input_size, nhid=nhid, dropout=dropoutd,
-                                      tie_encoder=decoder_embedding_layer if tie_decoder else None
-                                      )
+        # the cutoffs of an adaptive softmax projection, e.g. [2000, 10000], None for a full projection
+        adaptive_cutoffs = get_kwarg(kwargs, name="adaptive_cutoffs", default_value=None)
+        if adaptive_cutoffs is not None and tie_decoder:
+            raise ValueError("an adaptive projection (adaptive_cutoffs) can not be tied to the embeddings, "
+                             "set tie_decoder to False")
+        if adaptive_cutoffs is not None:
+            projection_layer = AdaptiveProjection(output_size=ntoken[0], input_size=input_size, nhid=nhid,
+                                                  dropout=dropoutd, cutoffs=adaptive_cutoffs)
+        else:
+            projection_layer = Projection(output_size=ntoken[0], input_size=input_size, nhid=nhid, dropout=dropoutd,
+                                          tie_encoder=decoder_embedding_layer if tie_decoder else None
+                                          )
         self.decoder = Decoder(
             decoder_layer=decoder_rnn,
             projection_layer=projection_layer,
@@ -132,7 +146,10 @@ class HRED(nn.Module):
         self.reset_encoders(bs)
         query_encoder_outputs = self.query_level_encoding(encoder_inputs)
         outputs = self.se_enc(query_encoder_outputs)
-        last_output = self.se_enc.hidden[-1]
+        if decoder_inputs.dim() == 3:
+            last_output, decoder_inputs = self.dialogue_turns(outputs[-1], decoder_inputs)
+        else:
+            last_output = self.se_enc.hidden[-1]
         state = self.decoder.hidden
         # Tanh seems to deteriorate performance so not used
         state[0] = self.decoder_state_linear(last_output)  # .tanh()
@@ -140,6 +157,74 @@ class HRED(nn.Module):
         outputs_dec, predictions = self.decoding(decoder_inputs, num_beams, state, constraints=constraints)
         return predictions, [*outputs, *outputs_dec]
 
+    def dialogue_turns(self, session_outputs, decoder_inputs):
+        """Prepares the decoding of the responses of all the turns of the dialogues in parallel,
+        every response is decoded from the session output after its context turn. The responses that are
+        all padding, e.g. the turns of the roles that are not trained or the ones after the end of the shorter
+        dialogues, are not decoded (the same turns the HierarchicalIterator keeps the targets of)
+
+        Args:
+            session_outputs (Tensor): The session encoder outputs of every turn [cl, bs, nhid]
+            decoder_inputs (Tensor): The responses of every turn [cl, sl, bs]
+
+        Returns:
+            Tuple[Tensor, Tensor]: The session outputs [1, n, nhid] and the responses [sl, n]
+                of the n turns with a response
+        """
+        num_utterances, max_sl, bs = assert_dims(decoder_inputs, [session_outputs.size(0), None,
+                                                                  session_outputs.size(1)]).size()
+        session_outputs = session_outputs.contiguous().view(num_utterances * bs, -1)
+        decoder_inputs = decoder_inputs.permute(1, 0, 2).contiguous().view(max_sl, num_utterances * bs)
+        turns = ((decoder_inputs.data != self.decoder.pad_token).sum(dim=0) > 0).nonzero().view(-1)
+        self.decoder.reset(turns.numel())
+        return session_outputs.index_select(0, turns).unsqueeze(0), decoder_inputs.index_select(1, turns)
+
+    def encode_utterance(self, utterance, session=None):
+        """Advances the session of a live conversation by one utterance, without encoding the previous ones again
+
+        Args:
+            utterance (Tensor): The new utterance of every conversation [sl, bs]
+            session (Optional[Dict[str, List[np.ndarray]]]): The session state returned by the previous call,
+                None for new conversations
+
+        Returns:
+            Dict[str, List[np.ndarray]]: The new session state, i.e. the session encoder hidden state and
+                the encoding of the utterance, as numpy arrays so that it can be serialized
+        """
+        with no_grad_context():
+            if session is None:
+                self.se_enc.reset(utterance.size(1))
+            else:
+                self.se_enc.hidden = [V(T(hidden)) for hidden in session["session_hidden"]]
+            utterance_encoding = self.query_level_encoding(utterance.unsqueeze(0))  # [1, bs, nhid]
+            self.se_enc(utterance_encoding)
+            return dict(session_hidden=[to_np(hidden) for hidden in self.se_enc.hidden],
+                        utterance_encoding=[to_np(utterance_encoding)])
+
+    def decode_session(self, session, decoder_inputs, num_beams=1):
+        """Decodes the responses of live conversations from their session states
+
+        Args:
+            session (Dict[str, List[np.ndarray]]): The session state returned by encode_utterance
+            decoder_inputs (Tensor): The first token of the responses [1, bs]
+            num_beams (int): 1 for greedy search, more for beam search
+
+        Returns:
+            Tensor: The tokens of the responses [sl, bs, nb]
+        """
+        with no_grad_context():
+            last_output = V(T(session["session_hidden"][-1]))  # [1, bs, nhid]
+            self.decoder.reset(last_output.size(1))
+            state = self.decoder.hidden
+            state[0] = self.decoder_state_linear(self.session_decoder_input(last_output))
+            constraints = last_output if self.session_constraint else None
+            _, predictions = self.decoding(decoder_inputs, num_beams, state, constraints=constraints)
+        return predictions
+
+    def session_decoder_input(self, session_output):
+        """The input of the decoder initial state for the session output [1, bs, nhid] when decoding a session"""
+        return session_output
+
     def reset_encoders(self, bs):
         self.query_encoder.reset(bs)
         self.se_enc.reset(bs)
@@ -156,20 +241,20 @@ class HRED(nn.Module):
         return outputs_dec, predictions
 
     def query_level_encoding(self, encoder_inputs):
-        query_encoder_outputs = []
-        for index, context in enumerate(encoder_inputs):
-            self.query_encoder.reset(bs=encoder_inputs.size(2))
-            state = self.query_encoder.hidden
-            outputs = self.query_encoder(context, state)  # context has size [sl, bs]
-            out = concat_bidir_state(self.query_encoder.encoder_layer.hidden[-1],
-                                     cell_type=self.cell_type, nlayers=1,
-                                     bidir=self.query_encoder.encoder_layer.bidir
-                                     )
-            query_encoder_outputs.append(out)  # get the last sl output of the query_encoder
-            # BPTT if the dialogue is too long repackage the first half of the outputs to decrease
-            # the gradient backpropagation and fit it into memory
-            # out = repackage_var(outputs[-1][
-            #                        -1]) if max_sl * num_utterances > self.BPTT_MAX_UTTERANCES and index <= num_utterances // 2 else \
-            #    outputs[-1][-1]
-        query_encoder_outputs = torch.cat(query_encoder_outputs, dim=0)  # [cl, bs, nhid]
-        return query_encoder_outputs
+        """Encodes all the utterances of the contexts [cl, sl, bs] with one call of the query encoder
+
+        Returns:
+            Tensor: The last hidden state of the query encoder for every utterance [cl, bs, nhid]
+        """
+        num_utterances, max_sl, bs = encoder_inputs.size()
+        # the utterances become the batch of the query encoder [sl, cl x bs]
+        utterances = encoder_inputs.permute(1, 0, 2).contiguous().view(max_sl, num_utterances * bs)
+        self.query_encoder.reset(bs=num_utterances * bs)
+        state = self.query_encoder.hidden
+        lengths = get_lengths(utterances, self.decoder.pad_token) if self.pack_sequences else None
+        self.query_encoder(utterances, state, lengths=lengths)
+        out = concat_bidir_state(self.query_encoder.encoder_layer.hidden[-1],
+                                 cell_type=self.cell_type, nlayers=1,
+                                 bidir=self.query_encoder.encoder_layer.bidir
+                                 )  # [1, cl x bs, nhid]
+        return out.view(num_utterances, bs, -1)  # [cl, bs, nhid]
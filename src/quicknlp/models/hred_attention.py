@@ -51,6 +51,7 @@ class HREDAttention(nn.Module):
         dropouth = get_list(dropouth, 3)
         wdrop = get_kwarg(kwargs, name="wdrop", default_value=0.5)  # RNN weights dropout
         wdrop = get_list(wdrop, 3)
+        att_type = get_kwarg(kwargs, name="att_type", default_value="SDP")  # attention type, SDP or MLP
         self.cell_type = "gru"
         self.nt = ntoken[-1]
         self.pr_force = 1.0
@@ -99,7 +100,7 @@ class HREDAttention(nn.Module):
                                                input_size=emb_sz[-1],
                                                dropout=dropoutd,
                                                att_nhid=att_nhid,
-                                               att_type="SDP",
+                                               att_type=att_type,
                                                tie_encoder=decoder_embedding_layer if tie_decoder else None
                                                )
         self.decoder = AttentionDecoder(
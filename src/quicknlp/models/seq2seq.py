@@ -1,8 +1,8 @@
 import torch.nn as nn
 
-from quicknlp.modules import Projection, RNNLayers, Decoder, Encoder
+from quicknlp.modules import AdaptiveProjection, Projection, RNNLayers, Decoder, Encoder
 from quicknlp.modules.embeddings import DropoutEmbeddings
-from quicknlp.utils import HParam, assert_dims, concat_bidir_state, get_kwarg, get_list
+from quicknlp.utils import HParam, assert_dims, concat_bidir_state, get_kwarg, get_lengths, get_list
 
 
 class Seq2Seq(nn.Module):
@@ -25,6 +25,9 @@ class Seq2Seq(nn.Module):
             tie_decoder (bool): if True the encoder and the decoder share their embeddings
             bidir (bool): if True use a bidirectional encoder
             **kwargs: Extra embeddings that will be passed to the encoder and the decoder
+                e.g. adaptive_cutoffs (List[int]) the cutoffs of an AdaptiveProjection e.g. [2000, 10000] to use
+                instead of a full projection. An adaptive projection is not tied to the embeddings, so it needs
+                tie_decoder to be False, otherwise a ValueError is raised
         """
         super().__init__()
         # allow for the same or different parameters between encoder and decoder
@@ -49,6 +52,8 @@ class Seq2Seq(nn.Module):
         self.nlayers = nlayers[0]
         self.nt = ntoken[-1]  # number of possible tokens
         self.pr_force = 1.0  # teacher forcing probability
+        # pack the encoder inputs so that the encoder skips their padding, they have to be padded at the end
+        self.pack_sequences = get_kwarg(kwargs, name="pack_sequences", default_value=False)
 
         encoder_rnn = RNNLayers(input_size=emb_sz[0],
                                 output_size=kwargs.get("out_dim", emb_sz[0]),
@@ -77,9 +82,18 @@ class Seq2Seq(nn.Module):
                                 nhid=nhid[-1], bidir=False, dropouth=dropouth[1],
                                 wdrop=wdrop[1], nlayers=nlayers[-1], cell_type=self.cell_type)
 
-        projection_layer = Projection(output_size=ntoken[-1], input_size=emb_sz[-1], dropout=dropoutd,
-                                      tie_encoder=decoder_embedding_layer if tie_decoder else None
-                                      )
+        # the cutoffs of an adaptive softmax projection, e.g. [2000, 10000], None for a full projection
+        adaptive_cutoffs = get_kwarg(kwargs, name="adaptive_cutoffs", default_value=None)
+        if adaptive_cutoffs is not None and tie_decoder:
+            raise ValueError("an adaptive projection (adaptive_cutoffs) can not be tied to the embeddings, "
+                             "set tie_decoder to False")
+        if adaptive_cutoffs is not None:
+            projection_layer = AdaptiveProjection(output_size=ntoken[-1], input_size=emb_sz[-1], dropout=dropoutd,
+                                                  cutoffs=adaptive_cutoffs)
+        else:
+            projection_layer = Projection(output_size=ntoken[-1], input_size=emb_sz[-1], dropout=dropoutd,
+                                          tie_encoder=decoder_embedding_layer if tie_decoder else None
+                                          )
         self.decoder = Decoder(
             decoder_layer=decoder_rnn,
             projection_layer=projection_layer,
@@ -95,7 +109,8 @@ class Seq2Seq(nn.Module):
         bs = encoder_inputs.size(1)
         self.encoder.reset(bs)
         self.decoder.reset(bs)
-        outputs = self.encoder(encoder_inputs)
+        lengths = get_lengths(encoder_inputs, self.decoder.pad_token) if self.pack_sequences else None
+        outputs = self.encoder(encoder_inputs, lengths=lengths)
         state = concat_bidir_state(self.encoder.encoder_layer.hidden, cell_type=self.cell_type, nlayers=self.nlayers,
                                    bidir=self.bidir
                                    )
@@ -2,6 +2,6 @@ from .attention_decoder import AttentionDecoder
 from .basic_decoder import Decoder, TransformerDecoder
 from .basic_encoder import Encoder
 from .embeddings import DropoutEmbeddings, TransformerEmbeddings
-from .projection import AttentionProjection, Projection
+from .projection import AdaptiveProjection, AttentionProjection, Projection
 from .rnn_encoder import RNNLayers
 from .transformer import TransformerDecoderLayers, TransformerEncoderLayers
@@ -23,16 +23,26 @@ class MLPAttention(nn.Module):
         self.linear1 = nn.Linear(in_features=n_in, out_features=nhid, bias=False)
         self.linear2 = nn.Linear(in_features=nhid, out_features=1, bias=False)
 
-    def forward(self, query, keys, values):
-        # Query dim [bs, dimQ]
+    def project_keys(self, keys):
+        """The keys part of linear1, it does not depend on the query so it can be computed once for all the queries"""
+        return F.linear(keys, self.linear1.weight[:, -keys.size(-1):])  # [sl, bs, nhid]
+
+    def forward(self, query, keys, values, keys_projection=None):
+        # Query dim [bs, dimQ] or [bs x nb, dimQ] when the nb beams of every batch row share its keys
         # keys dim [sl, bs, dimK]
         # values dim [sl, bs, dimV]
-        inputs = tr.cat([query.unsqueeze(0).repeat(keys.size(0), 1, 1), keys], dim=-1)
-        scores = self.linear2(F.tanh((self.linear1(inputs))))  # [sl,bs, 1]
-        scores = F.softmax(scores, dim=0)  # [sl,bs, 1]
+        # keys_projection dim [sl, bs, nhid]
+        if keys_projection is None:
+            keys_projection = self.project_keys(keys)
+        sl, bs, _ = keys_projection.size()
+        # linear1 over the concatenated query and keys equals the sum of their separate projections
+        query_projection = F.linear(query, self.linear1.weight[:, :query.size(-1)])  # [bs x nb, nhid]
+        query_projection = query_projection.view(1, bs, -1, query_projection.size(-1))  # [1, bs, nb, nhid]
+        scores = self.linear2(F.tanh(query_projection + keys_projection.unsqueeze(2)))  # [sl, bs, nb, 1]
+        scores = F.softmax(scores, dim=0)  # [sl, bs, nb, 1]
         if self.dropout is not None:
-            scores = self.dropout(scores)
-        return (scores * values).sum(dim=0)  # [bs, dimV]
+            scores = self.dropout(scores.view(sl, -1, 1)).view_as(scores)
+        return (scores * values.unsqueeze(2)).sum(dim=0).view(query.size(0), -1)  # [bs x nb, dimV]
 
 
 class SDPAttention(nn.Module):
@@ -43,16 +53,24 @@ class SDPAttention(nn.Module):
         self.dropout = LockedDropout(p) if p > 0.0 else None
         self.scale = np.sqrt(n_in)
 
-    def forward(self, query, keys, values):
-        # Query dim [bs, dimQ]
+    def project_keys(self, keys):
+        """The scaled keys, they do not depend on the query so they can be computed once for all the queries"""
+        return keys / self.scale
+
+    def forward(self, query, keys, values, keys_projection=None):
+        # Query dim [bs, dimQ] or [bs x nb, dimQ] when the nb beams of every batch row share its keys
         # keys dim [sl, bs, dimK]
         # values dim [sl, bs, dimV]
-        dot = (query * keys).sum(dim=-1) / self.scale
+        # keys_projection dim [sl, bs, dimK]
+        if keys_projection is None:
+            keys_projection = self.project_keys(keys)
+        sl, bs, _ = keys_projection.size()
+        dot = (query.view(1, bs, -1, query.size(-1)) * keys_projection.unsqueeze(2)).sum(dim=-1)  # [sl, bs, nb]
         # dot = (query @ keys) / self.scale
-        weights = F.softmax(dot, dim=0).unsqueeze(-1)
+        weights = F.softmax(dot, dim=0).unsqueeze(-1)  # [sl, bs, nb, 1]
         if self.dropout is not None:
-            weights = self.dropout(weights)
-        return (weights * values).sum(0)
+            weights = self.dropout(weights.view(sl, -1, 1)).view_as(weights)
+        return (weights * values.unsqueeze(2)).sum(0).view(query.size(0), -1)  # [bs x nb, dimV]
 
 
 class MultiHeadAttention(nn.Module):
@@ -71,25 +89,70 @@ class MultiHeadAttention(nn.Module):
         self.linear = nn.Linear(in_features=self.linear_out_dim, out_features=self.out_dim, bias=False)
 
     def forward(self, query, keys, values, mask=None):
-        # Query dim [bs, dimQ]
+        # Query dim [bs, dimQ] or [slq, bs, dimQ]
         # keys dim [sl, bs, dimK]
         # values dim [sl, bs, dimV]
+        keys_projection, values_projection = self.project_keys_values(keys=keys, values=values)
+        return self.attend(query=query, keys_projection=keys_projection, values_projection=values_projection,
+                           mask=mask)
 
-        # [bs, dimH *NH]
-        query_projection = self.query_linear(query)
-        sl, bs, dimK = keys.size()
+    def project_keys_values(self, keys, values):
+        """Projects the keys and values, so that the projections can be reused by every query attending them"""
         # [sl, bs, dimH *NH]
-        keys_projection = self.keys_linear(keys)
-        # [sl, bs, dimH *NH]
-        values_projection = self.values_linear(values)
+        return self.keys_linear(keys), self.values_linear(values)
+
+    def attend(self, query, keys_projection, values_projection, mask=None):
+        """Attention of the queries over the projected keys and values
 
-        scores = (query_projection * keys_projection).view(sl, bs, self.num_heads, self.nhid).sum(
-            dim=-1).contiguous() / self.scale
+        The query can have nb rows for every batch row of the keys, e.g. the beams of a beam search,
+        then all the nb rows attend to the keys of their batch row without copying them.
+
+        Args:
+            query (Tensor): A single query step with dims [bs, dimQ] or many query steps with dims [slq, bs, dimQ]
+            keys_projection (Tensor): The projected keys with dims [sl, bs, dimH *NH]
+            values_projection (Tensor): The projected values with dims [sl, bs, dimH *NH]
+            mask (Optional[Tensor]): Which keys every query can attend to (1) or not (0).
+                With dims [sl, bs, NH] for a single query step or dims [slq, sl] for many query steps
+
+        Returns:
+            Tensor: The attention outputs with dims [bs, out_dim] or [slq, bs, out_dim]
+        """
+        single_step = query.dim() == 2
+        if single_step:
+            query = query.unsqueeze(0)
+            if mask is not None:
+                mask = mask.permute(1, 2, 0).unsqueeze(2)  # [bs, NH, 1, sl]
+        slq, rows, _ = query.size()
+        sl, bs, _ = keys_projection.size()
+        num_beams = rows // bs
+        if num_beams > 1:
+            # the beams become extra query steps of their batch row [nb x slq, bs, dimQ]
+            query = query.view(slq, bs, num_beams, -1).permute(2, 0, 1, 3).contiguous().view(num_beams * slq, bs, -1)
+            if mask is not None and single_step:
+                mask = mask.contiguous().view(bs, num_beams, self.num_heads, sl).transpose(1, 2)  # [bs, NH, nb, sl]
+            elif mask is not None:
+                mask = mask.repeat(num_beams, 1)  # [nb x slq, sl]
+        # [bs, NH, nb x slq, dimH]
+        query_projection = self.query_linear(query).view(-1, bs, self.num_heads, self.nhid).permute(1, 2, 0, 3)
+        # [bs, NH, dimH, sl]
+        keys_projection = keys_projection.view(sl, bs, self.num_heads, self.nhid).permute(1, 2, 3, 0)
+        # [bs, NH, sl, dimH]
+        values_projection = values_projection.view(sl, bs, self.num_heads, self.nhid).permute(1, 2, 0, 3)
+
+        scores = tr.matmul(query_projection, keys_projection) / self.scale  # [bs, NH, nb x slq, sl]
         if mask is not None:
-            scores = scores.masked_fill(mask == 0, -1e20)
-        weights = F.softmax(scores, dim=0)
+            scores = scores.masked_fill(mask.expand_as(scores) == 0, -1e20)
+        weights = F.softmax(scores, dim=-1)
         if self.dropout is not None:
-            weights = self.dropout(weights)
-        attention = (weights.unsqueeze(-1) * values_projection.view(sl, bs, self.num_heads, self.nhid)).sum(0)
-        output = self.linear(attention.view(bs, -1))
-        return assert_dims(output, [bs, self.out_dim])
+            # a locked dropout mask over the keys for every query and head
+            weights = self.dropout(weights.permute(3, 0, 1, 2).contiguous().view(sl, bs * self.num_heads, -1))
+            weights = weights.view(sl, bs, self.num_heads, -1).permute(1, 2, 3, 0)
+        attention = tr.matmul(weights, values_projection)  # [bs, NH, nb x slq, dimH]
+        output = self.linear(attention.permute(2, 0, 1, 3).contiguous().view(-1, bs, self.linear_out_dim))
+        if num_beams > 1:
+            # [nb x slq, bs, out_dim] -> [slq, bs x nb, out_dim]
+            output = output.view(num_beams, slq, bs, self.out_dim).permute(1, 2, 0, 3).contiguous()
+            output = output.view(slq, rows, self.out_dim)
+        if single_step:
+            return assert_dims(output[0], [rows, self.out_dim])
+        return assert_dims(output, [slq, rows, self.out_dim])
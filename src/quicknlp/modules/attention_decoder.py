@@ -7,8 +7,15 @@ from .basic_decoder import Decoder
 
 
 class AttentionDecoder(Decoder):
+    # the attention output of every step depends on the projection of the previous one
+    SUPPORTS_DEFERRED_PROJECTION = False
 
-    def _train_forward(self, inputs, hidden=None, constraints=None):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # the attention output of every step is fed to the next one, so scheduled sampling decodes step by step
+        self.parallel_sampling = False
+
+    def _train_forward(self, inputs, hidden=None, constraints=None, project=True):
         sl, bs = inputs.size()
         emb = self.embedding_layer(inputs)
         layer_outputs = [[] for _ in range(self.nlayers)]
@@ -23,11 +30,15 @@ class AttentionDecoder(Decoder):
         outputs = [torch.cat(i, dim=0) for i in layer_outputs]
         return outputs
 
-    def _beam_forward(self, inputs, hidden, num_beams, constraints=None):
-        # ensure keys exist for all beams
-        if self.projection_layer.keys is not None and num_beams > 0:
-            self.projection_layer.keys = self.projection_layer.keys.repeat(1, num_beams, 1)
-        return super()._beam_forward(inputs, hidden=hidden, num_beams=num_beams)
+    def select_hidden(self, indices):
+        super().select_hidden(indices)
+        # the attention output is fed to the next step, so it has to follow the hidden state
+        self.projection_layer.select_attention_output(indices)
+
+    def select_rows(self, indices, constraints=None, batch_indices=None):
+        # the beams of a batch row share its keys
+        self.projection_layer.select_keys(indices if batch_indices is None else batch_indices)
+        return super().select_rows(indices, constraints=constraints, batch_indices=batch_indices)
 
     def _rnn_step(self, output, hidden):
         new_hidden, outputs = [], []
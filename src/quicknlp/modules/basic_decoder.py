@@ -1,18 +1,30 @@
+import contextlib
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from fastai.core import V, to_gpu
+from fastai.core import V, no_grad_context, to_gpu
 
 from quicknlp.utils import assert_dims, RandomUniform
 
 
+def expand_beams(values, num_beams):
+    """Repeats every batch row (dim 1) of values num_beams times, the beams of a batch row are next to each other
+    following the layout of the beam rows [bs x nb] (see reshape_parent_indices)
+    """
+    shape = list(values.size())
+    expanded = values.unsqueeze(2).expand(*shape[:2], num_beams, *shape[2:])
+    shape[1] *= num_beams
+    return expanded.contiguous().view(*shape)
+
+
 def repeat_cell_state(hidden, num_beams):
     results = []
     for row in hidden:
         if isinstance(row, (list, tuple)):
-            state = (row[0].repeat(1, num_beams, 1), row[1].repeat(1, num_beams, 1))
+            state = (expand_beams(row[0], num_beams), expand_beams(row[1], num_beams))
         else:
-            state = row.repeat(1, num_beams, 1)
+            state = expand_beams(row, num_beams)
         results.append(state)
     return results
 
@@ -22,21 +34,76 @@ def reshape_parent_indices(indices, bs, num_beams):
     return indices + parent_indices
 
 
-def select_hidden_by_index(hidden, indices):
+def beam_rows(indices, num_beams):
+    """The rows of all the beams of the batch rows in indices"""
+    return (indices.unsqueeze(1) * num_beams + to_gpu(torch.arange(0, num_beams).long())).view(-1)
+
+
+def scatter_rows(values, rows, size, fill_value=0):
+    """Places the values [sl, len(rows), ...] in the rows of a [sl, size, ...] tensor filled with fill_value"""
+    shape = list(values.size())
+    shape[1] = size
+    result = values.data.new(*shape).fill_(fill_value)
+    result.index_copy_(1, rows, values.data)
+    return V(result)
+
+
+def backtrack(tokens, parents):
+    """Reconstructs the sequences of the final rows following their back-pointers
+
+    Args:
+        tokens (Tensor): The tokens decoded in every step [sl, rows]
+        parents (Tensor): The row every row continued from in every step [sl - 1, rows]
+
+    Returns:
+        Tensor: The sequences ending in every row [sl, rows]
+    """
+    outputs = tokens.new(*tokens.size())
+    rows = to_gpu(torch.arange(0, tokens.size(1)).long())
+    for step in range(tokens.size(0) - 1, 0, -1):
+        outputs[step] = tokens[step].index_select(0, rows)
+        rows = parents[step - 1].index_select(0, rows)
+    outputs[0] = tokens[0].index_select(0, rows)
+    return outputs
+
+
+def gather_rows(values, indices, out=None):
+    """Selects the rows (dim 1) in indices, into out if it is given and it is not the values themselves"""
+    if out is None or out.data_ptr() == values.data_ptr():
+        return torch.index_select(values, 1, indices)
+    return torch.index_select(values, 1, indices, out=out)
+
+
+def select_hidden_by_index(hidden, indices, out=None):
+    """Selects the rows in indices of every state in hidden
+
+    Args:
+        hidden (List[Union[Tensor, Tuple[Tensor, Tensor]]]): The states of every layer [nl, rows, dim]
+        indices (Tensor): The rows to select
+        out (Optional[List[Union[Tensor, Tuple[Tensor, Tensor]]]]): Buffers with the same structure as hidden
+            to select the states into, so that no new states are allocated. Only usable without gradients
+
+    Returns:
+        The selected states
+    """
     if hidden is None:
         return hidden
+    out = [None] * len(hidden) if out is None else out
     results = []
-    for row in hidden:
+    for row, buffers in zip(hidden, out):
         if isinstance(row, (list, tuple)):
-            state = (torch.index_select(row[0], 1, indices), torch.index_select(row[1], 1, indices))
+            buffers = (None, None) if buffers is None else buffers
+            state = (gather_rows(row[0], indices, out=buffers[0]), gather_rows(row[1], indices, out=buffers[1]))
         else:
-            state = torch.index_select(row, 1, indices)
+            state = gather_rows(row, indices, out=buffers)
         results.append(state)
     return results
 
 
 class Decoder(nn.Module):
     MAX_STEPS_ALLOWED = 320
+    # the teacher forced passes can leave their outputs unprojected (see deferred_projection)
+    SUPPORTS_DEFERRED_PROJECTION = True
 
     def __init__(self, decoder_layer, projection_layer, max_tokens, eos_token, pad_token,
                  embedding_layer: torch.nn.Module):
@@ -53,23 +120,82 @@ class Decoder(nn.Module):
         self.emb_size = embedding_layer.emb_size
         self.pr_force = 0.0
         self.random = RandomUniform()
+        # scheduled sampling during training mixes the predictions of a teacher forced pass into a second one,
+        # instead of decoding one step at a time
+        self.parallel_sampling = True
+        # a decoding mode that removes the rows that have finished decoding from the batch in greedy and beam search,
+        # the finished rows then get zero layer outputs instead of the outputs of their eos steps
+        self.compact_finished = False
+        # greedy and beam search return only the tokens and their scores, not the outputs of every layer
+        self.inference = False
+        # the states selected in the previous step, reused to select the states of the next one without gradients
+        self._hidden_buffers = None
+        # in training the teacher forced outputs are not projected, the loss is computed from the inputs of the
+        # projection layer by its loss method
+        self.deferred_projection = False
+
+    @property
+    def parallel_sampling(self):
+        return self._parallel_sampling
+
+    @parallel_sampling.setter
+    def parallel_sampling(self, value):
+        if not value and getattr(self, "_deferred_projection", False):
+            raise ValueError("deferred_projection needs parallel_sampling, the step by step scheduled sampling "
+                             "projects the outputs of every step")
+        self._parallel_sampling = value
+
+    @property
+    def deferred_projection(self):
+        return self._deferred_projection
+
+    @deferred_projection.setter
+    def deferred_projection(self, value):
+        if value and not self.SUPPORTS_DEFERRED_PROJECTION:
+            raise ValueError(f"{self.__class__.__name__} can not use deferred_projection")
+        if value and not self.parallel_sampling:
+            raise ValueError("deferred_projection needs parallel_sampling, the step by step scheduled sampling "
+                             "projects the outputs of every step")
+        self._deferred_projection = value
 
     def reset(self, bs):
         self.decoder_layer.reset(bs)
 
-    def forward(self, inputs, hidden=None, num_beams=0, constraints=None):
+    def forward(self, inputs, hidden=None, num_beams=0, constraints=None, inference=None):
+        """
+
+        Args:
+            inputs (Tensor): The decoder inputs [sl, bs], only the first step is used in greedy and beam search
+            hidden (Optional[List[Tensor]]): The initial decoder state
+            num_beams (int): 0 for teacher forcing, 1 for greedy search and more than 1 for beam search
+            constraints (Optional[Tensor]): Constraints concatenated to the inputs of every step [1, bs, dim]
+            inference (Optional[bool]): If True greedy and beam search run without gradients and return only
+                the tokens [sl, bs, nb] and the log probabilities of the decoded sequences [bs, nb],
+                the outputs of the layers are not kept. If None self.inference is used
+
+        Returns:
+            List[Tensor]: The outputs of every layer [nlayers, sl, bs, dim] or the tokens and their scores.
+                With deferred_projection in training the last output is the input of the projection layer
+        """
         self.bs = inputs.size(1)
+        inference = self.inference if inference is None else inference
         if num_beams == 0:  # zero beams, a.k.a. teacher forcing
-            return self._train_forward(inputs, hidden, constraints)
-        elif num_beams == 1:  # one beam  a.k.a. greedy search
-            return self._greedy_forward(inputs, hidden, constraints)
-        elif num_beams > 1:  # multiple beams a.k.a topk search
-            return self._beam_forward(inputs, hidden, num_beams, constraints)
+            return self._train_forward(inputs, hidden, constraints, project=not self.defer_projection)
+        with no_grad_context() if inference else contextlib.suppress():
+            if num_beams == 1:  # one beam  a.k.a. greedy search
+                return self._greedy_forward(inputs, hidden, constraints, inference=inference)
+            elif num_beams > 1:  # multiple beams a.k.a topk search
+                return self._beam_forward(inputs, hidden, num_beams, constraints, inference=inference)
 
-    def _beam_forward(self, inputs, hidden, num_beams, constraints=None):
-        return self._topk_forward(inputs, hidden, num_beams, constraints)
+    def _beam_forward(self, inputs, hidden, num_beams, constraints=None, inference=False):
+        return self._topk_forward(inputs, hidden, num_beams, constraints, inference=inference)
 
-    def _train_forward(self, inputs, hidden=None, constraints=None):
+    @property
+    def defer_projection(self):
+        """True if the outputs of the training passes are left unprojected for the loss"""
+        return self.training and self.deferred_projection
+
+    def _train_forward(self, inputs, hidden=None, constraints=None, project=True):
         inputs = self.embedding_layer(inputs)
         if constraints is not None:
             # constraint should have dim [1, bs, hd]
@@ -78,105 +204,249 @@ class Decoder(nn.Module):
         # outputs are the outputs of every layer
         outputs = self.decoder_layer(inputs, hidden)
         # we project only the output of the last layer
-        if self.projection_layer is not None:
+        if self.projection_layer is not None and project:
             outputs[-1] = self.projection_layer(outputs[-1])
         return outputs
 
-    def _greedy_forward(self, inputs, hidden=None, constraints=None):
+    def _scheduled_sampling_forward(self, inputs, hidden=None, constraints=None):
+        """Scheduled sampling with two parallel teacher forced passes
+
+        The first pass predicts every step given the target tokens before it. For the second pass every target token
+        after the first is replaced by the prediction of the previous step with probability 1 - pr_force.
+        """
+        hidden = self.decoder_layer.hidden if hidden is None else hidden
+        with no_grad_context():
+            outputs = self._train_forward(inputs, hidden, constraints)
+        predictions = outputs[-1].data.max(dim=-1)[1]  # [sl, bs]
+        sampled = to_gpu(torch.rand(*inputs.size())) >= self.pr_force
+        sampled[0] = 0
+        mixed_inputs = inputs.data.clone()
+        mixed_inputs[1:] = torch.where(sampled[1:], predictions[:-1], inputs.data[1:])
+        outputs = self._train_forward(V(mixed_inputs), hidden, constraints, project=not self.defer_projection)
+        if not self.defer_projection:
+            # the first token followed by the predictions of every step, as in greedy search
+            tokens = torch.cat([inputs.data[:1], outputs[-1].data.max(dim=-1)[1]], dim=0)
+            self.beam_outputs = V(tokens).view(-1, inputs.size(1), 1)
+        return outputs
+
+    def _greedy_forward(self, inputs, hidden=None, constraints=None, inference=False):
+        if self.training and self.parallel_sampling:
+            return self._scheduled_sampling_forward(inputs, hidden, constraints)
         dec_inputs = inputs
         max_iterations = min(dec_inputs.size(0), self.MAX_STEPS_ALLOWED) if self.training else self.max_iterations
         inputs = V(inputs[:1].data)  # inputs should be only first token initially [1,bs]
         sl, bs = inputs.size()
         finished = to_gpu(torch.zeros(bs).byte())
         iteration = 0
-        self.beam_outputs = inputs.clone()
+        # the decoded tokens of every step
+        tokens = inputs.data.new(max_iterations + 1, bs).fill_(self.pad_token)
+        tokens[0] = inputs.data[0]
+        scores = to_gpu(torch.zeros(bs))
         layer_outputs = [[] for _ in range(self.nlayers)]
+        self._hidden_buffers = None
+        compact = self.compact_finished and not self.training
+        # the batch rows that are still decoding and the ones that were decoding in every step
+        active = to_gpu(torch.arange(0, bs).long())
+        step_rows = []
         while not finished.all() and iteration < max_iterations:
             # output should be List[[sl, bs, layer_dim], ...] sl should be one
             if 0 < iteration and self.training and 0. < self.random() < self.pr_force:
                 inputs = dec_inputs[iteration].unsqueeze(0)
-            output = self.forward(inputs, hidden=hidden, num_beams=0, constraints=constraints)
+            output = self._train_forward(inputs, hidden=hidden, constraints=constraints)
             hidden = self.decoder_layer.hidden
-            for layer_index in range(self.nlayers):
-                layer_outputs[layer_index].append(output[layer_index])
+            if inference:
+                # the log probability of the decoded tokens, finished rows are not scored anymore
+                step_scores = F.log_softmax(output[-1], dim=-1).data.max(dim=-1)[0].view(-1)
+                scores.index_add_(0, active, step_scores if compact else step_scores * (finished == 0).float())
+            else:
+                for layer_index in range(self.nlayers):
+                    layer_outputs[layer_index].append(output[layer_index])
+            step_rows.append(active)
 
             #  inputs are the indices  dims [1,bs] # repackage the var to avoid grad backwards
-            inputs = assert_dims(V(output[-1].data.max(dim=-1)[1]), [1, bs])
+            inputs = assert_dims(V(output[-1].data.max(dim=-1)[1]), [1, active.size(0)])
             iteration += 1
-            self.beam_outputs = assert_dims(torch.cat([self.beam_outputs, inputs], dim=0), [iteration + 1, bs])
-            new_finished = inputs.data == self.eos_token
-            finished = finished | new_finished
+            tokens[iteration].index_copy_(0, active, inputs.data[0])
+            new_finished = inputs.data.view(-1) == self.eos_token
+            if compact:
+                if new_finished.any():
+                    # remove the finished rows from the batch
+                    finished.index_fill_(0, active.masked_select(new_finished), 1)
+                    if not finished.all():
+                        keep = (new_finished == 0).nonzero().view(-1)
+                        active = active.index_select(0, keep)
+                        inputs = torch.index_select(inputs, 1, V(keep))
+                        constraints = self.select_rows(V(keep), constraints=constraints)
+                        hidden = self.decoder_layer.hidden
+            else:
+                finished = finished | new_finished
             # stop if the output is to big to fit in memory
 
-        self.beam_outputs = self.beam_outputs.view(-1, bs, 1)
+        self.beam_outputs = V(tokens[:iteration + 1]).view(-1, bs, 1)
+        if inference:
+            return [self.beam_outputs, V(scores).view(bs, 1)]
         # ensure the outputs are a list of layers where each layer is [sl,bs,layerdim]
-        outputs = [torch.cat(i, dim=0) for i in layer_outputs]
+        if compact:
+            outputs = [torch.cat([scatter_rows(output, rows, size=bs) for output, rows in zip(i, step_rows)], dim=0)
+                       for i in layer_outputs]
+        else:
+            outputs = [torch.cat(i, dim=0) for i in layer_outputs]
         return outputs
 
-    def _topk_forward(self, inputs, hidden, num_beams, constraints=None):
+    def _topk_forward(self, inputs, hidden, num_beams, constraints=None, inference=False):
         sl, bs = inputs.size()
         # initial logprobs should be zero (pr of <sos> token in the start is 1)
         logprobs = torch.zeros_like(inputs[:1]).view(1, bs, 1).float()  # shape will be [sl, bs, 1]
-        inputs = inputs[:1].repeat(1, num_beams)  # inputs should be only first token initially [1,bs x num_beams]
+        inputs = expand_beams(inputs[:1], num_beams)  # inputs should be only first token initially [1,bs x num_beams]
         finished = to_gpu(torch.zeros(bs * num_beams).byte())
         iteration = 0
         layer_outputs = [[] for _ in range(self.nlayers)]
-        self.beam_outputs = inputs.clone()
+        # the decoded tokens of every step and the parent row each beam continued from
+        tokens, parents = self.beam_buffers(inputs.data[0], self.max_iterations)
+        scores = to_gpu(torch.zeros(bs, num_beams))
+        self._hidden_buffers = None
         hidden = repeat_cell_state(hidden, num_beams)
+        if constraints is not None:
+            constraints = expand_beams(constraints, num_beams)
+        compact = self.compact_finished and not self.training
+        # the batch rows that are still decoding and the beam rows that were decoding in every step
+        active = to_gpu(torch.arange(0, bs).long())
+        step_rows = []
         while not finished.all() and iteration < self.max_iterations:
             # output should be List[[sl, bs * num_beams, layer_dim], ...] sl should be one
-            output = self.forward(inputs, hidden=hidden, num_beams=0, constraints=constraints)
-            hidden = self.decoder_layer.hidden
-            for layer_index in range(self.nlayers):
-                layer_outputs[layer_index].append(output[layer_index])
+            num_active = active.size(0)
+            rows = beam_rows(active, num_beams)
+            output = self._train_forward(inputs, hidden=hidden, constraints=constraints)
+            if not inference:
+                for layer_index in range(self.nlayers):
+                    layer_outputs[layer_index].append(output[layer_index])
+            step_rows.append(rows)
 
             # we take the output of the last layer with dims [1, bs, output_dim]
             # and get the indices of th top k for every bs
             new_logprobs = F.log_softmax(output[-1], dim=-1)  # [1, bs x num_beams, nt]
-            num_tokens = new_logprobs.size(2)
-            new_logprobs = new_logprobs.view(1, bs, num_beams, num_tokens) + logprobs.unsqueeze(-1)  # [1, bs, nb, nt]
-            # mask logprogs accordingly
-            new_logprobs = self.mask_logprobs(bs, finished, iteration, logprobs, new_logprobs, num_beams, num_tokens)
-
             # TODO implement stochastic beam search
             # get the top logprobs and their indices
-            logprobs, beams = torch.topk(new_logprobs, k=num_beams, dim=-1)  # [1, bs, num_beams]
-            parents = beams / num_tokens
-            inputs = beams % num_tokens
-            parent_indices = reshape_parent_indices(parents.view(-1), bs=bs, num_beams=num_beams)
-            self.decoder_layer.hidden = select_hidden_by_index(self.decoder_layer.hidden, indices=parent_indices)
+            logprobs, parent_beams, inputs = self.topk_beams(new_logprobs, logprobs, finished, iteration, num_beams)
+            parent_indices = reshape_parent_indices(parent_beams.view(-1), bs=num_active, num_beams=num_beams)
+            # the decoding state of every beam follows its parent
+            self.select_hidden(parent_indices)
+            hidden = self.decoder_layer.hidden
             finished = torch.index_select(finished, 0, parent_indices.data)
             inputs = inputs.view(1, -1).contiguous()
 
-            self.beam_outputs = torch.index_select(self.beam_outputs, dim=1, index=parent_indices)
-            self.beam_outputs = torch.cat([self.beam_outputs, inputs], dim=0)
+            parents[iteration].index_copy_(0, rows, rows.index_select(0, parent_indices.data))
+            tokens[iteration + 1].index_copy_(0, rows, inputs.data[0])
             new_finished = (inputs.data == self.eos_token).view(-1)
             finished = finished | new_finished
             iteration += 1
-
+            if inference:
+                scores.index_copy_(0, active, logprobs.data.view(num_active, num_beams))
+            if compact:
+                # remove the batch rows where all the beams have finished
+                done = finished.view(num_active, num_beams).long().sum(dim=1) == num_beams
+                if done.any() and not done.all():
+                    keep = (done == 0).nonzero().view(-1)
+                    keep_rows = beam_rows(keep, num_beams)
+                    active = active.index_select(0, keep)
+                    inputs = torch.index_select(inputs, 1, V(keep_rows))
+                    logprobs = torch.index_select(logprobs, 1, V(keep))
+                    finished = finished.index_select(0, keep_rows)
+                    constraints = self.select_rows(V(keep_rows), constraints=constraints, batch_indices=V(keep))
+                    hidden = self.decoder_layer.hidden
+
+        self.beam_outputs = V(backtrack(tokens[:iteration + 1], parents[:iteration])).view(-1, bs, num_beams)
+        if inference:
+            return [self.beam_outputs, V(scores)]
         # ensure the outputs are a list of layers where each layer is [sl,bs,layerdim]
-        outputs = [torch.cat(i, dim=0) for i in layer_outputs]
-        self.beam_outputs = self.beam_outputs.view(-1, bs, num_beams)
+        if compact:
+            outputs = [torch.cat([scatter_rows(output, rows, size=bs * num_beams)
+                                  for output, rows in zip(i, step_rows)], dim=0) for i in layer_outputs]
+        else:
+            outputs = [torch.cat(i, dim=0) for i in layer_outputs]
         return outputs
 
-    def mask_logprobs(self, bs, finished, iteration, logprobs, new_logprobs, num_beams, num_tokens):
+    def beam_buffers(self, inputs, max_iterations):
+        """Preallocates the buffers for the tokens [max_iterations + 1, rows] decoded in every step
+        and the back-pointers [max_iterations, rows] to the parent row of every step
+
+        Args:
+            inputs (Tensor): The first token of every row [rows]
+            max_iterations (int): The maximum number of decoding steps
+        """
+        tokens = inputs.new(max_iterations + 1, inputs.size(0)).fill_(self.pad_token)
+        tokens[0] = inputs
+        # rows that do not decode in a step point to themselves
+        parents = to_gpu(torch.arange(0, inputs.size(0)).long()).unsqueeze(0).repeat(max_iterations, 1)
+        return tokens, parents
+
+    def select_hidden(self, indices):
+        """Selects the decoding state of the rows in indices, e.g. to follow the parents of the beams"""
+        # without gradients the states of the previous step are not needed anymore, so they are reused
+        out = None if torch.is_grad_enabled() else self._hidden_buffers
+        self.decoder_layer.hidden = select_hidden_by_index(self.decoder_layer.hidden, indices=indices, out=out)
+        self._hidden_buffers = None if torch.is_grad_enabled() else self.decoder_layer.hidden
+
+    def select_rows(self, indices, constraints=None, batch_indices=None):
+        """Keeps only the rows in indices in the decoding state and the constraints,
+        e.g. to remove the rows that have finished decoding from the batch
+
+        Args:
+            indices (Tensor): The rows to keep
+            constraints (Optional[Tensor]): The constraints of every row [1, rows, dim]
+            batch_indices (Optional[Tensor]): The batch rows of the rows to keep, for the state that
+                all the beams of a batch row share. If None the rows are the batch rows
+
+        Returns:
+            The selected constraints
+        """
+        self.select_hidden(indices)
+        return None if constraints is None else torch.index_select(constraints, 1, indices)
+
+    def topk_beams(self, new_logprobs, logprobs, finished, iteration, num_beams):
+        """Finds the top num_beams continuations of the beams of every batch row
+
+        The top num_beams tokens of every beam are found first, since the top continuations over all the beams
+        are always among them, and then the top num_beams over these nb x nb candidates.
+
+        Args:
+            new_logprobs (Tensor): The log probabilities of the next token of every beam [1, bs x nb, nt]
+            logprobs (Tensor): The log probabilities of the beams so far [1, bs, nb]
+            finished (Tensor): The beams that have finished decoding [bs x nb]
+            iteration (int): The decoding step
+            num_beams (int): The number of beams
+
+        Returns:
+            Tuple[Tensor, Tensor, Tensor]: The log probabilities, the parent beams and the tokens
+                of the top continuations, all with dims [1, bs, nb]
+        """
+        bs = logprobs.size(1)
+        # [1, bs, nb, k]
+        beam_logprobs, beam_tokens = torch.topk(new_logprobs.view(1, bs, num_beams, -1), k=num_beams, dim=-1)
+        beam_logprobs = beam_logprobs + logprobs.unsqueeze(-1)
+        # mask logprobs if they are finished or it's the first iteration
+        beam_logprobs, beam_tokens = self.mask_logprobs(bs, finished, iteration, logprobs, beam_logprobs,
+                                                        beam_tokens, num_beams)
+        # [1, bs, nb]
+        logprobs, candidates = torch.topk(beam_logprobs.view(1, bs, -1), k=num_beams, dim=-1)
+        parent_beams = candidates / num_beams
+        tokens = torch.gather(beam_tokens.view(1, bs, -1), dim=-1, index=candidates)
+        return logprobs, parent_beams, tokens
+
+    def mask_logprobs(self, bs, finished, iteration, logprobs, beam_logprobs, beam_tokens, num_beams):
+        """Masks the candidates [1, bs, nb, k] of the beams, a finished beam has a single candidate,
+        the pad token with the log probability of the beam
+        """
         if iteration == 0:
             # only the first beam is considered in the first step, otherwise we would get the same result for every beam
-            new_logprobs = new_logprobs[..., 0, :]
-        else:
-            # we have to cater for finished beams as well
-            # create a mask [1, bs x nb, nt] with - inf everywhere
-            mask = torch.zeros_like(new_logprobs).fill_(-1e32).view(1, bs * num_beams, num_tokens)
-            f = V(finished.unsqueeze(0))
-            # set the pad_token position to the last logprob for the finished ones
-            mask[..., self.pad_token] = logprobs.view(1, bs * num_beams)
-            # mask shape = [1, bs * nb (that are finished), nt]
-            mask = mask.masked_select(f.unsqueeze(-1)).view(1, -1, num_tokens)
-            # replace the rows of the finished ones with the mask
-            new_logprobs.masked_scatter_(f.view(1, bs, num_beams, 1), mask)
-            # flatten all beams with the tokens
-            new_logprobs = new_logprobs.view(1, bs, -1)
-        return new_logprobs
+            return beam_logprobs[..., :1, :], beam_tokens[..., :1, :]
+        f = V(finished.view(1, bs, num_beams))
+        first_logprobs = torch.where(f, logprobs, beam_logprobs[..., 0])
+        first_tokens = beam_tokens[..., 0].masked_fill(f, self.pad_token)
+        other_logprobs = beam_logprobs[..., 1:].masked_fill(f.unsqueeze(-1).expand_as(beam_logprobs[..., 1:]), -1e32)
+        beam_logprobs = torch.cat([first_logprobs.unsqueeze(-1), other_logprobs], dim=-1)
+        beam_tokens = torch.cat([first_tokens.unsqueeze(-1), beam_tokens[..., 1:]], dim=-1)
+        return beam_logprobs, beam_tokens
 
     @property
     def hidden(self):
@@ -198,87 +468,124 @@ class Decoder(nn.Module):
 class TransformerDecoder(Decoder):
 
     def __init__(self, decoder_layer, projection_layer, max_tokens, eos_token, pad_token,
-                 embedding_layer: torch.nn.Module):
+                 embedding_layer: torch.nn.Module, incremental: bool = True):
+        """
+
+        Args:
+            incremental (bool): If True greedy and beam search decode only the newest token in every step,
+                and reuse the self attention keys and values of the previous tokens cached in the decoder layers.
+                Otherwise the whole sequence decoded so far is passed through the decoder in every step.
+        """
         super().__init__(decoder_layer=decoder_layer, projection_layer=projection_layer, max_tokens=max_tokens,
                          eos_token=eos_token, pad_token=pad_token, embedding_layer=embedding_layer)
+        self.incremental = incremental
 
-    def _train_forward(self, inputs, hidden=None, constraints=None):
+    def _train_forward(self, inputs, hidden=None, constraints=None, project=True):
         inputs = self.embedding_layer(inputs)
         # outputs are the outputs of every layer
         outputs = self.decoder_layer(inputs, hidden)
         # we project only the output of the last layer
+        if self.projection_layer is not None and project:
+            outputs[-1] = self.projection_layer(outputs[-1])
+        return outputs
+
+    def _step_forward(self, inputs, hidden):
+        """Decodes the last step of the inputs, using the cached self attention state of the previous ones"""
+        if not self.incremental:
+            return self._train_forward(inputs, hidden=hidden)
+        # the position of the last step is the number of steps cached so far
+        hidden_state = self.decoder_layer.hidden
+        offset = 0 if hidden_state is None else hidden_state[0][0].size(0)
+        inputs = self.embedding_layer(inputs[-1:], offset=offset)
+        outputs = self.decoder_layer(inputs, hidden, incremental=True)
+        # we project only the output of the last layer
         if self.projection_layer is not None:
             outputs[-1] = self.projection_layer(outputs[-1])
         return outputs
 
-    def _greedy_forward(self, inputs, hidden=None, constraints=None):
+    def _greedy_forward(self, inputs, hidden=None, constraints=None, inference=False):
         inputs = inputs[:1]  # inputs should be only first token initially [1,bs]
         sl, bs = inputs.size()
         finished = to_gpu(torch.zeros(bs).byte())
         iteration = 0
-        self.beam_outputs = inputs.clone()
+        # the decoded tokens of every step
+        tokens = inputs.data.new(self.max_iterations + 1, bs).fill_(self.pad_token)
+        tokens[0] = inputs.data[0]
+        scores = to_gpu(torch.zeros(bs))
         layer_outputs = [[] for _ in range(self.nlayers)]
+        self.decoder_layer.reset(bs)
         while not finished.all() and iteration < self.max_iterations:
             # output should be List[[sl, bs, layer_dim], ...] sl should be one
-            output = self.forward(inputs, hidden=hidden, num_beams=0)
-            for layer_index in range(self.nlayers):
-                layer_outputs[layer_index].append(output[layer_index])
+            output = self._step_forward(inputs, hidden=hidden)
+            if inference:
+                # the log probability of the decoded tokens, finished rows are not scored anymore
+                step_scores = F.log_softmax(output[-1][-1:], dim=-1).data.max(dim=-1)[0].view(-1)
+                scores += step_scores * (finished == 0).float()
+            else:
+                for layer_index in range(self.nlayers):
+                    layer_outputs[layer_index].append(output[layer_index])
 
             # step_inputs have shape [1,bs]
             _, step_inputs = output[-1][-1:].max(dim=-1)
             iteration += 1
-            self.beam_outputs = assert_dims(torch.cat([self.beam_outputs, step_inputs], dim=0), [iteration + 1, bs])
-            new_finished = step_inputs.data == self.eos_token
-            inputs = torch.cat([inputs, step_inputs], dim=0)
-            assert_dims(inputs, [iteration + 1, bs])
+            tokens[iteration] = step_inputs.data[0]
+            new_finished = step_inputs.data.view(-1) == self.eos_token
+            # the sequences decoded so far
+            inputs = assert_dims(V(tokens[:iteration + 1]), [iteration + 1, bs])
             finished = finished | new_finished
 
-        self.beam_outputs = self.beam_outputs.view(-1, bs, 1)
+        self.beam_outputs = V(tokens[:iteration + 1]).view(-1, bs, 1)
+        if inference:
+            return [self.beam_outputs, V(scores).view(bs, 1)]
         outputs = [torch.cat(i, dim=0) for i in layer_outputs]
         return outputs
 
-    def _topk_forward(self, inputs, hidden, num_beams, constraints=None):
+    def _topk_forward(self, inputs, hidden, num_beams, constraints=None, inference=False):
         sl, bs = inputs.size()
         # initial logprobs should be zero (pr of <sos> token in the start is 1)
         logprobs = torch.zeros_like(inputs[:1]).view(1, bs, 1).float()  # shape will be [sl, bs, 1]
-        inputs = inputs[:1].repeat(1,
-                                   num_beams)  # inputs should be only first token initially [1,bs x num_beams]
+        inputs = expand_beams(inputs[:1], num_beams)  # inputs should be only first token initially [1,bs x num_beams]
         finished = to_gpu(torch.zeros(bs * num_beams).byte())
         iteration = 0
         layer_outputs = [[] for _ in range(self.nlayers)]
-        self.beam_outputs = inputs.clone()
-        hidden = repeat_cell_state(hidden, num_beams)
+        # the decoded tokens of every step and the parent row each beam continued from
+        tokens, parents = self.beam_buffers(inputs.data[0], self.max_iterations)
+        self.decoder_layer.reset(bs * num_beams)
+        # the encoder outputs are not repeated for the beams, the beams of every batch row attend to the same ones
         while not finished.all() and iteration < self.max_iterations:
             # output should be List[[sl, bs * num_beams, layer_dim], ...] sl should be one
-            output = self.forward(inputs, hidden=hidden, num_beams=0)
-            for layer_index in range(self.nlayers):
-                layer_outputs[layer_index].append(output[layer_index])
+            output = self._step_forward(inputs, hidden=hidden)
+            if not inference:
+                for layer_index in range(self.nlayers):
+                    layer_outputs[layer_index].append(output[layer_index])
 
             # we take the output of the last layer with dims [1, bs, output_dim]
             # and get the indices of th top k for every bs
             new_logprobs = F.log_softmax(output[-1][-1:], dim=-1)  # [1, bs x num_beams, nt]
-            num_tokens = new_logprobs.size(2)
-            new_logprobs = new_logprobs.view(1, bs, num_beams, num_tokens) + logprobs.unsqueeze(-1)  # [1, bs, nb, nt]
-            # mask logprobs if they are finished or it's the first iteration
-            new_logprobs = self.mask_logprobs(bs, finished, iteration, logprobs, new_logprobs, num_beams, num_tokens)
-
             # TODO take into account sequence_length for getting the top logprobs and their indices
-            logprobs, beams = torch.topk(new_logprobs, k=num_beams, dim=-1)  # [1, bs, num_beams]
-            parents = beams / num_tokens
-            step_inputs = beams % num_tokens
-            parent_indices = reshape_parent_indices(parents.view(-1), bs=bs, num_beams=num_beams)
+            logprobs, parent_beams, step_inputs = self.topk_beams(new_logprobs, logprobs, finished, iteration,
+                                                                  num_beams)
+            parent_indices = reshape_parent_indices(parent_beams.view(-1), bs=bs, num_beams=num_beams)
+            # the cached self attention state follows the beams
+            self.decoder_layer.hidden = select_hidden_by_index(self.decoder_layer.hidden, indices=parent_indices)
             finished = torch.index_select(finished, 0, parent_indices.data)
             step_inputs = step_inputs.view(1, -1).contiguous()
 
-            self.beam_outputs = torch.index_select(self.beam_outputs, dim=1, index=parent_indices)
-            self.beam_outputs = torch.cat([self.beam_outputs, step_inputs], dim=0)
+            parents[iteration] = parent_indices.data
+            tokens[iteration + 1] = step_inputs.data[0]
             new_finished = (step_inputs.data == self.eos_token).view(-1)
-            inputs = torch.index_select(inputs, dim=1, index=parent_indices)
-            inputs = torch.cat([inputs, step_inputs], dim=0)
+            if self.incremental:
+                # only the last step is needed, the previous ones are cached in the decoder layers
+                inputs = step_inputs
+            else:
+                inputs = torch.index_select(inputs, dim=1, index=parent_indices)
+                inputs = torch.cat([inputs, step_inputs], dim=0)
             finished = finished | new_finished
             iteration += 1
 
+        self.beam_outputs = V(backtrack(tokens[:iteration + 1], parents[:iteration])).view(-1, bs, num_beams)
+        if inference:
+            return [self.beam_outputs, logprobs.view(bs, num_beams)]
         # ensure the outputs are a list of layers where each layer is [sl,bs,layerdim]
         outputs = [torch.cat(i, dim=0) for i in layer_outputs]
-        self.beam_outputs = self.beam_outputs.view(-1, bs, num_beams)
         return outputs
@@ -8,9 +8,11 @@ class Encoder(nn.Module):
         self.embedding_layer = embedding_layer
         self.encoder_layer = encoder_layer
 
-    def forward(self, input_tensor, state=None):
+    def forward(self, input_tensor, state=None, lengths=None):
         ed = self.embedding_layer(input_tensor)  # dims [sl,bs,ed]
-        return self.encoder_layer(ed, state)
+        if lengths is None:
+            return self.encoder_layer(ed, state)
+        return self.encoder_layer(ed, state, lengths=lengths)
 
     def reset(self, bs):
         self.encoder_layer.reset(bs)
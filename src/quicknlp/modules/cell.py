@@ -6,27 +6,31 @@ import torch.nn.functional as F
 from fastai.core import to_gpu
 from fastai.rnn_reg import WeightDrop
 from torch.nn import Parameter
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
 
 class Cell(nn.Module):
     """GRU or LSTM cell with withdrop. Can also be bidirectional and have trainable initial state"""
 
     def __init__(self, cell_type, input_size, output_size, dropout=0.0, wdrop=0.0, dropoutinit=0.0, bidir=False,
-                 train_init=False):
+                 train_init=False, nlayers=1):
         super().__init__()
         self.cell_type = cell_type.lower()
         self.bidir = bidir
         self.input_size = input_size
         self.output_size = output_size
         self.dropoutinit = dropoutinit
+        self.nlayers = nlayers
         if self.cell_type == "lstm":
-            self.cell = nn.LSTM(input_size, output_size, num_layers=1, bidirectional=bidir, dropout=dropout)
+            self.cell = nn.LSTM(input_size, output_size, num_layers=nlayers, bidirectional=bidir, dropout=dropout)
         elif self.cell_type == "gru":
-            self.cell = nn.GRU(input_size, output_size, num_layers=1, bidirectional=bidir, dropout=dropout)
+            self.cell = nn.GRU(input_size, output_size, num_layers=nlayers, bidirectional=bidir, dropout=dropout)
         else:
             raise NotImplementedError(f"cell: {cell_type} not supported")
         if wdrop:
             self.cell = WeightDrop(self.cell, wdrop)
+        # the names of the weight dropped weights, once the weight dropout is removed by freeze_for_inference
+        self.weight_drop_names = []
         self.train_init = train_init
         self.init_state = None
         self.init_cell_state = None
@@ -42,8 +46,12 @@ class Cell(nn.Module):
                 self.init_cell_state.data.uniform_(-stdv, stdv)
         self.reset(bs=1)
 
-    def forward(self, inputs, hidden):
+    def forward(self, inputs, hidden, lengths=None):
         """
+        If the lengths [bs] of the sequences are given, the padding at the end of the sequences is not processed
+        and the states returned are the ones after the last token of every sequence. The outputs of the pad steps
+        are zeros and the sequences of length zero keep their initial states.
+
         LSTM Inputs: input, (h_0, c_0)
                     - **input** (seq_len, batch, input_size): tensor containing the features
                       of the input sequence.
@@ -83,10 +91,69 @@ class Cell(nn.Module):
 
 
         """
-        return self.cell(inputs, hidden)
+        if lengths is None:
+            return self.cell(inputs, hidden)
+        sl, bs, _ = inputs.size()
+        # the packed sequences have to be sorted by decreasing length, the empty ones are not packed
+        sorted_lengths, order = torch.sort(lengths, descending=True)
+        order = to_gpu(order)
+        num_packed = int((sorted_lengths > 0).sum())
+        if num_packed == 0:
+            ndir = 2 if self.bidir else 1
+            return inputs.new_zeros(sl, bs, self.output_size * ndir), hidden
+        packed = pack_padded_sequence(inputs.index_select(1, order[:num_packed]),
+                                      sorted_lengths[:num_packed].cpu().tolist())
+        outputs, new_hidden = self.cell(packed, self.select_hidden(hidden, order[:num_packed]))
+        outputs, _ = pad_packed_sequence(outputs, total_length=sl)
+        if num_packed < bs:
+            # the empty sequences have zero outputs and keep their initial states
+            outputs = torch.cat([outputs, outputs.new_zeros(sl, bs - num_packed, outputs.size(2))], dim=1)
+            new_hidden = concat_hidden(new_hidden, self.select_hidden(hidden, order[num_packed:]))
+        restore = torch.sort(order)[1]
+        return outputs.index_select(1, restore), self.select_hidden(new_hidden, restore)
+
+    def select_hidden(self, hidden, indices):
+        """Selects the batch rows in indices of the hidden state"""
+        if isinstance(hidden, tuple):
+            return tuple(state.index_select(1, indices) for state in hidden)
+        return hidden.index_select(1, indices)
+
+    def freeze_for_inference(self):
+        """Replaces the weight dropped cell with a plain RNN module that uses the raw weights and removes the
+        dropout of the cell and the initial states. The outputs in eval mode stay the same, but the cell
+        does not apply dropout when training anymore. The state_dict keys stay the ones of the weight dropped cell.
+        """
+        if isinstance(self.cell, WeightDrop):
+            self.weight_drop_names = list(self.cell.weights)
+            self.cell = remove_weight_drop(self.cell)
+        self.cell.dropout = 0.0
+        self.dropoutinit = 0.0
+        return self
+
+    def weight_drop_keys(self, prefix=""):
+        """The pairs of (key, weight dropped key) of the parameters of a cell that had its weight dropout removed"""
+        if not self.weight_drop_names:
+            return []
+        return [(f"{prefix}cell.{name}",
+                 f"{prefix}cell.module.{name}_raw" if name in self.weight_drop_names else f"{prefix}cell.module.{name}")
+                for name, _ in self.cell.named_parameters()]
+
+    def state_dict(self, destination=None, prefix='', keep_vars=False):
+        # frozen cells save their weights with the keys of the weight dropped cell,
+        # so that frozen and not frozen models can load each other's state
+        destination = super().state_dict(destination=destination, prefix=prefix, keep_vars=keep_vars)
+        for key, weight_drop_key in self.weight_drop_keys(prefix):
+            destination[weight_drop_key] = destination.pop(key)
+        return destination
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        for key, weight_drop_key in self.weight_drop_keys(prefix):
+            if weight_drop_key in state_dict:
+                state_dict[key] = state_dict.pop(weight_drop_key)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def one_hidden(self, bs=1, cell_state=False):
-        ndir = 2 if self.bidir else 1
+        ndir = (2 if self.bidir else 1) * self.nlayers
         if not self.train_init:
             init_state = to_gpu(torch.zeros(ndir, bs, self.output_size))
         elif cell_state:
@@ -105,3 +172,57 @@ class Cell(nn.Module):
 
     def reset(self, bs=1):
         self.hidden = self.hidden_state(bs=bs)
+
+
+def concat_hidden(first, second):
+    """Concatenates two hidden states along their batch dim"""
+    if isinstance(first, tuple):
+        return tuple(torch.cat(states, dim=1) for states in zip(first, second))
+    return torch.cat([first, second], dim=1)
+
+
+def remove_weight_drop(module):
+    """Returns the RNN module wrapped by a WeightDrop module, with the raw weights as its weights"""
+    rnn = module.module
+    for name in module.weights:
+        weight = rnn._parameters.pop(name + "_raw")
+        if hasattr(rnn, name):
+            # the last dropped weight set by the WeightDrop module
+            delattr(rnn, name)
+        rnn.register_parameter(name, weight)
+    # WeightDrop disables flatten_parameters, so that the cuDNN kernels can be used again
+    rnn.__dict__.pop("flatten_parameters", None)
+    rnn.flatten_parameters()
+    return rnn
+
+
+def stack_cells(cells):
+    """Returns a multi-layer Cell that runs the single layer cells one after the other sharing their weights.
+
+    The cells should be frozen, have the same type, direction and output_size and every cell should take
+    the outputs of the one before it as inputs. The hidden state of the stacked cell is the concatenation of
+    the hidden states of the cells (see stack_states).
+    """
+    first = cells[0]
+    stacked = Cell(cell_type=first.cell_type, input_size=first.input_size, output_size=first.output_size,
+                   bidir=first.bidir, nlayers=len(cells))
+    for layer_index, cell in enumerate(cells):
+        for name, weight in cell.cell.named_parameters():
+            # e.g. weight_hh_l0 or weight_hh_l0_reverse
+            setattr(stacked.cell, name.replace("_l0", f"_l{layer_index}"), weight)
+    stacked.cell.flatten_parameters()
+    return stacked
+
+
+def stack_states(states):
+    """Concatenates the hidden states of single layer cells to the hidden state of their stacked cell"""
+    if isinstance(states[0], tuple):
+        return tuple(torch.cat(state, dim=0) for state in zip(*states))
+    return torch.cat(states, dim=0)
+
+
+def split_states(state, nlayers):
+    """Splits the hidden state of a stacked cell to the hidden states of its nlayers single layer cells"""
+    if isinstance(state, tuple):
+        return list(zip(*[layer_state.chunk(nlayers, dim=0) for layer_state in state]))
+    return list(state.chunk(nlayers, dim=0))
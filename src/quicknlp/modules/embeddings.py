@@ -3,7 +3,7 @@ import math
 import torch
 import torch.nn as nn
 from fastai.core import V
-from fastai.rnn_reg import EmbeddingDropout, LockedDropout
+from fastai.rnn_reg import LockedDropout
 
 
 class NormEmbeddings(nn.Module):
@@ -40,11 +40,33 @@ class PositionalEncoding(nn.Module):
         # we register pe as part of the state but not as a parameter
         self.register_buffer('pe', pe)
 
-    def forward(self, x):
-        x = x + V(self.pe[:, :x.size(1)])
+    def forward(self, x, offset=0):
+        """Adds the positional encodings of the steps offset:offset + sl to the inputs x with dims [sl, bs, dim]"""
+        x = x + V(self.pe[:, offset:offset + x.size(0)]).transpose(0, 1)
         return self.dropout(x)
 
 
+class EmbeddingDropout(nn.Module):
+    """Embedding dropout of Gal & Ghahramani 2016, zeros out whole tokens of the vocabulary.
+
+    Same as the fastai EmbeddingDropout but the dropout mask is drawn only for the tokens in the batch
+    and applied to their embeddings, instead of masking a copy of the whole embedding matrix.
+    Every occurrence of a token in the batch shares its mask.
+    """
+
+    def __init__(self, embed):
+        super().__init__()
+        self.embed = embed
+
+    def forward(self, words, dropout=0.1):
+        emb = self.embed(words)
+        if not dropout:
+            return emb
+        tokens, token_indices = torch.unique(words.data, sorted=False, return_inverse=True)
+        mask = emb.data.new(tokens.size(0)).bernoulli_(1 - dropout) / (1 - dropout)
+        return emb * V(mask[token_indices.view(-1)].view(*words.size(), 1))
+
+
 class DropoutEmbeddings(nn.Module):
     initrange = 0.1
 
@@ -67,9 +89,19 @@ class DropoutEmbeddings(nn.Module):
         self.emb_size = emb_size
 
     def forward(self, input_tensor):
-        emb = self.encoder_with_dropout(input_tensor, dropout=self.dropout_embedding if self.training else 0)
+        if self.training and self.dropout_embedding > 0:
+            emb = self.encoder_with_dropout(input_tensor, dropout=self.dropout_embedding)
+        else:
+            # without dropout the embedding is a plain lookup
+            emb = self.encoder(input_tensor)
         return self.dropout_input(emb)
 
+    def freeze_for_inference(self):
+        """Removes the embedding and input dropouts, the outputs in eval mode stay the same"""
+        self.dropout_embedding = 0.0
+        self.dropout_input.p = 0.0
+        return self
+
     @property
     def weight(self):
         return self.encoder.weight
@@ -83,8 +115,9 @@ class TransformerEmbeddings(nn.Module):
                                     PositionalEncoding(input_size=emb_size, dropout=dropout, max_len=max_len))
         self.emb_size = emb_size
 
-    def forward(self, input_tensor):
-        return self.layers(input_tensor)
+    def forward(self, input_tensor, offset=0):
+        """The embeddings of the input_tensor [sl, bs], if offset is given the first step has position offset"""
+        return self.layers[1](self.layers[0](input_tensor), offset=offset)
 
     @property
     def weight(self):
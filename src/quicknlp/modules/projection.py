@@ -1,6 +1,9 @@
 from collections import OrderedDict
+from typing import List
 
 import torch
+import torch.nn.functional as F
+from fastai.core import V
 from fastai.rnn_reg import LockedDropout
 from torch import nn as nn
 
@@ -8,8 +11,49 @@ from quicknlp.utils import assert_dims
 from .attention import MLPAttention, SDPAttention
 
 
+class ChunkedCrossEntropy(torch.autograd.Function):
+    """The mean cross entropy of the scores inputs x weight^T [rows, vocab] and the targets, ignoring the pad targets.
+
+    The scores are computed for chunk_rows rows at a time, the gradients of every chunk are computed in the forward
+    pass, so that only the scores of one chunk are in memory at any time. The result and its gradients are the
+    same as F.cross_entropy of the full scores.
+    """
+
+    @staticmethod
+    def forward(ctx, inputs, weight, target, pad_idx, chunk_rows):
+        not_pad = (target != pad_idx).float()
+        num_targets = max(float(not_pad.sum()), 1.)
+        needs_grad = ctx.needs_input_grad[0] or ctx.needs_input_grad[1]
+        grad_inputs = torch.zeros_like(inputs) if needs_grad else None
+        grad_weight = torch.zeros_like(weight) if needs_grad else None
+        loss = 0.
+        for start in range(0, inputs.size(0), chunk_rows):
+            chunk = inputs[start:start + chunk_rows]
+            chunk_target = target[start:start + chunk_rows].unsqueeze(1)
+            chunk_not_pad = not_pad[start:start + chunk_rows].unsqueeze(1)
+            logprobs = F.log_softmax(chunk @ weight.t(), dim=-1)  # [chunk_rows, vocab]
+            loss -= float((logprobs.gather(1, chunk_target) * chunk_not_pad).sum())
+            if needs_grad:
+                # d loss / d scores = (softmax - one hot of the target) / number of targets, zero for the pad targets
+                grad_scores = logprobs.exp_().scatter_add_(1, chunk_target, -torch.ones_like(chunk_not_pad))
+                grad_scores.mul_(chunk_not_pad / num_targets)
+                grad_inputs[start:start + chunk_rows] = grad_scores @ weight
+                grad_weight.addmm_(grad_scores.t(), chunk)
+        ctx.save_for_backward(grad_inputs, grad_weight)
+        return inputs.new_tensor(loss / num_targets)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad_inputs, grad_weight = ctx.saved_tensors
+        grad_inputs = grad_inputs * grad_output if ctx.needs_input_grad[0] else None
+        grad_weight = grad_weight * grad_output if ctx.needs_input_grad[1] else None
+        return grad_inputs, grad_weight, None, None, None
+
+
 class Projection(nn.Module):
     initrange = 0.1
+    # the number of steps the scores are computed for at a time in the loss
+    loss_chunk_size = 16
 
     def __init__(self, output_size: int, input_size: int, dropout: float, nhid: int = None, tie_encoder=None):
         super().__init__()
@@ -42,6 +86,110 @@ class Projection(nn.Module):
         decoded = self.layers(decoded)
         return decoded.view(-1, projection_input.size(1), decoded.size(1))
 
+    def loss(self, projection_input, target, pad_idx):
+        """The cross entropy of the target tokens [sl, bs] given the inputs of the projection [sl, bs, input_dim]
+
+        The scores of the last linear layer are computed for loss_chunk_size steps at a time together with
+        their gradients, so that the scores of the whole sequence [sl, bs, output_size] are never kept in memory.
+        """
+        output = self.dropout(projection_input)
+        hidden = output.view(output.size(0) * output.size(1), output.size(2))
+        *hidden_layers, linear = self.layers.children()
+        for layer in hidden_layers:
+            hidden = layer(hidden)
+        chunk_rows = self.loss_chunk_size * projection_input.size(1)
+        return ChunkedCrossEntropy.apply(hidden, linear.weight, target.contiguous().view(-1).data, pad_idx,
+                                         chunk_rows)
+
+
+class AdaptiveProjection(nn.Module):
+    """Adaptive softmax Grave et al. 2017, see https://arxiv.org/abs/1609.04309
+
+    The vocabulary is split by the cutoffs into a shortlist of the most frequent tokens and clusters of rarer tokens,
+    the vocabulary should be ordered by frequency like the torchtext vocabularies. The head predicts the shortlist
+    tokens and the clusters, every cluster has a smaller tail that predicts the tokens inside it. In training
+    the loss only runs the tails of the clusters that have target tokens, the forward returns the exact log
+    probabilities of the whole vocabulary for greedy and beam search.
+    """
+
+    def __init__(self, output_size: int, input_size: int, dropout: float, cutoffs: List[int], nhid: int = None,
+                 div_value: float = 4.0):
+        """
+
+        Args:
+            output_size (int): The size of the vocabulary
+            input_size (int): The dims of the inputs
+            dropout (float): The dropout of the inputs (and the hidden layer if nhid is given)
+            cutoffs (List[int]): The increasing indices where the shortlist and every cluster end,
+                e.g. [2000, 10000] for a shortlist of 2000 tokens and two clusters
+            nhid (Optional[int]): If given the inputs are first projected to nhid dims like in Projection
+            div_value (float): The dims of the tail of every cluster are divided by div_value
+        """
+        super().__init__()
+        assert list(cutoffs) == sorted(cutoffs) and 0 < cutoffs[0] and cutoffs[-1] < output_size, \
+            f"cutoffs {cutoffs} should be increasing and smaller than the vocabulary {output_size}"
+        layers = OrderedDict()
+        self.dropout = LockedDropout(dropout)
+        if nhid is not None:
+            linear1 = nn.Linear(input_size, nhid)
+            linear1.weight.data.uniform_(-Projection.initrange, Projection.initrange)
+            layers["projection1"] = linear1
+            layers["dropout"] = nn.Dropout(dropout)
+        else:
+            nhid = input_size
+        self.layers = nn.Sequential(layers)
+        self.cutoffs = [*cutoffs, output_size]
+        self.head = nn.Linear(nhid, self.cutoffs[0] + len(self.cutoffs) - 1, bias=False)
+        tails = []
+        for index in range(len(self.cutoffs) - 1):
+            tail_nhid = max(1, int(nhid // (div_value ** (index + 1))))
+            tails.append(nn.Sequential(nn.Linear(nhid, tail_nhid, bias=False),
+                                       nn.Linear(tail_nhid, self.cutoffs[index + 1] - self.cutoffs[index], bias=False)
+                                       ))
+        self.tails = nn.ModuleList(tails)
+        self.output_size = output_size
+
+    def hidden(self, projection_input):
+        """The inputs of the head and tails [sl x bs, nhid]"""
+        output = self.dropout(projection_input)
+        return self.layers(output.view(output.size(0) * output.size(1), output.size(2)))
+
+    def forward(self, projection_input):
+        # input should be sl, bs, input_dim
+        hidden = self.hidden(projection_input)
+        head_logprobs = F.log_softmax(self.head(hidden), dim=-1)
+        logprobs = [head_logprobs[:, :self.cutoffs[0]]]
+        for index, tail in enumerate(self.tails):
+            cluster_logprob = head_logprobs[:, self.cutoffs[0] + index].unsqueeze(1)
+            logprobs.append(F.log_softmax(tail(hidden), dim=-1) + cluster_logprob)
+        logprobs = torch.cat(logprobs, dim=-1)
+        return logprobs.view(-1, projection_input.size(1), self.output_size)
+
+    def loss(self, projection_input, target, pad_idx):
+        """The negative log likelihood of the target tokens [sl, bs] given the inputs of the projection
+        [sl, bs, input_dim], the tail of every cluster only runs for the targets inside it
+        """
+        hidden = self.hidden(projection_input)
+        target = target.contiguous().view(-1)
+        # the shortlist tokens are predicted by the head, the other tokens by the head and the tail of their cluster
+        head_target = target.data.clone()
+        clusters = []
+        for index in range(len(self.tails)):
+            in_cluster = (target.data >= self.cutoffs[index]) & (target.data < self.cutoffs[index + 1])
+            head_target.masked_fill_(in_cluster, self.cutoffs[0] + index)
+            clusters.append(in_cluster.nonzero().view(-1))
+        head_logprobs = F.log_softmax(self.head(hidden), dim=-1)
+        logprobs = head_logprobs.gather(1, V(head_target).unsqueeze(1)).squeeze(1)
+        for index, (tail, rows) in enumerate(zip(self.tails, clusters)):
+            if rows.dim() == 0 or rows.size(0) == 0:
+                continue
+            rows = V(rows)
+            tail_target = target.index_select(0, rows) - self.cutoffs[index]
+            tail_logprobs = F.log_softmax(tail(hidden.index_select(0, rows)), dim=-1)
+            logprobs = logprobs.index_add(0, rows, tail_logprobs.gather(1, tail_target.unsqueeze(1)).squeeze(1))
+        not_pad = V((target.data != pad_idx).float())
+        return -(logprobs * not_pad).sum() / not_pad.sum().clamp(min=1)
+
 
 class AttentionProjection(nn.Module):
 
@@ -59,7 +207,11 @@ class AttentionProjection(nn.Module):
 
     def forward(self, input):
         assert_dims(input, [None, self.input_size])
-        self._attention_output = self.attention(query=input, keys=self.keys, values=self.keys)
+        if self.keys_projection is None:
+            # the keys are the same for every decoding step, so their projection is computed only once
+            self.keys_projection = self.attention.project_keys(self.keys)
+        self._attention_output = self.attention(query=input, keys=self.keys, values=self.keys,
+                                                keys_projection=self.keys_projection)
         output = torch.cat([input, self._attention_output], dim=-1).unsqueeze_(0)
         assert_dims(output, [1, None, self.input_size * 2])
         output = assert_dims(self.projection1(output), [1, None, self.input_size])
@@ -72,6 +224,27 @@ class AttentionProjection(nn.Module):
         else:
             return self._attention_output
 
+    @property
+    def keys(self):
+        return self._keys
+
+    @keys.setter
+    def keys(self, value):
+        self._keys = value
+        self.keys_projection = None
+
     def reset(self, keys):
         self._attention_output = None
         self.keys = keys
+
+    def select_attention_output(self, indices):
+        """Keeps the attention output of the batch rows in indices"""
+        if self._attention_output is not None:
+            self._attention_output = torch.index_select(self._attention_output, 0, indices)
+
+    def select_keys(self, indices):
+        """Keeps the keys (and their projection) of the batch rows in indices"""
+        keys_projection = self.keys_projection
+        self.keys = torch.index_select(self.keys, 1, indices)
+        if keys_projection is not None:
+            self.keys_projection = torch.index_select(keys_projection, 1, indices)
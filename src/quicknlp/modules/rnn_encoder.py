@@ -3,7 +3,7 @@ import warnings
 import torch.nn as nn
 from fastai.lm_rnn import LockedDropout
 
-from .cell import Cell
+from .cell import Cell, split_states, stack_cells, stack_states
 
 
 def get_layer_dims(layer_index, total_layers, input_size, output_size, nhid, bidir):
@@ -50,13 +50,16 @@ class RNNLayers(nn.Module):
         self.input_size, self.output_size, self.nhid, self.nlayers, self.bidir = input_size, output_size, nhid, nlayers, bidir
         self.dropouths = nn.ModuleList([LockedDropout(dropouth) for l in range(nlayers)])
         self.hidden, self.weights = None, None
+        self.layer_groups, self.stacked_layers = None, None
         self.reset(1)
 
-    def forward(self, input_tensor, hidden=None):
+    def forward(self, input_tensor, hidden=None, lengths=None):
         """ Invoked during the forward propagation of the RNN_Encoder module.
         Args:
             input_tensor (Tensor): input of shape [sentence_length, batch_size, hidden_dim]
             hidden (List[Tensor]: state  of the encoder
+            lengths (Optional[Tensor]): The lengths [batch_size] of the sequences padded at the end.
+                If given the sequences are packed and the padding steps are skipped (see Cell.forward)
 
         Returns:
             (Tuple[List[Tensor], List[Tensor]]):
@@ -67,11 +70,13 @@ class RNNLayers(nn.Module):
         # we reset at very batch as they are not sequential (like a languagemodel)
         output = input_tensor  # sl, bs, ed
         self.hidden = self.hidden if hidden is None else hidden
+        if self.layer_groups is not None:
+            return self._stacked_forward(output, lengths=lengths)
         new_hidden, outputs = [], []
         for layer_index, (rnn, drop) in enumerate(zip(self.layers, self.dropouths)):
             with warnings.catch_warnings():
                 warnings.simplefilter("ignore")
-                output, new_h = rnn(output, self.hidden[layer_index])
+                output, new_h = rnn(output, self.hidden[layer_index], lengths=lengths)
             new_hidden.append(new_h)
             if layer_index != self.nlayers - 1:
                 output = drop(output)
@@ -80,6 +85,59 @@ class RNNLayers(nn.Module):
         self.hidden = new_hidden
         return outputs
 
+    def _stacked_forward(self, output, lengths=None):
+        new_hidden, outputs = [], []
+        for group, rnn in zip(self.layer_groups, self.stacked_layers):
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                output, new_h = rnn(output, stack_states([self.hidden[index] for index in group]), lengths=lengths)
+            new_hidden.extend(split_states(new_h, len(group)))
+            # the outputs of the layers inside a stack are not available, the ones of the stack are used instead
+            outputs.extend([output] * len(group))
+        self.hidden = new_hidden
+        return outputs
+
+    def freeze_for_inference(self, stack=True):
+        """Prepares the layers for a faster inference with the same outputs in eval mode
+
+        The cells are replaced by plain RNN modules without weight dropout and the dropout between the layers
+        is removed. The layers can then be stacked, consecutive cells with the same output size become
+        one multi-layer RNN that shares their weights, so that the fused multi-layer kernels are used.
+
+        Args:
+            stack (bool): If True stack the consecutive cells that can be run as one multi-layer RNN.
+                The outputs of the layers inside a stack are not computed, the forward returns the outputs
+                of the stack for every one of its layers. The hidden states are kept per layer.
+
+        Returns:
+            RNNLayers: the module itself
+        """
+        for layer, drop in zip(self.layers, self.dropouths):
+            layer.freeze_for_inference()
+            drop.p = 0.0
+        if stack:
+            groups = [[0]]
+            for index in range(1, self.nlayers):
+                previous, layer = self.layers[index - 1], self.layers[index]
+                ndir = 2 if previous.bidir else 1
+                if layer.output_size == previous.output_size and layer.input_size == previous.output_size * ndir:
+                    groups[-1].append(index)
+                else:
+                    groups.append([index])
+            self.layer_groups = groups
+            # a plain list, the stacked cells share the parameters of the layers and are not registered as modules,
+            # so that the state_dict keys stay the same
+            self.stacked_layers = [self.layers[group[0]] if len(group) == 1 else
+                                   stack_cells([self.layers[i] for i in group]) for group in groups]
+        return self
+
+    def _apply(self, fn):
+        module = super()._apply(fn)
+        # the stacked cells are not registered, their shared weights are flattened again after they are moved
+        for stacked in self.stacked_layers or []:
+            stacked.cell.flatten_parameters()
+        return module
+
     def reset_hidden(self, bs):
         self.hidden = [self.layers[l].hidden_state(bs) for l in range(self.nlayers)]
 
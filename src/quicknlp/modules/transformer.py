@@ -1,6 +1,5 @@
 import torch as tr
 import torch.nn as nn
-from fastai.core import V
 
 from quicknlp.utils import assert_dims, get_list
 from .attention import MultiHeadAttention
@@ -45,20 +44,44 @@ class AttentionLayer(nn.Module):
                                             keys_dim=self.input_size, values_dim=self.input_size,
                                             query_dim=self.input_size,
                                             dropout=dropout)
+        self._causal_mask = None
+
+    def causal_mask(self, query, keys_size):
+        """The mask [query_size, keys_size] of the keys every query can attend to,
+        where the queries are the last query_size steps of the keys. The cached mask is not a buffer of the module,
+        so it is made again on the device and with the type of the query if the module was moved
+        """
+        mask = self._causal_mask
+        if mask is None or mask.size(0) < keys_size or mask.device != query.device or mask.dtype != query.dtype:
+            self._causal_mask = query.data.new_ones(keys_size, keys_size).tril()
+        query_size = query.size(0)
+        return self._causal_mask[keys_size - query_size:keys_size, :keys_size]
 
     def forward(self, input_tensor, keys_vector, values_vector, mask=False):
-        self_attention_outputs = []
-        sl, bs, _ = keys_vector.size()
-        for index, input_step in enumerate(input_tensor, 1):
-            if mask:
-                mask_ = V(tr.zeros(sl, bs, self.num_heads))
-                mask_[:index] = 1
-            else:
-                mask_ = None
-            self_attention_outputs.append(
-                self.attention(query=input_step, keys=keys_vector,
-                               values=values_vector, mask=mask_))  # dims [bs, dims]
-        return tr.stack(self_attention_outputs, dim=0)  # dims [sl, bs, dims]
+        mask_ = self.causal_mask(input_tensor, keys_vector.size(0)) if mask else None
+        return self.attention(query=input_tensor, keys=keys_vector,
+                              values=values_vector, mask=mask_)  # dims [sl, bs, dims]
+
+    def incremental_forward(self, input_tensor, state=None):
+        """Masked self attention of the new steps of a sequence, reusing the projected keys and values of the
+        steps that came before them
+
+        Args:
+            input_tensor (Tensor): The new steps of the sequence with dims [sl, bs, input_size]
+            state (Optional[Tuple[Tensor, Tensor]]): The keys and values projections of the previous steps
+
+        Returns:
+            Tuple[Tensor, Tuple[Tensor, Tensor]]: The attention outputs with dims [sl, bs, input_size]
+                and the keys and values projections of all the steps so far
+        """
+        keys, values = self.attention.project_keys_values(keys=input_tensor, values=input_tensor)
+        if state is not None:
+            keys = tr.cat([state[0], keys], dim=0)
+            values = tr.cat([state[1], values], dim=0)
+        mask_ = self.causal_mask(input_tensor, keys.size(0))
+        outputs = self.attention.attend(query=input_tensor, keys_projection=keys, values_projection=values,
+                                        mask=mask_)  # dims [sl, bs, dims]
+        return outputs, (keys, values)
 
 
 class TransformerLayer(nn.Module):
@@ -112,6 +135,37 @@ class TransformerLayerDecoder(TransformerLayer):
                                            lambda x: self.decoder_attention(x, encoder_input, encoder_input))
         return self.sublayers[2](dec_att_output, self.linear)
 
+    def incremental_forward(self, encoder_input, decoder_input, state=None, encoder_projection=None):
+        """Decodes only the new steps in decoder_input, the self attention over the previous steps
+        uses their cached keys and values in state
+
+        Args:
+            encoder_input (Tensor): The encoder outputs [sl, bs, input_size]
+            decoder_input (Tensor): The new steps of the decoder [sl, bs, input_size]
+            state (Optional[Tuple[Tensor, Tensor]]): The self attention keys and values of the previous steps
+            encoder_projection (Optional[Tuple[Tensor, Tensor]]): The encoder outputs projected by
+                project_encoder_output, if None they are projected on every call
+
+        Returns:
+            Tuple[Tensor, Tuple[Tensor, Tensor]]: The outputs of the new steps [sl, bs, input_size]
+                and the updated self attention state
+        """
+        encoder_input, decoder_input = assert_dims([encoder_input, decoder_input], [2, None, None, self.input_size])
+        # same as sublayers[0] but the self attention state has to be returned too
+        self_attention, state = self.attention.incremental_forward(self.sublayers[0].layer_norm(decoder_input),
+                                                                   state=state)
+        att_output = decoder_input + self_attention
+        if encoder_projection is None:
+            encoder_projection = self.project_encoder_output(encoder_input)
+        keys, values = encoder_projection
+        dec_att_output = self.sublayers[1](att_output,
+                                           lambda x: self.decoder_attention.attention.attend(x, keys, values))
+        return self.sublayers[2](dec_att_output, self.linear), state
+
+    def project_encoder_output(self, encoder_input):
+        """The keys and values projections of the encoder-decoder attention, they stay the same for every step"""
+        return self.decoder_attention.attention.project_keys_values(keys=encoder_input, values=encoder_input)
+
 
 class TransformerDecoderLayers(nn.Module):
     def __init__(self, nlayers, input_size, num_heads, nhid, dropout=0.1):
@@ -120,19 +174,55 @@ class TransformerDecoderLayers(nn.Module):
         nhid = get_list(nhid, nlayers)
         num_heads = get_list(num_heads, nlayers)
         self.hidden = None
+        self.encoder_projections = None
         self.input_size = input_size
         self.layers = nn.ModuleList(
             [TransformerLayerDecoder(input_size=input_size, nhid=nhid[i],
                                      dropout=dropout, num_heads=num_heads[i]) for i in range(nlayers)])
 
-    def forward(self, decoder_inputs, encoder_inputs):
+    def forward(self, decoder_inputs, encoder_inputs, incremental=False):
+        """
+
+        Args:
+            decoder_inputs (Tensor): The decoder inputs with dims [sl, bs, input_size]
+            encoder_inputs (List[Tensor]): The outputs of every encoder layer with dims [nlayers, sl, bs, input_size]
+            incremental (bool): If True the decoder_inputs are only the next steps of the sequences decoded so far.
+                The self attention keys and values of the previous steps are read from self.hidden
+                and the ones of the new steps are added to it. The projections of the encoder_inputs are computed
+                on the first call and kept in self.encoder_projections. Call reset before decoding a new batch.
+
+        Returns:
+            List[Tensor]: The outputs of every layer with dims [nlayers, sl, bs, input_size]
+
+        """
         output_tensors = []
         sl, bs, input_size = decoder_inputs.size()
         dec_inputs = assert_dims(decoder_inputs, [sl, bs, self.input_size])
-        # nlayers, sl, bs, input_size
-        encoder_inputs = assert_dims(encoder_inputs, [self.nlayers, None, bs, self.input_size])
-        for enc_inputs, layer in zip(encoder_inputs, self.layers):
-            dec_inputs = layer(enc_inputs, dec_inputs)
-            output_tensors.append(dec_inputs)
+        # nlayers, sl, bs, input_size, in beam search the bs x nb beams share the encoder inputs of their batch row
+        encoder_inputs = assert_dims(encoder_inputs, [self.nlayers, None, None, self.input_size])
+        if incremental:
+            hidden = [None] * self.nlayers if self.hidden is None else self.hidden
+            if self.encoder_projections is None:
+                self.encoder_projections = self.project_encoder_outputs(encoder_inputs)
+            new_hidden = []
+            for enc_inputs, layer, layer_hidden, enc_projection in zip(encoder_inputs, self.layers, hidden,
+                                                                        self.encoder_projections):
+                dec_inputs, layer_hidden = layer.incremental_forward(enc_inputs, dec_inputs, state=layer_hidden,
+                                                                     encoder_projection=enc_projection)
+                output_tensors.append(dec_inputs)
+                new_hidden.append(layer_hidden)
+            self.hidden = new_hidden
+        else:
+            for enc_inputs, layer in zip(encoder_inputs, self.layers):
+                dec_inputs = layer(enc_inputs, dec_inputs)
+                output_tensors.append(dec_inputs)
         assert_dims(output_tensors, [self.nlayers, sl, bs, self.input_size])
         return output_tensors
+
+    def project_encoder_outputs(self, encoder_inputs):
+        """Returns the encoder-decoder attention keys and values projections of every layer"""
+        return [layer.project_encoder_output(enc_inputs) for enc_inputs, layer in zip(encoder_inputs, self.layers)]
+
+    def reset(self, bs):
+        self.hidden = None
+        self.encoder_projections = None
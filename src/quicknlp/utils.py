@@ -198,6 +198,11 @@ def assert_dims(value: Sequence[Array], dims: List[Optional[int]]) -> Sequence[A
     return value
 
 
+def get_lengths(inputs, pad_token):
+    """The number of tokens that are not padding of every sequence in inputs [sl, bs]"""
+    return (inputs.data != pad_token).long().sum(dim=0)
+
+
 def get_kwarg(kwargs, name, default_value=None, remove=True):
     """Returns the value for the parameter if it exists in the kwargs otherwise the default value provided"""
     if remove:
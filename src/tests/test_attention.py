@@ -1,5 +1,7 @@
 import numpy as np
 import pytest
+import torch as tr
+import torch.nn.functional as F
 from fastai.core import T, V, to_gpu
 
 from quicknlp.modules.attention import MLPAttention, MultiHeadAttention, SDPAttention
@@ -73,3 +75,59 @@ def test_MultiHeadAttention_with_mask(attention_setup):
     mask[0] = 1
     result = attention(query=V(query), keys=V(keys), values=V(keys), mask=mask)
     assert_dims(result, [bs, num_heads * nhid])
+
+
+def test_MultiHeadAttention_many_queries(attention_setup):
+    keys, query = attention_setup
+    bs = query.size(0)
+    ed = keys.size(2)
+    sl = keys.size(0)
+    eq = query.size(1)
+    num_heads = 4
+    nhid = 10
+    attention = to_gpu(
+        MultiHeadAttention(num_heads=num_heads, nhid=nhid, keys_dim=ed, query_dim=eq, values_dim=ed, dropout=0.0))
+    queries = to_gpu(V(T(np.random.rand(sl, bs, eq))))
+    causal_mask = V(T(np.tril(np.ones((sl, sl)))))
+    result = attention(query=queries, keys=keys, values=keys, mask=causal_mask)
+    assert_dims(result, [sl, bs, num_heads * nhid])
+    # every query step should get the same result as when it is attending on its own
+    for index in range(sl):
+        mask = V(T(np.zeros((sl, bs, num_heads))))
+        mask[:index + 1] = 1
+        expected = attention(query=queries[index], keys=keys, values=keys, mask=mask)
+        assert ((result[index] - expected).abs() < 1E-5).all()
+
+
+def test_MLPAttention_keys_projection(attention_setup):
+    keys, query = attention_setup
+    sl, bs, edk = keys.size()
+    in_features = edk + query.size(1)
+    attention = to_gpu(MLPAttention(n_in=in_features, nhid=200))
+    keys_projection = attention.project_keys(keys)
+    assert_dims(keys_projection, [sl, bs, 200])
+    result = attention(query=query, keys=keys, values=keys, keys_projection=keys_projection)
+    # the result should be the same as running linear1 over the concatenated query and keys
+    inputs = tr.cat([query.unsqueeze(0).repeat(sl, 1, 1), keys], dim=-1)
+    scores = F.softmax(attention.linear2(F.tanh(attention.linear1(inputs))), dim=0)
+    expected = (scores * keys).sum(dim=0)
+    assert ((result - expected).abs() < 1E-5).all()
+
+
+def test_attention_shared_keys(attention_setup):
+    keys, query = attention_setup
+    sl, bs, edk = keys.size()
+    eq = query.size(1)
+    num_beams = 3
+    # every batch row has num_beams queries that attend to the keys of their batch row
+    queries = to_gpu(V(T(np.random.rand(bs * num_beams, eq))))
+    repeated_keys = keys.unsqueeze(2).expand(sl, bs, num_beams, edk).contiguous().view(sl, bs * num_beams, edk)
+    attentions = [to_gpu(MLPAttention(n_in=edk + eq, nhid=200)),
+                  to_gpu(MultiHeadAttention(num_heads=4, nhid=10, keys_dim=edk, query_dim=eq, values_dim=edk))]
+    if edk == eq:
+        attentions.append(to_gpu(SDPAttention(n_in=edk)))
+    for attention in attentions:
+        result = attention(query=queries, keys=keys, values=keys)
+        expected = attention(query=queries, keys=repeated_keys, values=repeated_keys)
+        assert result.shape == expected.shape
+        assert ((result - expected).abs() < 1E-5).all()
@@ -41,3 +41,19 @@ def test_attention_projection(attention_projection_setup):
     assert to_np(module.get_attention_output(decoder_output)).sum() != 0
     assert module.get_attention_output(decoder_output) is module._attention_output
     assert_dims(module._attention_output, [2, params['input_size']])
+
+
+def test_attention_projection_caches_keys_projection(attention_projection_setup):
+    encoder_outputs, decoder_output, params = attention_projection_setup
+    module = to_gpu(AttentionProjection(**params))
+    module.reset(keys=encoder_outputs)
+    assert module.keys_projection is None
+    module(decoder_output)
+    keys_projection = module.keys_projection
+    assert_dims(keys_projection, [3, 2, params['att_nhid']])
+    # the keys projection is reused in the following steps
+    module(decoder_output)
+    assert module.keys_projection is keys_projection
+    # and it is cleared when the keys change
+    module.keys = encoder_outputs
+    assert module.keys_projection is None
@@ -18,3 +18,60 @@ def test_cell(cell_type, hidden_type):
     outputs, hidden = cell(inputs, hidden)
     assert (sl, bs, output_size) == outputs.shape
     assert isinstance(hidden, hidden_type)
+
+
+@pytest.mark.parametrize('cell_type', ["lstm", "gru"])
+@pytest.mark.parametrize('bidir', [False, True], ids=["unidir", "bidir"])
+def test_cell_packed(cell_type, bidir):
+    sl, bs, input_size, output_size = 8, 4, 12, 14
+    cell = to_gpu(Cell(cell_type, input_size, output_size, dropout=0.0, wdrop=0.0, bidir=bidir))
+    inputs = V(tr.rand(sl, bs, input_size))
+    lengths = to_gpu(tr.LongTensor([3, 8, 1, 5]))
+    outputs, hidden = cell(inputs, cell.hidden_state(bs), lengths=lengths)
+    assert (sl, bs, output_size * (2 if bidir else 1)) == outputs.shape
+    # every sequence gets the same results as when it is processed on its own without its padding
+    for row, length in enumerate(lengths.tolist()):
+        expected_outputs, expected_hidden = cell(inputs[:length, row:row + 1], cell.hidden_state(1))
+        assert ((outputs[:length, row:row + 1] - expected_outputs).abs() < 1e-5).all()
+        assert (outputs[length:, row] == 0).all()
+        hidden_row = hidden[0] if cell_type == "lstm" else hidden
+        expected_hidden = expected_hidden[0] if cell_type == "lstm" else expected_hidden
+        assert ((hidden_row[:, row:row + 1] - expected_hidden).abs() < 1e-5).all()
+
+
+@pytest.mark.parametrize('cell_type', ["lstm", "gru"])
+def test_cell_packed_empty_sequences(cell_type):
+    sl, bs, input_size, output_size = 6, 3, 12, 14
+    cell = to_gpu(Cell(cell_type, input_size, output_size, dropout=0.0, wdrop=0.0))
+    inputs = V(tr.rand(sl, bs, input_size))
+    initial = cell.hidden_state(bs)
+    initial = tuple(state + 1 for state in initial) if cell_type == "lstm" else initial + 1
+    lengths = to_gpu(tr.LongTensor([4, 0, 6]))
+    outputs, hidden = cell(inputs, initial, lengths=lengths)
+    # the empty sequence has zero outputs and keeps its initial state
+    assert (outputs[:, 1] == 0).all()
+    hidden_states = hidden if cell_type == "lstm" else (hidden,)
+    initial_states = initial if cell_type == "lstm" else (initial,)
+    for state, initial_state in zip(hidden_states, initial_states):
+        assert ((state[:, 1] - initial_state[:, 1]).abs() < 1e-6).all()
+    # all the sequences empty
+    outputs, hidden = cell(inputs, initial, lengths=to_gpu(tr.LongTensor([0, 0, 0])))
+    assert (sl, bs, output_size) == outputs.shape
+    assert (outputs == 0).all()
+
+
+def test_cell_packed_weight_drop():
+    cell = to_gpu(Cell("gru", 12, 14, dropout=0.0, wdrop=0.5))
+    # no weight dropout in eval mode, so the packed sequences get the same results as the padded ones
+    cell.eval()
+    inputs = V(tr.rand(4, 2, 12))
+    lengths = to_gpu(tr.LongTensor([4, 2]))
+    outputs, hidden = cell(inputs, cell.hidden_state(2), lengths=lengths)
+    for row, length in enumerate(lengths.tolist()):
+        expected_outputs, expected_hidden = cell(inputs[:length, row:row + 1], cell.hidden_state(1))
+        assert ((outputs[:length, row:row + 1] - expected_outputs).abs() < 1e-5).all()
+        assert ((hidden[:, row:row + 1] - expected_hidden).abs() < 1e-5).all()
+    # and the weights are dropped when training
+    cell.train()
+    outputs, hidden = cell(inputs, cell.hidden_state(2), lengths=lengths)
+    assert (4, 2, 14) == outputs.shape
@@ -1,5 +1,9 @@
+import numpy as np
 import pytest
-from fastai.core import V, to_gpu
+import torch as tr
+import torch.nn.functional as F
+from fastai.core import T, V, to_gpu, to_np
+from numpy.testing import assert_allclose
 from torch.optim import Adam
 
 from quicknlp.data.learners import cvae_loss
@@ -46,3 +50,30 @@ def test_cvae_encoder_decoder_model(model):
     enc_dec_model = CVAEModel(model)
     groups = enc_dec_model.get_layer_groups()
     assert len(groups) == 1
+
+
+def test_cvae_pack_sequences(hredmodel):
+    model = CVAE(ntoken=hredmodel.nt, nhid=64, nlayers=2, emb_sz=32, pad_token=hredmodel.pad_idx,
+                 eos_token=hredmodel.eos_idx, latent_dim=16, bow_nhid=40, pack_sequences=True)
+    model = to_gpu(model)
+    assert model.pack_sequences
+    *xs, y = next(iter(hredmodel.trn_dl))
+    output = model(*V(xs))
+    loss = cvae_loss(input=output[0], target=V(y), pad_idx=hredmodel.pad_idx)
+    loss.backward()
+
+
+def test_cvae_loss_bow():
+    slt, bs, vocab, latent_dim, pad_idx = 4, 3, 7, 2, 1
+    predictions = to_gpu(V(tr.rand(slt, bs, vocab)))
+    bow_logits = to_gpu(V(tr.rand(bs, vocab)))
+    mu, log_var = to_gpu(V(tr.zeros(bs, latent_dim))), to_gpu(V(tr.zeros(bs, latent_dim)))
+    targets = np.random.randint(2, vocab, size=(slt, bs))
+    targets[-1, 0] = pad_idx
+    targets = V(T(targets))
+    loss = cvae_loss([predictions, mu, log_var, mu, log_var, bow_logits], targets, pad_idx=pad_idx)
+    # the bag of words of every batch row scores all of its target tokens, with the kld being zero
+    bow_loss = F.cross_entropy(bow_logits.unsqueeze(0).repeat(slt, 1, 1).view(-1, vocab), targets.view(-1),
+                               ignore_index=pad_idx, reduce=False).mean()
+    expected = F.cross_entropy(predictions.view(-1, vocab), targets.view(-1), ignore_index=pad_idx) + bow_loss
+    assert_allclose(to_np(loss), to_np(expected), rtol=1e-5)
@@ -1,7 +1,11 @@
+import numpy as np
 import pandas as pd
+import pytest
+from numpy.testing import assert_array_equal
 from torchtext.data import Field
 
-from quicknlp.data import TabularDatasetFromFiles, TabularDatasetFromDataFrame
+from quicknlp.data import DialDataset, DialogueDataLoader, DialogueRandomSampler, DialogueSampler, HREDDataset, \
+    TabularDatasetFromDataFrame, TabularDatasetFromFiles
 
 
 def test_TabularDatasetFromFiles(s2smodel_data):
@@ -41,3 +45,65 @@ def test_TabularDatasetFromDataFrame(s2smodel_data):
         assert "english" in example_vars
         assert "french" in example_vars
         assert "german" in example_vars
+
+
+def test_DialDataset():
+    context = [[[5, 6, 7], [8]], [[9, 10]]]
+    response = [[11, 12], [13]]
+    ds = DialDataset(context=context, response=response, pad=1, backwards=True, sos=2, eos=3)
+    assert 2 == len(ds)
+    x, y = ds[0]
+    assert_array_equal(x, [[2, 7, 6, 5, 3], [2, 8, 3, 1, 1]])
+    assert_array_equal(y, [2, 11, 12, 3])
+    x, y = ds[1]
+    assert_array_equal(x, [[2, 10, 9, 3]])
+    assert_array_equal(y, [2, 13, 3])
+
+
+def test_HREDDataset():
+    x = [np.array([[4, 5, 6], [7, 8, 1]]), np.array([9, 10])]
+    y = [np.array([0, 11, 12]), np.array([0, 13])]
+    ds = HREDDataset(x, y)
+    assert 2 == len(ds)
+    context, response, target = ds[0]
+    assert_array_equal(context, x[0])
+    assert_array_equal(response, y[0])
+    # the target is the response shifted by one step and ending with eos
+    assert_array_equal(target, [11, 12, 2])
+    context, response, target = ds[1]
+    assert_array_equal(context, [[9, 10]])
+    assert_array_equal(target, [13, 2])
+
+
+@pytest.mark.parametrize('pre_pad', [True, False], ids=["pre_pad", "post_pad"])
+def test_DialogueDataLoader_get_batch(pre_pad):
+    x = [np.array([[4, 5, 6], [7, 8, 9]]), np.array([10, 11])]
+    y = [np.array([0, 12, 13]), np.array([0, 14])]
+    dl = DialogueDataLoader(HREDDataset(x, y), batch_size=2, pad_idx=1, pre_pad=pre_pad, transpose=True,
+                            transpose_y=True)
+    x_batch, y_batch, y_target = dl.get_batch([0, 1])
+    # dims [cl, sl, bs] for the contexts and [sl, bs] for the responses and targets
+    assert x_batch.shape == (2, 3, 2)
+    assert_array_equal(x_batch[..., 0], x[0])
+    if pre_pad:
+        assert_array_equal(x_batch[..., 1], [[1, 1, 1], [1, 10, 11]])
+        assert_array_equal(y_batch.T, [[0, 12, 13], [1, 0, 14]])
+        assert_array_equal(y_target.T, [[12, 13, 2], [1, 14, 2]])
+    else:
+        assert_array_equal(x_batch[..., 1], [[10, 11, 1], [1, 1, 1]])
+        assert_array_equal(y_batch.T, [[0, 12, 13], [0, 14, 1]])
+        assert_array_equal(y_target.T, [[12, 13, 2], [14, 2, 1]])
+
+
+def test_DialogueSampler():
+    context = [[[5, 6]], [[5, 6, 7], [8]], [[9]], [[9, 10, 11, 12]], [[5], [6, 7]]]
+    ds = DialDataset(context=context, response=[[11]] * 5, pad=1)
+    assert_array_equal(ds.context_shapes(), [[1, 2], [2, 3], [1, 1], [1, 4], [2, 2]])
+    # by conversation length then utterance length in descending order
+    assert [1, 4, 3, 0, 2] == list(DialogueSampler(ds))
+
+    sampler = DialogueRandomSampler(ds, bs=2)
+    idxs = list(sampler)
+    assert sorted(idxs) == list(range(len(ds)))
+    # the batch with the largest sample goes first
+    assert 1 in idxs[:2]
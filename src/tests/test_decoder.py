@@ -5,8 +5,10 @@ import pytest
 from fastai.core import T, V, to_gpu, to_np
 from numpy.testing import assert_allclose
 
+from quicknlp.data.model_helpers import set_inference
 from quicknlp.modules import AttentionDecoder, AttentionProjection, Projection, RNNLayers, TransformerDecoderLayers
-from quicknlp.modules.basic_decoder import Decoder, TransformerDecoder, reshape_parent_indices, select_hidden_by_index
+from quicknlp.modules.basic_decoder import Decoder, TransformerDecoder, backtrack, expand_beams, \
+    reshape_parent_indices, select_hidden_by_index
 from quicknlp.modules.embeddings import DropoutEmbeddings, TransformerEmbeddings
 from quicknlp.utils import assert_dims
 
@@ -98,6 +100,17 @@ def test_select_hidden_by_index():
     assert_allclose(actual=to_np(results[0]).ravel(), desired=expected)
 
 
+def test_backtrack():
+    # given the tokens of every step for 3 rows
+    tokens = np.array([[0, 0, 0], [5, 6, 7], [8, 9, 10]])
+    # and the row every row continued from in every step
+    parents = np.array([[0, 0, 1], [2, 0, 0]])
+    results = backtrack(to_gpu(T(tokens)), to_gpu(T(parents)))
+    # then I get the sequence that ends in every row
+    expected = np.array([[0, 0, 0], [7, 5, 5], [8, 9, 10]])
+    assert_allclose(actual=to_np(results), desired=expected)
+
+
 @pytest.fixture()
 def decoder_inputs(decoder_params):
     batch_size = decoder_params.batch_size
@@ -170,3 +183,144 @@ def test_transformer_decoder(num_beams, decoder_inputs_transformer):
     else:
         assert_dims(outputs, [nlayers, None, batch_size, (emb_size, ntokens)])
         assert decoder.beam_outputs is None
+
+
+@pytest.mark.parametrize("num_beams", [1, 2], ids=["greedy", "beam_search"])
+def test_transformer_decoder_incremental(num_beams, decoder_inputs_transformer):
+    batch_size, emb_size, nlayers, sl, vin, ven = decoder_inputs_transformer
+    ntokens, nhid, max_tokens = 10, 2, 20
+    embedding = TransformerEmbeddings(ntokens=ntokens, emb_size=emb_size, dropout=0.0, pad_token=1)
+    encoder = TransformerDecoderLayers(nlayers=nlayers, input_size=emb_size, num_heads=2, nhid=emb_size, dropout=0.0)
+    projection_layer = Projection(output_size=ntokens, input_size=emb_size, tie_encoder=None, dropout=0.0)
+    decoder = TransformerDecoder(decoder_layer=encoder, projection_layer=projection_layer, pad_token=1, eos_token=2,
+                                 max_tokens=max_tokens, embedding_layer=embedding, incremental=False)
+    decoder = to_gpu(decoder).eval()
+    decoder(vin, ven, num_beams=num_beams)
+    expected = to_np(decoder.beam_outputs)
+    decoder.incremental = True
+    decoder(vin, ven, num_beams=num_beams)
+    assert_allclose(to_np(decoder.beam_outputs), expected)
+
+
+@pytest.mark.parametrize("batch_size", [1, 3])
+def test_transformer_decoder_step_forward(batch_size):
+    ntokens, emb_size, nlayers, sl, enc_sl = 10, 12, 2, 4, 3
+    embedding = TransformerEmbeddings(ntokens=ntokens, emb_size=emb_size, dropout=0.0, pad_token=1)
+    encoder = TransformerDecoderLayers(nlayers=nlayers, input_size=emb_size, num_heads=2, nhid=emb_size, dropout=0.0)
+    projection_layer = Projection(output_size=ntokens, input_size=emb_size, tie_encoder=None, dropout=0.0)
+    decoder = TransformerDecoder(decoder_layer=encoder, projection_layer=projection_layer, pad_token=1, eos_token=2,
+                                 max_tokens=10, embedding_layer=embedding)
+    decoder = to_gpu(decoder).eval()
+    inputs = to_gpu(V(T(np.random.randint(2, ntokens, size=(sl, batch_size)))))
+    enc_inputs = to_gpu(V(T(np.random.rand(nlayers, enc_sl, batch_size, emb_size))))
+    expected = decoder._train_forward(inputs, hidden=enc_inputs)[-1]
+    decoder.decoder_layer.reset(batch_size)
+    for step in range(sl):
+        # every step gets the output of the whole prefix, at the position of the step
+        output = decoder._step_forward(inputs[:step + 1], hidden=enc_inputs)[-1]
+        assert_allclose(to_np(output[-1]), to_np(expected[step]), rtol=1e-4, atol=1e-5)
+
+
+def test_rnn_decoder_compact_finished(rnn_decoder, decoder_inputs):
+    dec_ins, keys = decoder_inputs
+    decoder, params = rnn_decoder
+    if params.num_beams == 0:
+        pytest.skip("compaction is only used in greedy and beam search")
+    decoder.eval()
+    results = []
+    for compact in [False, True]:
+        decoder.compact_finished = compact
+        decoder.reset(params.batch_size)
+        decoder.projection_layer.keys = keys
+        outputs = decoder(dec_ins, hidden=decoder.hidden, num_beams=params.num_beams)
+        assert_dims(outputs, [params.nlayers, None, params.num_beams * params.batch_size,
+                              (params.nhid, params.ntokens)])
+        results.append(to_np(decoder.beam_outputs))
+    decoder.train()
+    expected, actual = results
+    assert expected.shape == actual.shape
+    # the tokens after the eos of the finished rows are not decoded anymore
+    for row_expected, row_actual in zip(expected.reshape(expected.shape[0], -1).T,
+                                        actual.reshape(actual.shape[0], -1).T):
+        eos = np.nonzero(row_expected == decoder.eos_token)[0]
+        length = eos[0] + 1 if eos.size > 0 else row_expected.size
+        assert_allclose(row_actual[:length], row_expected[:length])
+
+
+def test_topk_beams():
+    bs, num_beams, ntokens, pad_token = 2, 3, 6, 0
+    decoder = Decoder(decoder_layer=RNNLayers(input_size=4, output_size=4, nhid=4, nlayers=1, cell_type="gru"),
+                      projection_layer=None, max_tokens=5, eos_token=1, pad_token=pad_token,
+                      embedding_layer=DropoutEmbeddings(ntokens=ntokens, emb_size=4))
+    new_logprobs = np.log(np.random.dirichlet(np.ones(ntokens), size=(1, bs * num_beams)))
+    logprobs = np.log(np.random.rand(1, bs, num_beams))
+    finished = np.array([0, 1, 0, 1, 1, 0], dtype=np.uint8)
+    results = decoder.topk_beams(V(T(new_logprobs)).float(), V(T(logprobs)).float(), to_gpu(T(finished)),
+                                 iteration=1, num_beams=num_beams)
+    actual_logprobs, actual_parents, actual_tokens = [to_np(result) for result in results]
+    # the top continuations over all the tokens of all the beams, finished beams can only add the pad token
+    scores = new_logprobs.reshape(bs, num_beams, ntokens) + logprobs.reshape(bs, num_beams, 1)
+    scores[finished.reshape(bs, num_beams) == 1] = -1e32
+    scores[..., pad_token][finished.reshape(bs, num_beams) == 1] = logprobs.reshape(bs, num_beams)[
+        finished.reshape(bs, num_beams) == 1]
+    expected = np.sort(scores.reshape(bs, -1), axis=-1)[:, ::-1][:, :num_beams]
+    assert_allclose(actual_logprobs.reshape(bs, num_beams), expected, rtol=1e-5)
+    for row in range(bs):
+        for beam in range(num_beams):
+            parent, token = actual_parents[0, row, beam], actual_tokens[0, row, beam]
+            assert abs(scores[row, parent, token] - actual_logprobs[0, row, beam]) < 1e-5
+
+
+def test_rnn_decoder_inference(rnn_decoder, decoder_inputs):
+    dec_ins, keys = decoder_inputs
+    decoder, params = rnn_decoder
+    if params.num_beams == 0:
+        pytest.skip("inference is only used in greedy and beam search")
+    decoder.eval()
+    decoder.reset(params.batch_size)
+    decoder.projection_layer.keys = keys
+    decoder(dec_ins, hidden=decoder.hidden, num_beams=params.num_beams)
+    expected = to_np(decoder.beam_outputs)
+    decoder.reset(params.batch_size)
+    decoder.projection_layer.keys = keys
+    tokens, scores = decoder(dec_ins, hidden=decoder.hidden, num_beams=params.num_beams, inference=True)
+    decoder.train()
+    # only the tokens and their scores are returned
+    assert_allclose(to_np(tokens), expected)
+    assert_dims(scores, [params.batch_size, params.num_beams])
+    assert (to_np(scores) <= 0).all()
+
+
+def test_set_inference_restores_previous_mode(rnn_decoder):
+    decoder, params = rnn_decoder
+    decoder.inference = True
+    previous = set_inference(decoder, False)
+    assert not decoder.inference
+    # the mode the decoder had before can be restored
+    set_inference(decoder, previous)
+    assert decoder.inference
+    decoder.inference = False
+
+
+def test_expand_beams():
+    # when I expand a state [1, bs=2, 1] for 3 beams
+    state = V(T(np.array([2, 3]).reshape(1, 2, 1)))
+    results = expand_beams(state, num_beams=3)
+    # then the beams of every batch row are next to each other
+    assert_allclose(actual=to_np(results).ravel(), desired=np.array([2, 2, 2, 3, 3, 3]))
+
+
+def test_rnn_decoder_scheduled_sampling(rnn_decoder):
+    decoder, params = rnn_decoder
+    sl = 5
+    dec_ins = V(T(np.random.randint(0, params.ntokens, size=(sl, params.batch_size))))
+    decoder.train()
+    decoder.pr_force = 0.5
+    decoder.reset(params.batch_size)
+    decoder.projection_layer.keys = V(T(np.random.rand(1, params.batch_size, params.emb_size)))
+    outputs = decoder(dec_ins, hidden=decoder.hidden, num_beams=1)
+    decoder.pr_force = 0.0
+    # the parallel passes return an output for every target step
+    expected_sl = sl if decoder.parallel_sampling else None
+    assert_dims(outputs, [params.nlayers, expected_sl, params.batch_size, (params.nhid, params.ntokens)])
+    assert_dims(decoder.beam_outputs, [None, params.batch_size, 1])
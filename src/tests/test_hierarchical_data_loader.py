@@ -1,3 +1,5 @@
+import pytest
+
 from quicknlp.data.torchtext_data_loaders import HierarchicalDataLoader
 
 
@@ -15,3 +17,32 @@ def test_hierarchical_data_loader(hierarchical_dataset):
         # and I expect the features to be 2D [sequence_length, bs] for response and targets
         assert len(batch[1].shape) == 2
         assert len(batch[2].shape) == 2
+
+
+def test_hierarchical_data_loader_max_tokens(hierarchical_dataset):
+    ds, field = hierarchical_dataset
+    field.build_vocab(ds)
+    max_tokens = 60
+    dl = HierarchicalDataLoader(ds, batch_size=2, target_names=["__role2__"], max_tokens=max_tokens,
+                                whole_dialogue=True, repeat=False)
+    num_dialogues, num_batches = 0, 0
+    for context, response, targets in dl:
+        # every batch has up to max_tokens tokens (bs x cl x sl) without the init and eos tokens
+        cl, sl, bs = response.shape
+        assert bs == 1 or bs * cl * (sl - 2) <= max_tokens
+        num_dialogues += bs
+        num_batches += 1
+    # no dialogue is skipped
+    assert len(ds) == num_dialogues
+    # the iterator does not repeat, so len has to be the number of batches it yields
+    assert len(dl) == num_batches
+
+
+@pytest.mark.parametrize("target_names", [None, ["__role2__"]])
+def test_hierarchical_data_loader_max_tokens_per_turn(hierarchical_dataset, target_names):
+    ds, field = hierarchical_dataset
+    field.build_vocab(ds)
+    dl = HierarchicalDataLoader(ds, batch_size=2, target_names=target_names, max_tokens=60, repeat=False)
+    # one batch is yielded for every turn with targets
+    num_batches = sum(1 for _ in dl)
+    assert len(dl) == num_batches
@@ -1,11 +1,12 @@
 import pytest
-from fastai.core import V, to_gpu
+from fastai.core import V, to_gpu, to_np
+from numpy.testing import assert_allclose
 from torch.optim import Adam
 
 from quicknlp.data.learners import decoder_loss
 from quicknlp.data.model_helpers import HREDModel
 from quicknlp.models import HRED
-from quicknlp.utils import get_trainable_parameters
+from quicknlp.utils import assert_dims, get_trainable_parameters
 
 params = [(True), (False)]
 ids = ["bidir", "unidir"]
@@ -46,3 +47,38 @@ def test_hred_encoder_decoder_model(model):
     enc_dec_model = HREDModel(model)
     groups = enc_dec_model.get_layer_groups()
     assert len(groups) == 1
+
+
+def test_hred_whole_dialogue(model, hredmodel):
+    *xs, y = next(iter(hredmodel.trn_dl))
+    context, response = V(xs)
+    cl, _, bs = context.size()
+    # the responses of all the turns of the dialogues, with a first turn without a response
+    responses = response.data.unsqueeze(0).repeat(cl, 1, 1)
+    responses[0] = hredmodel.pad_idx
+    responses = V(responses)
+    output = model(context, responses)
+    # the turns without a response are not decoded
+    assert output[0].size(1) == (cl - 1) * bs
+    targets = responses[1:, 1:].permute(1, 0, 2).contiguous().view(responses.size(1) - 1, -1)
+    loss = decoder_loss(input=output[0], target=targets, pad_idx=hredmodel.pad_idx)
+    loss.backward()
+
+
+def test_hred_session(model, hredmodel):
+    *xs, y = next(iter(hredmodel.trn_dl))
+    context, response = V(xs)
+    cl, _, bs = context.size()
+    model.eval()
+    # when I encode the utterances of the conversations one at a time
+    session = None
+    for utterance in context:
+        session = model.encode_utterance(utterance, session=session)
+    # then the session is the same as encoding the whole context
+    model.reset_encoders(bs)
+    model.se_enc(model.query_level_encoding(context))
+    assert_allclose(session["session_hidden"][-1], to_np(model.se_enc.hidden[-1]), rtol=1e-4, atol=1e-5)
+    # and I can decode the responses from the session
+    predictions = model.decode_session(session, response[:1], num_beams=1)
+    assert_dims(predictions, [None, bs, 1])
+    model.train()
@@ -1,6 +1,8 @@
+from types import SimpleNamespace
+
 import pytest
 
-from quicknlp.data.iterators import HierarchicalIterator
+from quicknlp.data.iterators import HierarchicalIterator, numericalize_dialogues, pad_dialogues
 from quicknlp.utils import assert_dims
 
 
@@ -63,3 +65,82 @@ def test_hierarchical_iterator(hiterator):
     assert_dims(batch.response, [None, batch.batch_size])
     assert_dims(batch.targets, [None, batch.batch_size])
     assert (batch.response[1:] == batch.targets).all()
+
+
+def test_hierarchical_iterator_whole_dialogue(hierarchical_dataset):
+    ds, field = hierarchical_dataset
+    field.build_vocab(ds)
+    iterator = HierarchicalIterator(ds, batch_size=2, sort_key=lambda x: len(x.roles), whole_dialogue=True)
+    batch = next(iter(iterator))
+    cl, sl, bs = batch.context.size()
+    # every batch has all the turns of the dialogues
+    assert_dims(batch.response, [cl, sl, bs])
+    # and the targets of all the turns with a response are flattened
+    responses = batch.response.permute(1, 0, 2).contiguous().view(sl, -1)
+    turns = ((responses != field.vocab.stoi[field.pad_token]).sum(dim=0) > 0).nonzero().view(-1)
+    assert_dims(batch.targets, [sl - 1, turns.numel()])
+    assert (responses[1:].index_select(1, turns) == batch.targets).all()
+
+
+def test_hierarchical_iterator_whole_dialogue_max_context_size(hierarchical_dataset):
+    ds, field = hierarchical_dataset
+    field.build_vocab(ds)
+    iterator = HierarchicalIterator(ds, batch_size=2, sort_key=lambda x: len(x.roles), whole_dialogue=True,
+                                    max_context_size=None, train=False)
+    expected = [(batch.context, batch.response) for batch in iterator]
+    # the contexts that are too large keep their last turns instead of being skipped
+    iterator = HierarchicalIterator(ds, batch_size=2, sort_key=lambda x: len(x.roles), whole_dialogue=True,
+                                    max_context_size=60, train=False)
+    batches = list(iterator)
+    assert len(expected) == len(batches)
+    for (context, response), batch in zip(expected, batches):
+        cl, sl, bs = batch.context.size()
+        assert cl == 1 or cl * sl * bs <= 60
+        assert (context[-cl:] == batch.context).all()
+        assert (response[-cl:] == batch.response).all()
+
+
+def test_hierarchical_iterator_numericalized(hiterator):
+    iterator, field = hiterator
+    bs = 2
+    minibatch = iterator.dataset[:bs]
+    cl = max([len(ex.roles) for ex in minibatch])
+    sl = max([sl for ex in minibatch for sl in ex.sl])
+    x0, x1, y = iterator.process_minibatch(minibatch)
+    # the same as padding the token strings with the field and numericalizing them
+    for row, example in enumerate(minibatch):
+        padded, *_ = iterator.pad(example, max_sl=sl, max_conv=cl, field=field)
+        field.include_lengths = False
+        expected = field.numericalize(padded, device=-1, train=False).t()
+        assert (x0[:, :, row].cpu() == expected[:-1]).all()
+        assert (x1[:, :, row].cpu() == expected[1:]).all()
+
+
+@pytest.mark.parametrize("target_roles", [None, ["__role2__"]])
+def test_hierarchical_iterator_padded_lengths(hierarchical_dataset, target_roles):
+    ds, field = hierarchical_dataset
+    field.build_vocab(ds)
+    iterator = HierarchicalIterator(ds, batch_size=2, sort_key=lambda x: len(x.roles), target_roles=target_roles,
+                                    max_tokens=60)
+    # the batches are made of dialogues sorted by their shape
+    shapes = [(len(ex.roles), max(ex.sl)) for minibatch in iterator.token_batches for ex in minibatch]
+    assert shapes == sorted(shapes)
+    minibatch = ds.examples[:3]
+    cl = max([len(ex.roles) for ex in minibatch])
+    sl = max([sl for ex in minibatch for sl in ex.sl])
+    # the lengths are the ones of the padded dialogues
+    padded = pad_dialogues(minibatch, max_sl=sl, max_conv=cl, field=field, target_roles=target_roles)
+    expected = (padded != field.vocab.stoi[field.pad_token]).sum(axis=1)
+    assert (iterator.padded_lengths(minibatch, max_sl=sl, max_conv=cl) == expected).all()
+
+
+def test_numericalize_dialogues_new_vocab():
+    example = SimpleNamespace(text=["hi", "there", "bye"], sl=[2, 1])
+    field = SimpleNamespace(vocab=SimpleNamespace(stoi={"hi": 2, "there": 3, "bye": 4}))
+    numericalize_dialogues([example], field)
+    assert [2, 3, 4] == example.ids.tolist()
+    assert [0, 2, 3] == list(example.offsets)
+    # the examples are numericalized again with a new vocab
+    field.vocab = SimpleNamespace(stoi={"hi": 5, "there": 6, "bye": 7})
+    numericalize_dialogues([example], field)
+    assert [5, 6, 7] == example.ids.tolist()
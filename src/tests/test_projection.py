@@ -0,0 +1,123 @@
+import numpy as np
+import pytest
+import torch as tr
+from fastai.core import T, V, to_gpu, to_np
+from numpy.testing import assert_allclose
+
+from quicknlp.data.learners import decoder_loss, decoder_loss_smoothed
+from quicknlp.modules import AdaptiveProjection, Decoder, Projection, RNNLayers
+from quicknlp.modules.embeddings import DropoutEmbeddings
+from quicknlp.utils import assert_dims
+
+
+@pytest.mark.parametrize('nhid', [None, 12], ids=["no_hidden", "hidden"])
+def test_adaptive_projection(nhid):
+    sl, bs, input_size, ntokens, pad_idx = 5, 4, 8, 20, 1
+    projection = to_gpu(AdaptiveProjection(output_size=ntokens, input_size=input_size, dropout=0.0, cutoffs=[4, 10],
+                                           nhid=nhid))
+    inputs = to_gpu(V(tr.rand(sl, bs, input_size)))
+    logprobs = projection(inputs)
+    assert_dims(logprobs, [sl, bs, ntokens])
+    # the log probabilities of the whole vocabulary
+    assert_allclose(to_np(logprobs.exp().sum(dim=-1)), np.ones((sl, bs)), rtol=1e-5)
+    targets = np.random.randint(0, ntokens, size=(sl, bs))
+    targets[-1] = pad_idx
+    targets = V(T(targets))
+    loss = projection.loss(inputs, targets, pad_idx=pad_idx)
+    expected = decoder_loss(logprobs, targets, pad_idx=pad_idx)
+    assert_allclose(to_np(loss), to_np(expected), rtol=1e-5)
+
+
+def test_decoder_deferred_projection():
+    sl, bs, emb_size, ntokens = 6, 3, 10, 15
+    decoder = Decoder(decoder_layer=RNNLayers(input_size=emb_size, output_size=emb_size, nhid=16, nlayers=2,
+                                              cell_type="gru"),
+                      projection_layer=Projection(output_size=ntokens, input_size=emb_size, dropout=0.0),
+                      embedding_layer=DropoutEmbeddings(ntokens=ntokens, emb_size=emb_size),
+                      pad_token=0, eos_token=1, max_tokens=10)
+    decoder = to_gpu(decoder)
+    decoder.deferred_projection = True
+    decoder.train()
+    inputs = V(T(np.random.randint(2, ntokens, size=(sl, bs))))
+    decoder.reset(bs)
+    outputs = decoder(inputs, hidden=decoder.hidden, num_beams=0)
+    # the last output is the input of the projection layer
+    assert_dims(outputs[-1], [sl, bs, emb_size])
+    targets = inputs[1:]
+    loss = decoder_loss(outputs[-1], targets, pad_idx=0, projection=decoder.projection_layer)
+    expected = decoder_loss(decoder.projection_layer(outputs[-1]), targets, pad_idx=0)
+    assert_allclose(to_np(loss), to_np(expected), rtol=1e-5)
+    # in eval mode the outputs are projected as usual
+    decoder.eval()
+    decoder.reset(bs)
+    outputs = decoder(inputs, hidden=decoder.hidden, num_beams=0)
+    assert_dims(outputs[-1], [sl, bs, ntokens])
+
+
+def test_decoder_deferred_projection_needs_parallel_sampling():
+    ntokens, emb_size = 15, 10
+    decoder = Decoder(decoder_layer=RNNLayers(input_size=emb_size, output_size=emb_size, nhid=16, nlayers=1,
+                                              cell_type="gru"),
+                      projection_layer=Projection(output_size=ntokens, input_size=emb_size, dropout=0.0),
+                      embedding_layer=DropoutEmbeddings(ntokens=ntokens, emb_size=emb_size),
+                      pad_token=0, eos_token=1, max_tokens=10)
+    decoder.parallel_sampling = False
+    with pytest.raises(ValueError):
+        decoder.deferred_projection = True
+    decoder.parallel_sampling = True
+    decoder.deferred_projection = True
+    # the step by step scheduled sampling cannot be turned on once the projection is deferred
+    with pytest.raises(ValueError):
+        decoder.parallel_sampling = False
+
+
+@pytest.mark.parametrize('nhid', [None, 12], ids=["no_hidden", "hidden"])
+def test_projection_chunked_loss(nhid):
+    sl, bs, input_size, ntokens, pad_idx = 7, 3, 8, 20, 1
+    projection = to_gpu(Projection(output_size=ntokens, input_size=input_size, dropout=0.0, nhid=nhid))
+    projection.loss_chunk_size = 2
+    inputs = to_gpu(V(tr.rand(sl, bs, input_size), requires_grad=True))
+    targets = np.random.randint(0, ntokens, size=(sl, bs))
+    targets[-2:, 0] = pad_idx
+    targets = V(T(targets))
+
+    loss = projection.loss(inputs, targets, pad_idx=pad_idx)
+    loss.backward()
+    grads = [to_np(inputs.grad)] + [to_np(param.grad) for param in projection.parameters()]
+    inputs.grad = None
+    projection.zero_grad()
+
+    # the same loss and gradients as the cross entropy of the full scores
+    expected = decoder_loss(projection(inputs), targets, pad_idx=pad_idx)
+    expected.backward()
+    expected_grads = [to_np(inputs.grad)] + [to_np(param.grad) for param in projection.parameters()]
+    assert_allclose(to_np(loss), to_np(expected), rtol=1e-5)
+    for grad, expected_grad in zip(grads, expected_grads):
+        assert_allclose(grad, expected_grad, rtol=1e-4, atol=1e-6)
+
+
+def test_decoder_loss_short_input():
+    sl_in, sl, bs, ntokens, pad_idx = 3, 5, 2, 6, 1
+    inputs = to_gpu(V(tr.rand(sl_in, bs, ntokens)))
+    targets = V(T(np.random.randint(2, ntokens, size=(sl, bs))))
+    loss = decoder_loss(inputs, targets, pad_idx=pad_idx)
+    # the missing steps are scored as if the input was padded with zeros
+    padded = tr.cat([inputs, to_gpu(V(tr.zeros(sl - sl_in, bs, ntokens)))], dim=0)
+    expected = decoder_loss(padded, targets, pad_idx=pad_idx)
+    assert_allclose(to_np(loss), to_np(expected), rtol=1e-5)
+
+
+def test_decoder_loss_smoothed():
+    sl, bs, ntokens, pad_idx, smoothing_factor = 5, 3, 6, 1, 0.8
+    inputs = np.random.rand(sl, bs, ntokens)
+    targets = np.random.randint(2, ntokens, size=(sl, bs))
+    targets[-2:, 0] = pad_idx
+    loss = decoder_loss_smoothed(to_gpu(V(T(inputs))), V(T(targets)), pad_idx=pad_idx,
+                                 smoothing_factor=smoothing_factor)
+    # the cross entropy with the smoothed target distributions
+    logprobs = inputs - np.log(np.exp(inputs).sum(axis=-1, keepdims=True))
+    smoothed = np.full_like(inputs, (1 - smoothing_factor) / (ntokens - 1))
+    np.put_along_axis(smoothed, targets[..., None], smoothing_factor, axis=-1)
+    not_pad = targets != pad_idx
+    expected = -(smoothed * logprobs).sum(axis=-1)[not_pad].mean()
+    assert_allclose(to_np(loss), expected, rtol=1e-5)
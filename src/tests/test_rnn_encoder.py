@@ -1,6 +1,8 @@
 import numpy as np
+import pytest
 from fastai.core import T, V, to_gpu, to_np
 
+from quicknlp.data.model_helpers import freeze_for_inference
 from quicknlp.modules import RNNLayers
 from quicknlp.modules.basic_encoder import Encoder
 from quicknlp.modules.embeddings import DropoutEmbeddings
@@ -70,3 +72,75 @@ def test_BiRNNEncoder():
         c_new = to_np(layer[0])
         assert ~np.allclose(hl, h_new)
         assert ~np.allclose(cl, c_new)
+
+
+@pytest.mark.parametrize('cell_type', ["lstm", "gru"])
+@pytest.mark.parametrize('bidir', [False, True], ids=["unidir", "bidir"])
+def test_encoder_freeze_for_inference(cell_type, bidir):
+    ntoken, emb_sz, nhid, nlayers, sl, bs = 10, 4, 6, 3, 5, 3
+    embedding = DropoutEmbeddings(ntokens=ntoken, emb_size=emb_sz, pad_token=0, dropouti=0.3, dropoute=0.1)
+    rnn_layers = RNNLayers(input_size=emb_sz, nhid=nhid, nlayers=nlayers, output_size=emb_sz * 2, dropouth=0.3,
+                           wdrop=0.5, bidir=bidir, cell_type=cell_type)
+    encoder = to_gpu(Encoder(embedding_layer=embedding, encoder_layer=rnn_layers)).eval()
+    inputs = V(T(np.random.randint(1, ntoken, sl * bs).reshape(sl, bs)))
+    encoder.reset(bs)
+    expected_outputs = encoder(inputs)
+    expected_hidden = encoder.hidden
+
+    # the first two layers have the same output size so they are stacked
+    freeze_for_inference(encoder)
+    assert [[0, 1], [2]] == rnn_layers.layer_groups
+    encoder.reset(bs)
+    outputs = encoder(inputs)
+    assert_dims(outputs, [nlayers, sl, bs, None])
+    np.testing.assert_allclose(to_np(outputs[-1]), to_np(expected_outputs[-1]), rtol=1e-5, atol=1e-6)
+    for layer_hidden, layer_expected_hidden in zip(encoder.hidden, expected_hidden):
+        if cell_type == "lstm":
+            np.testing.assert_allclose(to_np(layer_hidden[0]), to_np(layer_expected_hidden[0]), rtol=1e-5, atol=1e-6)
+            np.testing.assert_allclose(to_np(layer_hidden[1]), to_np(layer_expected_hidden[1]), rtol=1e-5, atol=1e-6)
+        else:
+            np.testing.assert_allclose(to_np(layer_hidden), to_np(layer_expected_hidden), rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize('cell_type', ["lstm", "gru"])
+def test_encoder_freeze_for_inference_state_dict(cell_type):
+    ntoken, emb_sz, nhid, nlayers, sl, bs = 10, 4, 6, 3, 5, 3
+
+    def get_encoder():
+        embedding = DropoutEmbeddings(ntokens=ntoken, emb_size=emb_sz, pad_token=0, dropouti=0.3, dropoute=0.1)
+        rnn_layers = RNNLayers(input_size=emb_sz, nhid=nhid, nlayers=nlayers, output_size=emb_sz * 2, dropouth=0.3,
+                               wdrop=0.5, cell_type=cell_type)
+        return to_gpu(Encoder(embedding_layer=embedding, encoder_layer=rnn_layers)).eval()
+
+    frozen = freeze_for_inference(get_encoder())
+    not_frozen = get_encoder()
+    # the frozen and stacked encoder has the same state_dict keys
+    assert set(frozen.state_dict().keys()) == set(not_frozen.state_dict().keys())
+    not_frozen.load_state_dict(frozen.state_dict())
+    # and a frozen encoder loads the state of a not frozen one
+    other_frozen = freeze_for_inference(get_encoder())
+    other_frozen.load_state_dict(not_frozen.state_dict())
+    inputs = V(T(np.random.randint(1, ntoken, sl * bs).reshape(sl, bs)))
+    results = []
+    for encoder in [frozen, not_frozen, other_frozen]:
+        encoder.reset(bs)
+        results.append(to_np(encoder(inputs)[-1]))
+    np.testing.assert_allclose(results[1], results[0], rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(results[2], results[0], rtol=1e-5, atol=1e-6)
+
+
+def test_embedding_dropout():
+    ntoken, emb_sz, sl, bs = 10, 4, 6, 5
+    embedding = to_gpu(DropoutEmbeddings(ntokens=ntoken, emb_size=emb_sz, pad_token=0, dropouti=0.0, dropoute=0.5))
+    embedding.train()
+    inputs = np.random.randint(1, ntoken, sl * bs).reshape(sl, bs)
+    outputs = to_np(embedding(V(T(inputs))))
+    assert (sl, bs, emb_sz) == outputs.shape
+    weight = to_np(embedding.weight)
+    for token in np.unique(inputs):
+        token_outputs = outputs[inputs == token]
+        # every occurrence of a token is either dropped or scaled by 1 / (1 - dropout)
+        if token_outputs[0].any():
+            np.testing.assert_allclose(token_outputs, np.tile(weight[token] * 2, (len(token_outputs), 1)), rtol=1e-5)
+        else:
+            assert not token_outputs.any()
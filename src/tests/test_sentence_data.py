@@ -35,6 +35,30 @@ def test_S2SModelLoader(s2smodel_data):
     assert len(ml) == index + 1
 
 
+def test_S2SModelLoader_max_tokens(s2smodel_data):
+    path, train, valid, test = s2smodel_data
+    fields = [
+        ("english", Field(init_token="__init__", eos_token="__eos__", lower=True)),
+        ("french", Field(init_token="__init__", eos_token="__eos__", lower=True)),
+    ]
+    ds = TabularDatasetFromFiles(path=path / train, fields=fields)
+    for name, field in fields:
+        field.build_vocab(ds)
+    max_tokens = 16
+    ml = S2SDataLoader(dataset=ds, batch_size=2, source_names=["english"], target_names=["french"],
+                       max_tokens=max_tokens, repeat=False)
+    num_examples, num_batches = 0, 0
+    for X, Y in ml:
+        # every batch has up to max_tokens tokens without the init and eos tokens
+        assert (X.shape[0] - 2) * X.shape[1] <= max_tokens
+        assert (Y.shape[0] - 1) * Y.shape[1] <= max_tokens
+        num_examples += X.shape[1]
+        num_batches += 1
+    assert len(ds) == num_examples
+    # the iterator does not repeat, so len has to be the number of batches it yields
+    assert len(ml) == num_batches
+
+
 @pytest.fixture(params=HAVE_TEST, ids=HAVE_TEST_IDS)
 def generalmodel(s2smodel_data, request):
     fields = [
@@ -53,3 +53,12 @@ def test_seq2seq_encoder_decoder_model(model):
     enc_dec_model = S2SModel(model)
     groups = enc_dec_model.get_layer_groups()
     assert len(groups) == 2
+
+
+def test_seq2seq_adaptive_projection_tied():
+    kwargs = dict(ntoken=[20, 30], nhid=16, nlayers=1, emb_sz=8, pad_token=1, eos_token=2, adaptive_cutoffs=[10])
+    # the adaptive projection cannot be tied to the decoder embeddings
+    with pytest.raises(ValueError):
+        Seq2Seq(tie_decoder=True, **kwargs)
+    model = Seq2Seq(tie_decoder=False, **kwargs)
+    assert model.decoder.projection_layer.__class__.__name__ == "AdaptiveProjection"
@@ -37,6 +37,20 @@ def test_attention_layer():
     assert (outputs[0] != outputs2[0]).all()
 
 
+def test_attention_layer_causal_mask_follows_the_module():
+    sl, bs, in_features = 3, 2, 32
+    layer = to_gpu(AttentionLayer(input_size=in_features, num_heads=4, dropout=0.0))
+    inputs = to_gpu(V(tr.randn([sl, bs, in_features])))
+    layer(inputs, inputs, inputs, mask=True)
+    # the cached mask is made again when the module and its inputs change type (or device)
+    layer = layer.double()
+    inputs = inputs.double()
+    outputs = layer(inputs, inputs, inputs, mask=True)
+    assert_dims(outputs, [sl, bs, in_features])
+    assert layer._causal_mask.dtype == inputs.dtype
+    assert layer._causal_mask.device == inputs.device
+
+
 def test_transfomer_layer():
     sl = 10
     bs = 2
@@ -96,3 +110,25 @@ def test_transformer_decoder_layers():
     assert_dims(layer_outputs2, [num_layers, 1, bs, in_features])
     for layer1, layer2 in zip(layer_outputs, layer_outputs2):
         assert ((layer1[0] - layer2[0]).abs() < 1E-6).all()
+
+
+def test_transformer_decoder_layers_incremental():
+    sl = 10
+    bs = 2
+    in_features = 32
+    num_layers = 5
+    inputs = to_gpu(V(T(tr.randn([sl, bs, in_features]))))
+    encoder_inputs = to_gpu(V(T(tr.randn([num_layers, sl, bs, in_features]))))
+    transformer = to_gpu(
+        TransformerDecoderLayers(input_size=in_features, num_heads=8, nhid=512, nlayers=num_layers, dropout=0.0))
+    layer_outputs = transformer(inputs, encoder_inputs)
+    transformer.reset(bs)
+    # decoding one step at a time with the cached keys and values should give the same outputs
+    for index in range(sl):
+        step_outputs = transformer(inputs[index:index + 1], encoder_inputs, incremental=True)
+        assert_dims(step_outputs, [num_layers, 1, bs, in_features])
+        assert_dims([list(state) for state in transformer.hidden], [num_layers, 2, index + 1, bs, in_features])
+        # the encoder projections are computed once and stay the same for every step
+        assert_dims([list(state) for state in transformer.encoder_projections], [num_layers, 2, sl, bs, in_features])
+        for layer1, layer2 in zip(layer_outputs, step_outputs):
+            assert ((layer1[index] - layer2[0]).abs() < 1E-5).all()